@@ -0,0 +1,217 @@
+"""Benchmarks of the ingestion stages. See conftest.py for how to run them"""
+import io
+import math
+import tracemalloc
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from unittest.mock import patch
+
+import pandas as pd  # type: ignore
+import pytest
+from openpyxl import Workbook  # type: ignore
+
+from transitstat._merge import bulk_merge, insert_or_update
+from transitstat._transform import CategoryDictionary
+from transitstat.circulator.import_ridership import DataImporter
+from transitstat.circulator.otp_reports import read_operator_report
+from transitstat.circulator.reports import REPORT_CATEGORIES, RidesystemReports
+from transitstat.connector.data_import import ConnectorImport
+from transitstat.connector.schema import Base as ConnectorBase, HcRidership
+from transitstat.database import ensure_schema, get_engine
+
+ROUTES = ['Purple', 'Orange', 'Green', 'Banner']
+STOPS = 120
+
+
+def make_ridership_workbook(path: Path, rows: int) -> None:
+    """Writes a monthly ridership spreadsheet with about rows route, block and day cells"""
+    weeks = min(52, math.ceil(rows / (7 * len(ROUTES))))
+    blocks = math.ceil(rows / (7 * len(ROUTES) * weeks))
+    workbook = Workbook(write_only=True)
+    for week in range(weeks):
+        start = datetime(2021, 1, 3) + timedelta(weeks=week)
+        sheet = workbook.create_sheet(start.strftime('%m-%d-%y'))
+        for _ in range(7):
+            sheet.append(['Circulator ridership by block'])
+        sheet.append([None, None, None] + [start + timedelta(days=i) for i in range(7)] + ['Total'])
+        for route in ROUTES:
+            sheet.append([None, route])
+            for block in range(1, blocks + 1):
+                counts = [(block * day) % 300 for day in range(1, 8)]
+                sheet.append([None, None, f'#{block}'] + counts + [sum(counts)])
+            sheet.append([None, None, 'Total'] + [0] * 8)
+        sheet.append([])
+        sheet.append(['Printed by Ridesystems'])
+    workbook.save(path)
+
+
+def make_connector_workbook(path: Path, rows: int) -> None:
+    """Writes a month of Harbor Connector trips, with one sheet per day"""
+    days = min(31, rows)
+    workbook = Workbook(write_only=True)
+    for day in range(days):
+        trip_date = datetime(2022, 3, 1) + timedelta(days=day)
+        sheet = workbook.create_sheet(f'HC2 {trip_date:%m-%d-%y}')
+        sheet.append(['Date', 'Depart Time', 'Count', 'Depart Location', 'Boardings'])
+        for trip in range(math.ceil(rows / days)):
+            sheet.append([trip_date, (trip_date + timedelta(minutes=15 * trip)).time(), trip + 1,
+                          'Canton Park' if trip % 2 else 'Locust Point', trip % 7])
+    workbook.save(path)
+
+
+def make_dispatch_workbook(path: Path, rows: int) -> None:
+    """Writes a month of dispatch reports, with one sheet per day"""
+    days = min(31, rows)
+    workbook = Workbook(write_only=True)
+    for day in range(days):
+        sheet = workbook.create_sheet(f'3.{day + 1}.22')
+        sheet.append(['Bus', 'Block', 'Operator', 'Nextel', 'Clock In/Temp', 'Start Time', 'Notes', 'Relief Vehicle',
+                      'Relief Location/Time', 'End Time', 'Clock Out'])
+        for row in range(math.ceil(rows / days)):
+            route = ROUTES[row % len(ROUTES)]
+            sheet.append([f'CC{1200 + row % 100}({row % 100:02})', f'{route} {row % 6 + 1} {"PM" if row % 2 else "AM"}',
+                          f'Person {row}', None, '6:00', '6:15', None, None, None, '14:00', '14:30'])
+    workbook.save(path)
+
+
+def test_insert_or_update(measure, new_conn_str, rows):
+    """Row at a time upserts, for comparison with bulk_merge"""
+    if rows > 10000:
+        pytest.skip('insert_or_update commits every row, so it takes too long past 10k rows')
+
+    def _setup():
+        conn_str = new_conn_str()
+        ensure_schema(get_engine(conn_str), ConnectorBase.metadata)
+        objs = [HcRidership(route_id=i % 10, date=date(2000, 1, 1) + timedelta(days=i // 10), riders=i)
+                for i in range(rows)]
+        return (objs, get_engine(conn_str)), {}, conn_str
+
+    def _insert(objs, engine):
+        for obj in objs:
+            insert_or_update(obj, engine)
+
+    measure(_insert, rows, _setup, rounds=1)
+
+
+def test_bulk_merge(measure, new_conn_str, rows):
+    """Set based upserts"""
+    def _setup():
+        conn_str = new_conn_str()
+        ensure_schema(get_engine(conn_str), ConnectorBase.metadata)
+        records = [{'route_id': i % 10, 'date': date(2000, 1, 1) + timedelta(days=i // 10), 'riders': i}
+                   for i in range(rows)]
+        return (HcRidership, records, get_engine(conn_str)), {}, conn_str
+
+    measure(bulk_merge, rows, _setup)
+
+
+def _import_ridership(conn_str: str, file: Path) -> bool:
+    return DataImporter(conn_str).import_ridership(file=file)
+
+
+def _parse_connector(conn_str: str, path: Path) -> dict:
+    return ConnectorImport(conn_str).parse_sheets(path)
+
+
+def test_import_ridership(measure, new_conn_str, rows, tmp_path_factory):
+    """DataImporter.import_ridership on a generated monthly spreadsheet"""
+    xlsx = tmp_path_factory.mktemp('ridership') / 'ridership.xlsx'
+    make_ridership_workbook(xlsx, rows)
+
+    def _setup():
+        conn_str = new_conn_str()
+        return (conn_str, xlsx), {}, conn_str
+
+    measure(_import_ridership, rows, _setup)
+
+
+def test_connector_parse_sheets(measure, new_conn_str, rows, tmp_path_factory):
+    """ConnectorImport.parse_sheets on a generated month of Harbor Connector trips"""
+    directory = tmp_path_factory.mktemp('connector')
+    make_connector_workbook(directory / 'HC2 03.2022.xlsx', rows)
+
+    def _setup():
+        conn_str = new_conn_str()
+        return (conn_str, directory), {}, conn_str
+
+    measure(_parse_connector, rows, _setup)
+
+
+def test_read_operator_report(measure, new_conn_str, rows, tmp_path_factory):
+    """read_operator_report on a generated month of dispatch reports"""
+    xlsx = tmp_path_factory.mktemp('dispatch') / 'dispatch.xlsx'
+    make_dispatch_workbook(xlsx, rows)
+
+    def _setup():
+        conn_str = new_conn_str()
+        return (conn_str, xlsx), {}, conn_str
+
+    measure(read_operator_report, rows, _setup)
+
+
+@pytest.mark.parametrize('report', ['otp', 'runtimes', 'ridership'])
+def test_ridesystems_load(measure, new_conn_str, dataset, rows, report):
+    """RidesystemReports loading a report, with the download replaced by a factory generated DataFrame"""
+    df = dataset(report, rows)
+    method, load = {'otp': ('get_otp', 'get_otp'),
+                    'runtimes': ('get_runtimes', 'get_vehicle_assignments'),
+                    'ridership': ('get_ridership', 'get_ridership')}[report]
+
+    def _setup():
+        conn_str = new_conn_str()
+        with patch('transitstat.circulator.reports.RideSystemsInterface') as rs_interface:
+            getattr(rs_interface.return_value, method).return_value = df
+            inst = RidesystemReports(conn_str, 'username', 'password')
+            # The login is lazy, so it has to happen while the interface is patched
+            assert inst.rs_cls is rs_interface.return_value
+        return (inst, date.today() - timedelta(days=2), date.today()), {'force': True}, conn_str
+
+    def _load(inst, start_date, end_date, force):
+        getattr(inst, load)(start_date, end_date, force)
+
+    measure(_load, rows, _setup)
+
+
+def test_compact_otp_month(benchmark, dataset, rows):
+    """
+    Memory of a month of OTP reports held as one frame per day, as a backfill does, with the text columns as strings
+    and as categoricals. Each day is parsed from CSV, so every frame has its own strings like a download does. Records
+    the memory still held once the month is read (object_mb and compact_mb) and the peak while reading it in the
+    extra_info. The factory makes up a new street for nearly every stop, so the stops are drawn from about as many as
+    the Circulator has
+    """
+    df = dataset('otp', rows)
+    days = pd.Series(pd.date_range('2022-03-01', '2022-03-31')).sample(len(df), replace=True, random_state=1)
+    stops = pd.Series(df['stop'].unique()[:STOPS]).sample(len(df), replace=True, random_state=1)
+    df = df.assign(date=days.to_numpy(), stop=stops.to_numpy())
+    reports = [day_df.to_csv(index=False) for _, day_df in df.groupby('date')]
+
+    def _read(compact):
+        categories = CategoryDictionary(REPORT_CATEGORIES)
+        frames = (pd.read_csv(io.StringIO(report)) for report in reports)
+        return [categories.compact(frame) if compact else frame for frame in frames]
+
+    benchmark.pedantic(_read, args=(True,), rounds=3)
+    for name, compact in (('object', False), ('compact', True)):
+        tracemalloc.start()
+        try:
+            frames = _read(compact)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del frames
+        benchmark.extra_info.update({f'{name}_mb': current / 1024 / 1024, f'{name}_peak_mb': peak / 1024 / 1024})
+    benchmark.extra_info['rows'] = rows
+
+
+def test_generated_workbooks(tmp_path_factory, conn_str):
+    """Checks that the generated workbooks parse into about as many rows as they were asked for"""
+    directory = tmp_path_factory.mktemp('generated')
+    make_ridership_workbook(directory / 'ridership.xlsx', 1000)
+    assert len(DataImporter._parse_file(directory / 'ridership.xlsx')) >= 1000  # pylint:disable=protected-access
+
+    make_connector_workbook(directory / 'HC2 03.2022.xlsx', 1000)
+    assert len(ConnectorImport(conn_str).parse_frames(directory)) == 31
+
+    make_dispatch_workbook(directory / 'dispatch.xlsx', 1000)
+    assert read_operator_report(conn_str, directory / 'dispatch.xlsx').inserted > 0
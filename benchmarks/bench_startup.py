@@ -0,0 +1,39 @@
+"""
+Startup cost of the report script, which cron runs often enough for a slow start to add up. Each benchmark starts a new
+interpreter with -X importtime, fails if one of the libraries that are only needed once there is work to do was
+imported, and records the total import time and the number of modules imported in its extra_info
+"""
+import subprocess  # nosec
+import sys
+from typing import Dict, List
+
+import pytest
+
+SCRIPT = 'transitstat.circulator.reports'
+# Imported the first time a report is downloaded or written, never at startup
+DEFERRED = ('pandas', 'numpy', 'pyarrow', 'ridesystems', 'transitstat.circulator.creds')
+
+
+def import_times(args: List[str]) -> Dict[str, int]:
+    """
+    Runs python -X importtime with args
+
+    :param args: Arguments after -X importtime, like ['-c', 'import transitstat']
+    :return: Dictionary of module -> import time in microseconds, not counting the modules it imported
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', *args], capture_output=True, text=True,  # nosec
+                          check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and not line.endswith('package'):
+            own, _, module = line[len('import time:'):].split('|')
+            times[module.strip()] = int(own)
+    return times
+
+
+@pytest.mark.parametrize('args', [['-c', f'import {SCRIPT}'], ['-m', SCRIPT, '--help']], ids=['import', 'help'])
+def test_startup(benchmark, args):
+    """Importing the report script, and printing its help"""
+    times = benchmark.pedantic(import_times, args=(args,), rounds=3)
+    assert not [module for module in DEFERRED if module in times]
+    benchmark.extra_info.update({'import_ms': sum(times.values()) / 1000, 'modules': len(times)})
@@ -0,0 +1,79 @@
+"""
+Compares the peak memory and wall time of pd.read_excel(sheet_name=None) against the streaming reader in
+transitstat._xlsx, on a synthetic workbook shaped like the monthly ridership spreadsheets.
+
+    python benchmarks/bench_xlsx.py --sheets 20 --rows 2000
+
+Each reader runs in its own process, so the peak RSS of one doesn't hide the other. Peak MB is the growth of the peak
+RSS during the read, after pandas and openpyxl are imported.
+"""
+import argparse
+import multiprocessing
+import resource
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import perf_counter
+
+import pandas as pd  # type: ignore
+from openpyxl import Workbook  # type: ignore
+
+from transitstat._xlsx import iter_sheets
+
+
+def make_workbook(path: Path, sheets: int, rows: int) -> None:
+    """Writes a workbook with sheets sheets, each with a header and rows rows of ridership by block and day"""
+    workbook = Workbook(write_only=True)
+    for sheet_num in range(sheets):
+        sheet = workbook.create_sheet(f'Week {sheet_num}')
+        start = datetime(2022, 1, 2) + timedelta(weeks=sheet_num)
+        sheet.append(['Route', 'Block'] + [start + timedelta(days=i) for i in range(7)])
+        for row_num in range(rows):
+            sheet.append([f'Route {row_num % 4}', f'#{row_num % 9}'] + [(row_num * i) % 500 for i in range(7)])
+    workbook.save(path)
+
+
+def _read_excel(path: Path) -> int:
+    return sum(len(df) for df in pd.read_excel(path, sheet_name=None).values())
+
+
+def _iter_sheets(path: Path) -> int:
+    return sum(len(df) for _, df in iter_sheets(path))
+
+
+def _measure(reader, path: Path, results) -> None:
+    # ru_maxrss is in kilobytes on Linux
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    start = perf_counter()
+    rows = reader(path)
+    results.put((rows, perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - baseline))
+
+
+def main(args) -> None:
+    """Builds the workbook and runs each reader in a fresh process"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sheets', type=int, default=20, help='Number of sheets in the workbook')
+    parser.add_argument('--rows', type=int, default=2000, help='Number of rows in each sheet')
+    parsed_args = parser.parse_args(args)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / 'ridership.xlsx'
+        make_workbook(path, parsed_args.sheets, parsed_args.rows)
+
+        context = multiprocessing.get_context('spawn')
+        print(f'{"reader":<15}{"rows":>10}{"seconds":>10}{"peak MB":>10}')
+        for name, reader in (('pd.read_excel', _read_excel), ('iter_sheets', _iter_sheets)):
+            results = context.Queue()
+            process = context.Process(target=_measure, args=(reader, path, results))
+            process.start()
+            process.join()
+            if process.exitcode:
+                print(f'{name:<15} failed')
+                continue
+            rows, seconds, peak = results.get()
+            print(f'{name:<15}{rows:>10}{seconds:>10.2f}{peak:>10.1f}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
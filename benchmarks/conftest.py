@@ -0,0 +1,98 @@
+"""
+Fixtures for the ingestion benchmarks. The datasets come from the factories in tests/conftest.py, and every stage runs
+against a fresh sqlite database. Run from the repository root:
+
+    pytest benchmarks                                   # 1k rows
+    pytest benchmarks --bench-sizes 1000,100000,1000000
+    pytest benchmarks --benchmark-compare               # diff against the last saved run
+
+Each run is saved to benchmarks/.baselines. Besides the timings, every benchmark records rows, rows_per_s, peak_mb
+(tracemalloc peak of one extra run) and queries (statements sent to the database in that run) in its extra_info.
+"""
+import itertools
+import tracemalloc
+from typing import Any, Callable, Dict, Tuple
+
+import pandas as pd  # type: ignore
+import pytest
+from sqlalchemy import event  # type: ignore
+
+from transitstat.database import get_engine
+
+# The dataset factories and conn_str fixture
+pytest_plugins = ['tests.conftest']
+
+_COUNTER = itertools.count()
+_DATASETS: Dict[Tuple[str, int], pd.DataFrame] = {}
+
+
+def pytest_addoption(parser):
+    """Adds the --bench-sizes option"""
+    parser.addoption('--bench-sizes', default='1000',
+                     help='Comma separated numbers of rows to run each benchmark with, like 1000,100000,1000000')
+
+
+def pytest_generate_tests(metafunc):
+    """Runs every benchmark that takes `rows` once for each of the --bench-sizes"""
+    if 'rows' in metafunc.fixturenames:
+        sizes = [int(i) for i in metafunc.config.getoption('--bench-sizes').split(',')]
+        metafunc.parametrize('rows', sizes, ids=[f'{i}rows' for i in sizes])
+
+
+@pytest.fixture(name='new_conn_str')
+def fixture_new_conn_str(tmp_path_factory) -> Callable[[], str]:
+    """Returns a function that gives the connection string of a new, empty sqlite database each time it is called"""
+    directory = tmp_path_factory.mktemp('bench')
+    return lambda: f'sqlite:///{directory / f"transitstat{next(_COUNTER)}.db"}'
+
+
+@pytest.fixture(name='dataset')
+def fixture_dataset(arrival_dataset, ridership_dataset, runtime_dataset) -> Callable[[str, int], pd.DataFrame]:
+    """Returns a function that builds a report DataFrame with the factories. They are reused across benchmarks, since
+    a million factory rows take minutes to build"""
+    factories = {'otp': arrival_dataset, 'ridership': ridership_dataset, 'runtimes': runtime_dataset}
+
+    def _dataset(report: str, rows: int) -> pd.DataFrame:
+        if (report, rows) not in _DATASETS:
+            _DATASETS[(report, rows)] = pd.DataFrame(data=factories[report].create_batch(rows))
+        return _DATASETS[(report, rows)]
+    return _dataset
+
+
+@pytest.fixture(name='measure')
+def fixture_measure(benchmark):
+    """
+    Returns a function that benchmarks a stage and records its throughput, peak memory and query count
+
+    measure(target, rows, setup, rounds) calls setup() before each call of target. setup returns the (args, kwargs)
+    to call target with, and the connection string of the database that target uses, so its queries can be counted
+    """
+    def _measure(target: Callable, rows: int, setup: Callable[[], Tuple[Tuple, Dict[str, Any], str]],
+                 rounds: int = 3) -> None:
+        def _setup():
+            args, kwargs, _ = setup()
+            return args, kwargs
+
+        benchmark.pedantic(target, setup=_setup, rounds=rounds)
+        if benchmark.stats is None:
+            # --benchmark-disable runs each benchmark once as a plain test
+            return
+
+        # One more run outside of the timing, to measure the memory and count the queries
+        args, kwargs, conn_str = setup()
+        queries = []
+        event.listen(get_engine(conn_str), 'before_cursor_execute', lambda *_: queries.append(1))
+        tracemalloc.start()
+        try:
+            target(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        benchmark.extra_info.update({
+            'rows': rows,
+            'rows_per_s': rows / benchmark.stats.stats.mean,
+            'peak_mb': peak / 1024 / 1024,
+            'queries': len(queries),
+        })
+    return _measure
@@ -20,5 +20,9 @@ setup(
         'sqlalchemy',
         'openpyxl',
         'ridesystems>=2.0.5',
-    ]
+    ],
+    extras_require={
+        'cache': ['pyarrow'],
+        'export': ['pyarrow'],
+    }
 )
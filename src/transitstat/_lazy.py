@@ -0,0 +1,21 @@
+"""Defers importing the heavy libraries (pandas, numpy) until they are used, so the scripts start quickly when they
+turn out to have nothing to do"""
+import importlib
+from types import ModuleType
+from typing import Any
+
+
+class LazyModule(ModuleType):  # pylint:disable=too-few-public-methods
+    """
+    Stands in for a module until one of its attributes is used, which imports it. Unlike importlib.util.LazyLoader,
+    the first use can come from several threads at once, since the import goes through the regular import locks
+
+    Annotations that use the module need `from __future__ import annotations`, or they import it when the function is
+    defined
+    """
+
+    def __getattr__(self, name: str) -> Any:
+        value = getattr(importlib.import_module(self.__name__), name)
+        # Later lookups of the attribute don't come back here
+        setattr(self, name, value)
+        return value
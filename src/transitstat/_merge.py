@@ -1,11 +1,40 @@
-"""Helper that makes up for the lack of MERGE in SqlAlchemy. One day they will support that, and this can be removed"""
+"""Helpers that make up for the lack of MERGE in SqlAlchemy. One day they will support that, and this can be removed"""
+from __future__ import annotations
+
+from typing import Any, Iterable, List, NamedTuple, Optional, TYPE_CHECKING, Union
+
 from loguru import logger
-from sqlalchemy import engine as engine_type, inspect as sqlalchemyinspect  # type: ignore
+from sqlalchemy import Column, MetaData, Table, and_, delete, engine as engine_type, exists, func, insert, \
+    inspect as sqlalchemyinspect, select, true, update  # type: ignore
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert  # type: ignore
+from sqlalchemy.engine import Connection  # type: ignore
 from sqlalchemy.orm import Session  # type: ignore
 from sqlalchemy.orm.decl_api import DeclarativeMeta  # type: ignore
 from sqlalchemy.exc import IntegrityError  # type: ignore
 from sqlalchemy.sql import text  # type: ignore
 
+from ._transform import Record, frame_to_records
+from ._lazy import LazyModule
+
+if TYPE_CHECKING:
+    import pandas as pd  # type: ignore
+else:
+    pd = LazyModule('pandas')
+
+MergeRows = Union['pd.DataFrame', Iterable[Union[DeclarativeMeta, Record]]]
+
+
+class MergeResult(NamedTuple):
+    """Number of rows inserted and updated by bulk_merge"""
+    inserted: int = 0
+    updated: int = 0
+
+
+class ReplaceResult(NamedTuple):
+    """Number of rows deleted and inserted by bulk_replace"""
+    deleted: int = 0
+    inserted: int = 0
+
 
 def insert_or_update(insert_obj: DeclarativeMeta, engine: engine_type, identity_insert=False) -> None:
     """
@@ -62,3 +91,191 @@ def insert_or_update(insert_obj: DeclarativeMeta, engine: engine_type, identity_
         if identity_insert:
             session.execute(text(f'SET IDENTITY_INSERT {insert_obj.__tablename__} OFF'))
         session.close()
+
+
+def bulk_merge(model: DeclarativeMeta, rows: MergeRows, bind: Union[engine_type.Engine, Connection],
+               chunk_size: Optional[int] = None) -> MergeResult:
+    """
+    Set based replacement for insert_or_update. The batch is written to a staging table, and then upserted into the
+    table for `model` with a single statement (MERGE on Sql Server, INSERT ... ON CONFLICT on Sqlite). Rows with
+    duplicate primary keys are collapsed, and the last one wins.
+
+    :param model: `sqlalchemy.ext.declarative.DeclarativeMeta` class of the table to upsert into
+    :param rows: A DataFrame with columns named after the table columns, or an iterable of `model` objects or
+        dictionaries keyed by column name
+    :param bind: Engine or connection to use. An engine gets its own transaction, and a connection uses whatever
+        transaction the caller has open
+    :param chunk_size: If set, the rows are staged and merged this many at a time, which bounds the size of the
+        staging table. All of the chunks are written in the same transaction
+    :return: The number of inserted and updated rows
+    """
+    table = model.__table__
+    records = _dedupe(table, _to_records(model, rows))
+    if not records:
+        return MergeResult()
+
+    if isinstance(bind, Connection):
+        result = _merge_chunks(bind, table, records, chunk_size)
+    else:
+        with bind.begin() as connection:
+            result = _merge_chunks(connection, table, records, chunk_size)
+
+    logger.debug('Merged {} rows into {}: {} inserted, {} updated', len(records), table.name, result.inserted,
+                 result.updated)
+    return result
+
+
+def bulk_replace(model: DeclarativeMeta, rows: MergeRows, bind: Union[engine_type.Engine, Connection], where: Any,
+                 chunk_size: Optional[int] = None) -> ReplaceResult:
+    """
+    Replaces the slice of a table that matches where with rows, like one day of a report. The delete and the inserts
+    happen in one transaction, so readers see either the old slice or the new one, and rows that are no longer in the
+    source are removed. Every row is expected to match where
+
+    :param model: `sqlalchemy.ext.declarative.DeclarativeMeta` class of the table
+    :param rows: A DataFrame with columns named after the table columns, or an iterable of `model` objects or
+        dictionaries keyed by column name
+    :param bind: Engine or connection to use. An engine gets its own transaction, and a connection uses whatever
+        transaction the caller has open
+    :param where: Sqlalchemy condition that selects the slice to replace, like model.date == day
+    :param chunk_size: If set, the rows are inserted this many at a time
+    :return: The number of deleted and inserted rows
+    """
+    table = model.__table__
+    records = _dedupe(table, _to_records(model, rows))
+
+    if isinstance(bind, Connection):
+        result = _replace_records(bind, table, where, records, chunk_size)
+    else:
+        with bind.begin() as connection:
+            result = _replace_records(connection, table, where, records, chunk_size)
+
+    logger.debug('Replaced {} rows of {} with {}', result.deleted, table.name, result.inserted)
+    return result
+
+
+def _replace_records(connection: Connection, table: Table, where: Any, records: List[Record],
+                     chunk_size: Optional[int]) -> ReplaceResult:
+    """Deletes the slice and inserts the records with one executemany per chunk"""
+    deleted = connection.execute(delete(table).where(where)).rowcount
+    if not records:
+        return ReplaceResult(deleted=deleted)
+
+    preparer = connection.dialect.identifier_preparer
+    identity_insert = connection.dialect.name == 'mssql' and _has_identity(table)
+    if identity_insert:
+        connection.execute(text(f'SET IDENTITY_INSERT {preparer.format_table(table)} ON'))
+    chunk_size = chunk_size or len(records)
+    for i in range(0, len(records), chunk_size):
+        connection.execute(insert(table), records[i:i + chunk_size])
+    if identity_insert:
+        connection.execute(text(f'SET IDENTITY_INSERT {preparer.format_table(table)} OFF'))
+    return ReplaceResult(deleted=deleted, inserted=len(records))
+
+
+def _to_records(model: DeclarativeMeta, rows: MergeRows) -> List[Record]:
+    """Converts the rows passed to bulk_merge into dictionaries keyed by column name"""
+    if isinstance(rows, pd.DataFrame):
+        return frame_to_records(rows, model)
+
+    attributes = {attr.key: attr.columns[0].name for attr in sqlalchemyinspect(model).column_attrs}
+    return [row if isinstance(row, dict) else {name: getattr(row, key) for key, name in attributes.items()}
+            for row in rows]
+
+
+def _dedupe(table: Table, records: List[Record]) -> List[Record]:
+    """Drops rows with a duplicated primary key, keeping the last one, because MERGE refuses to update a row twice"""
+    primary_keys = [column.name for column in table.primary_key.columns]
+    return list({tuple(record.get(key) for key in primary_keys): record for record in records}.values())
+
+
+def _merge_chunks(connection: Connection, table: Table, records: List[Record],
+                  chunk_size: Optional[int]) -> MergeResult:
+    """Merges the records chunk_size at a time. The records are already deduped, so the chunks don't share keys"""
+    chunk_size = chunk_size or len(records)
+    inserted = updated = 0
+    for i in range(0, len(records), chunk_size):
+        result = _merge_records(connection, table, records[i:i + chunk_size])
+        inserted += result.inserted
+        updated += result.updated
+    return MergeResult(inserted=inserted, updated=updated)
+
+
+def _merge_records(connection: Connection, table: Table, records: List[Record]) -> MergeResult:
+    """Stages the records and upserts them into table"""
+    dialect = connection.dialect.name
+    staging = Table(f'#stage_{table.name}' if dialect == 'mssql' else f'stage_{table.name}', MetaData(),
+                    *[Column(column.name, column.type) for column in table.columns],
+                    prefixes=[] if dialect == 'mssql' else ['TEMPORARY'])
+    staging.create(connection)
+    try:
+        connection.execute(staging.insert(), records)
+
+        join_on = and_(*[table.c[column.name] == staging.c[column.name] for column in table.primary_key.columns])
+        updated = connection.execute(select(func.count()).select_from(staging.join(table, join_on))).scalar()
+
+        if dialect == 'mssql':
+            _merge_mssql(connection, table, staging)
+        elif dialect == 'sqlite':
+            _merge_sqlite(connection, table, staging)
+        else:
+            _merge_generic(connection, table, staging, join_on)
+    finally:
+        staging.drop(connection)
+
+    return MergeResult(inserted=len(records) - updated, updated=updated)
+
+
+def _merge_mssql(connection: Connection, table: Table, staging: Table) -> None:
+    """Upserts the staging table into table with a Sql Server MERGE statement"""
+    preparer = connection.dialect.identifier_preparer
+    columns = [preparer.quote(column.name) for column in table.columns]
+    primary_keys = [preparer.quote(column.name) for column in table.primary_key.columns]
+    values = [i for i in columns if i not in primary_keys]
+
+    stmt = f'MERGE INTO {preparer.format_table(table)} WITH (HOLDLOCK) AS tgt ' \
+           f'USING {preparer.format_table(staging)} AS src ' \
+           f'ON {" AND ".join(f"tgt.{i} = src.{i}" for i in primary_keys)} '
+    if values:
+        stmt += f'WHEN MATCHED THEN UPDATE SET {", ".join(f"tgt.{i} = src.{i}" for i in values)} '
+    stmt += f'WHEN NOT MATCHED THEN INSERT ({", ".join(columns)}) VALUES ({", ".join(f"src.{i}" for i in columns)});'
+
+    identity_insert = _has_identity(table)
+    if identity_insert:
+        connection.execute(text(f'SET IDENTITY_INSERT {preparer.format_table(table)} ON'))
+    connection.execute(text(stmt))
+    if identity_insert:
+        connection.execute(text(f'SET IDENTITY_INSERT {preparer.format_table(table)} OFF'))
+
+
+def _has_identity(table: Table) -> bool:
+    """
+    Checks if Sql Server creates the table with an IDENTITY column, which can only be given values with IDENTITY_INSERT
+    on. That is the column sqlalchemy autoincrements: a single integer primary key that doesn't set autoincrement=False
+    """
+    # Only sqlalchemy 2.0 has a public name for it
+    return table._autoincrement_column is not None  # pylint:disable=protected-access
+
+
+def _merge_sqlite(connection: Connection, table: Table, staging: Table) -> None:
+    """Upserts the staging table into table with INSERT ... ON CONFLICT"""
+    # The WHERE clause is required by Sqlite so it can tell the ON CONFLICT apart from a join constraint
+    stmt = sqlite_insert(table).from_select([column.name for column in table.columns],
+                                            select(*staging.columns).where(true()))
+    values = {column.name: stmt.excluded[column.name] for column in table.columns if not column.primary_key}
+    primary_keys = [column.name for column in table.primary_key.columns]
+    if values:
+        stmt = stmt.on_conflict_do_update(index_elements=primary_keys, set_=values)
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=primary_keys)
+    connection.execute(stmt)
+
+
+def _merge_generic(connection: Connection, table: Table, staging: Table, join_on) -> None:
+    """Upserts the staging table into table with an UPDATE followed by an INSERT, for databases without a MERGE"""
+    values = {column.name: select(staging.c[column.name]).where(join_on).scalar_subquery()
+              for column in table.columns if not column.primary_key}
+    if values:
+        connection.execute(update(table).where(exists().where(join_on)).values(values))
+    connection.execute(insert(table).from_select([column.name for column in table.columns],
+                                                 select(*staging.columns).where(~exists().where(join_on))))
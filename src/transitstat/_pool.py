@@ -0,0 +1,61 @@
+"""Runs CPU bound file parsing on a pool of worker processes, while the results are consumed in the calling process"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+import pandas as pd  # type: ignore
+from loguru import logger
+
+from .metrics import metrics
+
+
+def map_files(func: Callable[[Path], Any], files: Iterable[Path], jobs: int = 1,
+              stage: Optional[str] = None) -> Iterator[Tuple[Path, Any, Optional[Exception]]]:
+    """
+    Calls func on each file, using up to jobs processes. With one job, files are processed in order in this process
+    and exceptions are raised as usual. With more, results are yielded as they finish, and an exception from one file
+    is logged and yielded instead of stopping the others
+
+    :param func: Module level function (so it can be pickled) that parses a file
+    :param files: Files to parse
+    :param jobs: Number of worker processes
+    :param stage: If set, the time spent in func is recorded in the metrics under this stage name. It is timed in the
+        worker, so it doesn't include waiting for a free process
+    :return: Generator of (file, result of func, exception raised by func or None)
+    """
+    files = list(files)
+    timed_func = partial(_timed, func)
+    if jobs <= 1 or len(files) < 2:
+        for file in files:
+            seconds, result = timed_func(file)
+            _record(stage, seconds, result)
+            yield file, result, None
+        return
+
+    with ProcessPoolExecutor(max_workers=min(jobs, len(files))) as executor:
+        futures = {executor.submit(timed_func, file): file for file in files}
+        for future in as_completed(futures):
+            file = futures[future]
+            try:
+                seconds, result = future.result()
+            except Exception as err:  # pylint:disable=broad-except
+                logger.error('Unable to parse {}: {}', file, err)
+                yield file, None, err
+                continue
+            _record(stage, seconds, result)
+            yield file, result, None
+
+
+def _timed(func: Callable[[Path], Any], file: Path) -> Tuple[float, Any]:
+    """Calls func, and returns how long it took along with its result"""
+    start_time = perf_counter()
+    result = func(file)
+    return perf_counter() - start_time, result
+
+
+def _record(stage: Optional[str], seconds: float, result: Any) -> None:
+    """Records a parsed file in the metrics. Only DataFrame results have a row count"""
+    if stage is not None:
+        metrics.record(stage, seconds, len(result) if isinstance(result, pd.DataFrame) else None)
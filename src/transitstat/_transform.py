@@ -0,0 +1,142 @@
+"""Vectorized conversion of report DataFrames into rows that can be handed to the bulk writer"""
+from __future__ import annotations
+
+import threading
+from typing import Any, Dict, Iterable, List, Optional, TYPE_CHECKING
+
+from loguru import logger
+from sqlalchemy.orm.decl_api import DeclarativeMeta  # type: ignore
+from sqlalchemy.types import Date, DateTime, Integer, Numeric, String, Time, TypeEngine  # type: ignore
+
+from ._lazy import LazyModule
+
+if TYPE_CHECKING:
+    import pandas as pd  # type: ignore
+else:
+    pd = LazyModule('pandas')
+
+Record = Dict[str, Any]
+
+# Distinct values a CategoryDictionary column can have before it is left as strings
+MAX_CATEGORIES = 2000
+
+
+def frame_to_records(df: pd.DataFrame, model: DeclarativeMeta,
+                     columns: Optional[Dict[str, str]] = None) -> List[Record]:
+    """
+    Converts a DataFrame into dictionaries keyed by column name, using whole column operations instead of iterating the
+    rows. Columns are renamed, columns that are not in the table are dropped, the values are coerced to the types in
+    the model, and NaN/NaT become None.
+
+    :param df: DataFrame to convert
+    :param model: `sqlalchemy.ext.declarative.DeclarativeMeta` class of the table the rows are going into
+    :param columns: Mapping of DataFrame column names to table column names, for the columns that don't already match
+    :return: List of records that can be passed to `transitstat._merge.bulk_merge`
+    """
+    if columns:
+        df = df.rename(columns=columns)
+    frame = pd.DataFrame({column.name: coerce_column(df[column.name], column.type)
+                          for column in model.__table__.columns if column.name in df.columns}, index=df.index)
+    return frame.astype(object).where(frame.notna(), None).to_dict('records')
+
+
+def coerce_column(series: pd.Series, column_type: TypeEngine) -> pd.Series:  # pylint:disable=too-many-return-statements
+    """
+    Converts a column to the python types that sqlalchemy expects for column_type. Values that can't be converted
+    become null
+
+    :param series: Column to convert
+    :param column_type: Sqlalchemy type of the table column
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # The categories only keep the frames small in memory. The database gets the values
+        series = series.astype(object)
+    if isinstance(column_type, DateTime):
+        return pd.Series(pd.to_datetime(series, errors='coerce').dt.to_pydatetime(), index=series.index, dtype=object)
+    if isinstance(column_type, Date):
+        return pd.to_datetime(series, errors='coerce').dt.date
+    if isinstance(column_type, Time):
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return series.dt.time
+        return series
+    if isinstance(column_type, Integer):
+        return pd.to_numeric(series, errors='coerce').round().astype('Int64')
+    if isinstance(column_type, Numeric):
+        return pd.to_numeric(series, errors='coerce')
+    if isinstance(column_type, String):
+        return series.map(_to_text, na_action='ignore')
+    return series
+
+
+def _to_text(value: Any) -> str:
+    """Converts a value for a text column. Numbers like the vehicle are read as floats when the column has blanks, and
+    are written without the .0"""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class CategoryDictionary:
+    """
+    Categories for the text columns of the reports that repeat the same few values on every row, like the routes,
+    stops and vehicles. Storing them as categoricals keeps one copy of each string per column instead of one per row.
+    The categories of a column only ever grow, so a value keeps the same code in every frame compacted with the same
+    dictionary, and the frames of different days can be combined without going back to strings
+    """
+
+    def __init__(self, columns: Iterable[str], max_categories: int = MAX_CATEGORIES):
+        """
+        :param columns: Names of the columns to store as categoricals. Other columns are left alone, besides the
+            integer columns being downcast
+        :param max_categories: Distinct values a column can have. Past that, the categories cost more than they save,
+            so the column is left as strings from then on
+        """
+        self.columns = set(columns)
+        self.max_categories = max_categories
+        self._categories: Dict[str, pd.Index] = {}
+        self._lock = threading.Lock()
+
+    def compact(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Converts the dictionary columns of df to categoricals, and downcasts the integer columns to the smallest type
+        that holds them. Floats are left as they are, since float32 doesn't have the precision of the coordinates
+
+        :param df: Frame to compact. It isn't modified
+        :return: The compacted frame
+        """
+        converted = {}
+        with self._lock:
+            for column in df.columns:
+                series = df[column]
+                if column in self.columns and (series.dtype == object or isinstance(series.dtype, pd.CategoricalDtype)):
+                    categories = self._categories.get(column, pd.Index([], dtype=object))
+                    new = pd.Index(series.dropna().unique(), dtype=object).difference(categories, sort=False)
+                    if len(categories) + len(new) > self.max_categories:
+                        logger.debug('{} has more than {} values, so it is left as strings', column,
+                                     self.max_categories)
+                        self.columns.discard(column)
+                        converted[column] = series.astype(object)
+                        continue
+                    if len(new):
+                        categories = categories.append(new)
+                    # Registered even when the column is all null, so concat can align it with the other frames
+                    self._categories[column] = categories
+                    converted[column] = pd.Categorical(series, categories=categories)
+                elif series.dtype.kind in 'iu':
+                    converted[column] = pd.to_numeric(series, downcast='integer')
+        return df.assign(**converted) if converted else df
+
+    def concat(self, frames: List[pd.DataFrame]) -> pd.DataFrame:
+        """
+        Combines frames, keeping the dictionary columns categorical. pd.concat only does that when every frame has
+        the same categories, so the frames compacted before the dictionary last grew are brought up to date first
+
+        :param frames: Frames to combine, compacted or not
+        """
+        frames = [self.compact(df) for df in frames]
+        with self._lock:
+            updated = [df.assign(**{column: df[column].cat.set_categories(self._categories[column])
+                                    for column in df.columns if column in self.columns and
+                                    isinstance(df[column].dtype, pd.CategoricalDtype)})
+                       for df in frames]
+        return pd.concat(updated, ignore_index=True)
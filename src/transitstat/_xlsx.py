@@ -0,0 +1,100 @@
+"""Streaming reader for xlsx files, so that only one sheet is held in memory at a time. This is a replacement for
+pd.read_excel(..., sheet_name=None), which loads every sheet of the workbook before returning"""
+from collections import deque
+from itertools import islice
+from pathlib import Path
+from typing import Any, Callable, Deque, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import pandas as pd  # type: ignore
+from openpyxl import load_workbook  # type: ignore
+from openpyxl.worksheet.worksheet import Worksheet  # type: ignore
+
+Row = Tuple[Any, ...]
+
+
+def iter_sheets(path: Path, skiprows: int = 0, skipfooter: int = 0,
+                include: Optional[Callable[[str], bool]] = None) -> Iterator[Tuple[str, pd.DataFrame]]:
+    """
+    Reads a workbook one sheet at a time. Each sheet is parsed like pd.read_excel would: the first row after skiprows
+    is the header, missing headers are named 'Unnamed: <column number>', columns past the last value in the sheet are
+    dropped, and trailing empty rows are dropped before the skipfooter rows are
+
+    :param path: xlsx file to read
+    :param skiprows: Number of rows at the top of each sheet to skip before the header
+    :param skipfooter: Number of rows at the bottom of each sheet to skip
+    :param include: Called with each sheet name. Sheets that it returns False for are not read at all
+    :return: Generator of (sheet name, DataFrame)
+    """
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for sheet_name in workbook.sheetnames:
+            if include is not None and not include(sheet_name):
+                continue
+
+            skipped_width, header, rows = _read_header(workbook[sheet_name], skiprows)
+            if header is None:
+                yield sheet_name, pd.DataFrame()
+                continue
+            data = list(_trim(rows, skipfooter))
+            yield sheet_name, _to_frame(header, data, max([skipped_width] + [_width(row) for row in [header, *data]]))
+    finally:
+        workbook.close()
+
+
+def _read_header(sheet: Worksheet, skiprows: int) -> Tuple[int, Optional[Row], Iterator[Row]]:
+    """
+    Skips the first skiprows rows of the sheet and reads the header
+
+    :return: Tuple of the width of the widest skipped row, the header row (None if the sheet is empty), and an iterator
+        over the rest of the rows
+    """
+    # The size recorded in the file is often wrong or missing, so let openpyxl read until the data ends (like pandas)
+    sheet.reset_dimensions()
+    rows = sheet.iter_rows(values_only=True)
+    skipped_width = max((_width(row) for row in islice(rows, skiprows)), default=0)
+    return skipped_width, next(rows, None), rows
+
+
+def _trim(rows: Iterable[Row], skipfooter: int) -> Iterator[Row]:
+    """
+    Drops trailing empty rows and then skipfooter rows from the end. Only the rows that might still be dropped are
+    buffered
+    """
+    pending: Deque[Row] = deque()
+    for row in rows:
+        pending.append(row)
+        if any(i is not None for i in row):
+            # Everything before the last skipfooter rows up to this non empty row is safe to return
+            while len(pending) > skipfooter:
+                yield pending.popleft()
+
+
+def _to_frame(header: Row, rows: Sequence[Row], width: int) -> pd.DataFrame:
+    """
+    Builds a DataFrame from the header and rows of a sheet
+
+    :param header: Header row
+    :param rows: Data rows
+    :param width: Number of columns. Rows are padded or truncated to fit
+    """
+    columns: List[Any] = []
+    for i in range(width):
+        column = header[i] if i < len(header) and header[i] is not None else f'Unnamed: {i}'
+        # pandas renames duplicated headers to <name>.1, <name>.2, ...
+        name, dupes = column, 0
+        while name in columns:
+            dupes += 1
+            name = f'{column}.{dupes}'
+        columns.append(name)
+
+    frame = pd.DataFrame([tuple(row[:width]) + (None,) * (width - len(row)) for row in rows], columns=columns)
+    # Empty cells are NaN, like they are with pd.read_excel
+    return frame.where(frame.notna(), float('nan'))
+
+
+def _width(row: Row) -> int:
+    """Length of the row without its trailing empty cells"""
+    for i in range(len(row), 0, -1):
+        if row[i - 1] is not None:
+            return i
+    return 0
@@ -1,10 +1,14 @@
 """Setup logging"""
 import argparse
+import logging
 import os
 import sys
 
 from loguru import logger
 
+from .metrics import emit_at_exit
+from .profiler import TOP_N, profile_at_exit
+
 
 def setup_parser(help_str="Driver for the transitstat scripts"):
     """Factory that creates the base argument parser"""
@@ -13,6 +17,14 @@ def setup_parser(help_str="Driver for the transitstat scripts"):
     parser.add_argument('-vv', '--debug', action='store_true', help='Print debug statements')
     parser.add_argument('-c', '--conn_str', help='Database connection string',
                         default='mssql+pyodbc://balt-sql311-prd/DOT_DATA?driver=ODBC Driver 17 for SQL Server')
+    parser.add_argument('--metrics_json', help='File to write the timing and row count summary of the run to, as JSON')
+    parser.add_argument('--metrics_prom',
+                        help='File to write the timing and row count summary of the run to, in the Prometheus text '
+                             'format for the node exporter textfile collector')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the database statements, and print the slowest ones when the script exits')
+    parser.add_argument('--profile_top', type=int, default=TOP_N,
+                        help='Number of statements to list in the profile')
 
     return parser
 
@@ -39,3 +51,29 @@ def setup_logging(debug=False, verbose=False):
     ]
 
     logger.configure(handlers=handlers)
+
+    # sqlalchemy logs each statement to the standard library logger. They are only wanted when debugging
+    sql_logger = logging.getLogger('sqlalchemy.engine')
+    sql_logger.handlers = [_SqlLogHandler()]
+    sql_logger.propagate = False
+    sql_logger.setLevel(logging.INFO if debug else logging.WARNING)
+
+
+def setup_reporting(args: argparse.Namespace, run: str) -> None:
+    """
+    Sets up the reports that are made when the script exits: the metrics summary, and the query profile if --profile
+    was passed
+
+    :param args: Arguments parsed by a parser from setup_parser
+    :param run: Name of the run, like the script and report
+    """
+    emit_at_exit(run, args.metrics_json, args.metrics_prom)
+    if args.profile:
+        profile_at_exit(args.profile_top)
+
+
+class _SqlLogHandler(logging.Handler):
+    """Sends the sqlalchemy statement log to loguru at the debug level"""
+    def emit(self, record: logging.LogRecord) -> None:
+        level = 'DEBUG' if record.levelno <= logging.INFO else record.levelname
+        logger.opt(exception=record.exc_info).log(level, record.getMessage())
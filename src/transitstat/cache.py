@@ -0,0 +1,142 @@
+"""On disk cache of downloaded reports, stored as one Parquet file per report, day and set of report arguments. Parquet
+support needs pyarrow, which is installed with the cache extra (pip install transitstat[cache])"""
+from __future__ import annotations
+
+import hashlib
+import importlib.util
+import json
+import os
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from time import time_ns
+from typing import Any, Dict, Optional, TYPE_CHECKING
+
+from loguru import logger
+
+from ._lazy import LazyModule
+
+if TYPE_CHECKING:
+    import pandas as pd  # type: ignore
+else:
+    pd = LazyModule('pandas')
+
+RECENT_DAYS = 7
+
+
+class ReportCache:
+    """
+    Stores and looks up report DataFrames by report, day and arguments. The modified time of a cached file is when the
+    report was downloaded, which is what max_age is checked against. Its access time is set on every hit, and is what
+    the least recently used reports are picked by
+    """
+
+    def __init__(self, directory: Path, *, max_age: Optional[timedelta] = None, max_size: Optional[int] = None,
+                 recent_days: int = RECENT_DAYS):
+        """
+        :param directory: Directory to keep the cached reports in. It is created if it doesn't exist
+        :param max_age: Cached reports older than this are ignored and deleted. By default, they never expire
+        :param max_size: Maximum total size of the cache in bytes. The least recently used reports are deleted to get
+            under it. By default, the size isn't limited
+        :param recent_days: Days this close to today can still change in Ridesystems, so they are never cached
+        """
+        if importlib.util.find_spec('pyarrow') is None:
+            raise ImportError('The report cache needs pyarrow. Install it with pip install transitstat[cache]')
+
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_age = max_age
+        self.max_size = max_size
+        self.recent_days = recent_days
+
+    def cacheable(self, day: date) -> bool:
+        """Checks if a day is old enough that its reports won't change anymore"""
+        return day <= date.today() - timedelta(days=self.recent_days)
+
+    def get(self, report: str, day: date, kwargs: Optional[Dict[str, Any]] = None) -> Optional[pd.DataFrame]:
+        """
+        Looks up a cached report
+
+        :param report: Name of the report, like get_otp
+        :param day: Day the report is for
+        :param kwargs: Arguments the report was requested with
+        :return: The report, or None if it isn't cached, is expired or the day is too recent to cache
+        """
+        if not self.cacheable(day):
+            return None
+
+        path = self._path(report, day, kwargs)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        if self.max_age is not None and datetime.now() - datetime.fromtimestamp(stat.st_mtime) > self.max_age:
+            path.unlink(missing_ok=True)
+            return None
+
+        df = pd.read_parquet(path)
+        # Mounts with noatime or relatime don't update the access time on reads, so it is set here. The modified time
+        # is kept, so the report still expires max_age after it was downloaded
+        os.utime(path, ns=(time_ns(), stat.st_mtime_ns))
+        return df
+
+    def put(self, report: str, day: date, df: pd.DataFrame, kwargs: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        Stores a report, unless the day is too recent to cache
+
+        :param report: Name of the report, like get_otp
+        :param day: Day the report is for
+        :param df: The report for just that day
+        :param kwargs: Arguments the report was requested with
+        :return: True if the report was stored
+        """
+        if not self.cacheable(day):
+            return False
+
+        path = self._path(report, day, kwargs)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        try:
+            df.to_parquet(tmp_path, index=False)
+        except (TypeError, ValueError, ImportError, OSError) as err:
+            # A report that Parquet can't store is just downloaded again next time
+            logger.warning('Unable to cache {} for {}: {}', report, day, err)
+            tmp_path.unlink(missing_ok=True)
+            return False
+        os.replace(tmp_path, path)
+        return True
+
+    def evict(self) -> int:
+        """
+        Deletes the expired reports, and then the least recently used ones until the cache is under max_size
+
+        :return: Number of reports deleted
+        """
+        oldest = (datetime.now() - self.max_age).timestamp() if self.max_age is not None else None
+        files = []
+        deleted = 0
+        for path in self.directory.glob('*/*.parquet'):
+            stat = path.stat()
+            if oldest is not None and stat.st_mtime < oldest:
+                path.unlink(missing_ok=True)
+                deleted += 1
+            else:
+                files.append((stat.st_atime, stat.st_size, path))
+        files.sort()
+
+        total_size = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if self.max_size is None or total_size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+            deleted += 1
+
+        if deleted:
+            logger.info('Deleted {} reports from the cache in {}', deleted, self.directory)
+        return deleted
+
+    def _path(self, report: str, day: date, kwargs: Optional[Dict[str, Any]]) -> Path:
+        """File for a report, named by the hash of the report, day and arguments"""
+        key = json.dumps({'report': report, 'date': day.isoformat(), 'kwargs': kwargs or {}}, sort_keys=True,
+                         default=str)
+        return self.directory / report / f'{hashlib.sha256(key.encode()).hexdigest()}.parquet'
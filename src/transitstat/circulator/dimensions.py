@@ -0,0 +1,339 @@
+"""Optional normalized storage for the widest Ridesystems tables. The route, stop, vehicle and block names move to
+dimension tables with integer keys, and ccc_ridership and ccc_arrival_times are stored as fact tables that only hold
+those keys. The old tables are kept as <table>_legacy, and views with the old table names join the facts back to the
+names, so existing queries keep working.
+
+Run `python -m transitstat.circulator.dimensions` once to convert a database. After that, RidesystemReports sees the
+views and writes to the fact tables on its own"""
+from __future__ import annotations
+
+# pylint:disable=too-few-public-methods
+import sys
+import threading
+from datetime import timedelta
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, TYPE_CHECKING
+
+from loguru import logger
+from sqlalchemy import Column, engine as engine_type, func, inspect, insert, select, text  # type: ignore
+from sqlalchemy.engine import Connection  # type: ignore
+from sqlalchemy.exc import IntegrityError  # type: ignore
+from sqlalchemy.ext.declarative import DeclarativeMeta  # type: ignore
+from sqlalchemy.orm import declarative_base  # type: ignore
+from sqlalchemy.types import Date, DateTime, Integer, Numeric, String, Time  # type: ignore
+
+from .schema import CirculatorArrival, CirculatorRidership, STOP_LENGTH
+from ..args import setup_logging, setup_parser, setup_reporting
+from ..database import ensure_schema, get_engine
+from .._merge import bulk_merge
+from .._transform import Record, frame_to_records
+from .._lazy import LazyModule
+
+if TYPE_CHECKING:
+    import pandas as pd  # type: ignore
+else:
+    pd = LazyModule('pandas')
+
+Base: DeclarativeMeta = declarative_base()
+
+# Days copied from a legacy table at a time
+COPY_DAYS = 31
+# Names looked up in one query
+LOOKUP_CHUNK_SIZE = 500
+
+
+class DimRoute(Base):
+    """Circulator routes"""
+    __tablename__ = 'dim_route'
+
+    route_key = Column(Integer, primary_key=True)
+    route = Column(String(length=50), nullable=False, unique=True)
+
+
+class DimStop(Base):
+    """Circulator stops, with the location from the ridership report"""
+    __tablename__ = 'dim_stop'
+
+    stop_key = Column(Integer, primary_key=True)
+    stop = Column(String(length=STOP_LENGTH), nullable=False, unique=True)
+    latitude = Column(Numeric(precision=9, scale=6))
+    longitude = Column(Numeric(precision=9, scale=6))
+
+
+class DimVehicle(Base):
+    """Circulator vehicles"""
+    __tablename__ = 'dim_vehicle'
+
+    vehicle_key = Column(Integer, primary_key=True)
+    vehicle = Column(String(length=20), nullable=False, unique=True)
+
+
+class DimBlock(Base):
+    """Circulator blocks"""
+    __tablename__ = 'dim_block'
+
+    block_key = Column(Integer, primary_key=True)
+    block_id = Column(String(length=100), nullable=False, unique=True)
+
+
+class CirculatorRidershipFact(Base):
+    """Normalized storage for ccc_ridership"""
+    __tablename__ = 'ccc_ridership_fact'
+
+    vehicle_key = Column(Integer, primary_key=True, autoincrement=False)
+    route_key = Column(Integer, primary_key=True, autoincrement=False)
+    stop_key = Column(Integer, primary_key=True, autoincrement=False)
+    datetime = Column(DateTime, primary_key=True, index=True)
+    boardings = Column(Integer)
+    alightings = Column(Integer)
+
+
+class CirculatorArrivalFact(Base):
+    """Normalized storage for ccc_arrival_times"""
+    __tablename__ = 'ccc_arrival_fact'
+
+    date = Column(Date, primary_key=True)
+    route_key = Column(Integer, primary_key=True, autoincrement=False)
+    block_key = Column(Integer, primary_key=True, autoincrement=False)
+    scheduled_arrival_time = Column(Time, primary_key=True)
+    stop_key = Column(Integer)
+    actual_arrival_time = Column(Time)
+    scheduled_departure_time = Column(Time)
+    actual_departure_time = Column(Time)
+    on_time_status = Column(String(length=10))
+    vehicle_key = Column(Integer)
+
+
+class Dimension(NamedTuple):
+    """A dimension table, and the columns of the wide table that it holds"""
+    model: DeclarativeMeta
+    key: str  # Integer key column, which is also the name of the column in the fact tables
+    name: str  # Column with the name, which is the same as in the wide table
+    attributes: Tuple[str, ...] = ()  # Other columns of the wide table that describe the name, like the location
+
+
+ROUTE = Dimension(DimRoute, 'route_key', 'route')
+STOP = Dimension(DimStop, 'stop_key', 'stop', ('latitude', 'longitude'))
+VEHICLE = Dimension(DimVehicle, 'vehicle_key', 'vehicle')
+BLOCK = Dimension(DimBlock, 'block_key', 'block_id')
+
+
+class FactSpec(NamedTuple):
+    """Describes how a wide table is stored as a fact table"""
+    wide: DeclarativeMeta  # Table that the reports are loaded into, which is replaced by a view
+    fact: DeclarativeMeta  # Table with the keys
+    date_column: str  # Date or datetime column of the wide table, which the rows are copied by
+    dimensions: Tuple[Dimension, ...]
+
+
+FACTS = {spec.wide.__tablename__: spec for spec in [
+    FactSpec(CirculatorRidership, CirculatorRidershipFact, 'datetime', (VEHICLE, ROUTE, STOP)),
+    FactSpec(CirculatorArrival, CirculatorArrivalFact, 'date', (ROUTE, BLOCK, STOP, VEHICLE)),
+]}
+
+
+class DimensionCache:
+    """
+    Looks up the keys of names, adding the names that are new. The keys never change once they are assigned, so they
+    are kept in memory for the life of the process
+    """
+
+    def __init__(self, engine: engine_type.Engine):
+        """
+        :param engine: Engine for the database with the dimension tables
+        """
+        self.engine = engine
+        self._keys: Dict[str, Dict[Any, int]] = {}
+        self._lock = threading.Lock()
+
+        ensure_schema(self.engine, Base.metadata)
+
+    def keys(self, dimension: Dimension, frame: pd.DataFrame) -> pd.Series:
+        """
+        Gets the key of the name in each row
+
+        :param dimension: Dimension to look the names up in
+        :param frame: Rows with the name column, and optionally the attribute columns, which are stored with new names
+        :return: Nullable integer keys, which are null where the name is
+        """
+        with self._lock:
+            cache = self._keys.setdefault(dimension.model.__tablename__, {})
+            missing = set(frame[dimension.name].dropna().unique()) - cache.keys()
+            if missing:
+                cache.update(self._lookup(dimension, frame, missing))
+            return frame[dimension.name].map(cache).astype('Int64')
+
+    def _lookup(self, dimension: Dimension, frame: pd.DataFrame, names: Set[Any]) -> Dict[Any, int]:
+        """Reads the keys of the names, inserting the names that aren't in the dimension table yet"""
+        found = self._select(dimension, names)
+        new = names - found.keys()
+        if new:
+            columns = [i for i in (dimension.name, *dimension.attributes) if i in frame.columns]
+            rows = frame.loc[frame[dimension.name].isin(new), columns].drop_duplicates(dimension.name)
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(insert(dimension.model.__table__),
+                                       frame_to_records(rows, dimension.model))
+            except IntegrityError:
+                # Another process added some of them first
+                logger.debug('Names were added to {} by someone else', dimension.model.__tablename__)
+                for name in new - self._select(dimension, new).keys():
+                    with self.engine.begin() as connection:
+                        connection.execute(insert(dimension.model.__table__), frame_to_records(
+                            rows[rows[dimension.name] == name], dimension.model))
+            found.update(self._select(dimension, new))
+        return found
+
+    def _select(self, dimension: Dimension, names: Iterable[Any]) -> Dict[Any, int]:
+        table = dimension.model.__table__
+        names = list(names)
+        ret: Dict[Any, int] = {}
+        with self.engine.connect() as connection:
+            for i in range(0, len(names), LOOKUP_CHUNK_SIZE):
+                ret.update(connection.execute(select(table.c[dimension.name], table.c[dimension.key]).where(
+                    table.c[dimension.name].in_(names[i:i + LOOKUP_CHUNK_SIZE]))).all())
+        return ret
+
+
+class NormalizedStorage:
+    """Redirects writes to the fact tables, for the wide tables that have been converted to views"""
+
+    def __init__(self, engine: engine_type.Engine):
+        """
+        :param engine: Engine for the database
+        """
+        self.engine = engine
+        self._views: Optional[Set[str]] = None
+        self._dimensions: Optional[DimensionCache] = None
+
+    def is_normalized(self, model: DeclarativeMeta) -> bool:
+        """Checks if the table of model was converted to a view over a fact table"""
+        if self._views is None:
+            self._views = set(inspect(self.engine).get_view_names()) & set(FACTS)
+        return model.__tablename__ in self._views
+
+    def prepare(self, model: DeclarativeMeta, rows: List[Record]) -> Tuple[DeclarativeMeta, List[Record]]:
+        """
+        Converts the rows of a wide table to the rows of its fact table, if the table has been converted
+
+        :param model: The wide table the rows are for
+        :param rows: Rows keyed by column name
+        :return: Tuple of the table to write to and the rows to write to it
+        """
+        if not self.is_normalized(model):
+            return model, rows
+        if self._dimensions is None:
+            self._dimensions = DimensionCache(self.engine)
+        spec = FACTS[model.__tablename__]
+        return spec.fact, to_facts(spec, pd.DataFrame.from_records(rows), self._dimensions)
+
+
+def to_facts(spec: FactSpec, frame: pd.DataFrame, dimensions: DimensionCache) -> List[Record]:
+    """
+    Replaces the names in the rows of a wide table with their keys
+
+    :param spec: The wide and fact tables
+    :param frame: Rows of the wide table
+    :param dimensions: Cache to look the keys up in
+    :return: Rows of the fact table
+    """
+    if frame.empty:
+        return []
+    keys = {dimension.key: dimensions.keys(dimension, frame) for dimension in spec.dimensions
+            if dimension.name in frame.columns}
+    return frame_to_records(frame.assign(**keys), spec.fact)
+
+
+def compatibility_view(spec: FactSpec):
+    """
+    Select that rebuilds the wide table from the fact table, with the columns in the same order
+
+    :param spec: The wide and fact tables
+    """
+    fact = spec.fact.__table__
+    joined = fact
+    sources = {}
+    for dimension in spec.dimensions:
+        table = dimension.model.__table__
+        # The stop and vehicle of an arrival can be missing
+        joined = joined.join(table, fact.c[dimension.key] == table.c[dimension.key],
+                             isouter=fact.c[dimension.key].nullable)
+        sources.update({column: table.c[column] for column in (dimension.name, *dimension.attributes)})
+
+    columns = [sources[column.name].label(column.name) if column.name in sources else fact.c[column.name]
+               for column in spec.wide.__table__.columns]
+    return select(*columns).select_from(joined)
+
+
+def normalize(engine: engine_type.Engine, tables: Optional[Iterable[str]] = None) -> Dict[str, int]:
+    """
+    Converts wide tables to normalized storage. The rows are copied to the fact table, the wide table is renamed to
+    <table>_legacy, and a view with the name of the wide table is created. The copy, rename and view of each table
+    happen in one transaction. Tables that were already converted are skipped
+
+    :param engine: Engine for the database
+    :param tables: Names of the tables to convert. By default, all of the tables in FACTS
+    :return: Dictionary of table -> number of rows copied
+    """
+    ensure_schema(engine, Base.metadata)
+    dimensions = DimensionCache(engine)
+    views = set(inspect(engine).get_view_names())
+
+    ret = {}
+    for name in tables or FACTS:
+        if name in views:
+            logger.info('{} was already converted', name)
+            continue
+
+        spec = FACTS[name]
+        # The names are added first, so the copy only reads the dimension tables
+        _load_dimensions(engine, spec, dimensions)
+
+        column = spec.wide.__table__.c[spec.date_column]
+        with engine.begin() as connection:
+            first, last = connection.execute(select(func.min(column), func.max(column))).one()
+            ret[name] = 0
+            lower = first
+            while lower is not None and lower <= last:
+                upper = lower + timedelta(days=COPY_DAYS)
+                chunk = pd.read_sql(select(spec.wide.__table__).where(column >= lower, column < upper), connection)
+                ret[name] += bulk_merge(spec.fact, to_facts(spec, chunk, dimensions), connection).inserted
+                lower = upper
+
+            _rename_table(connection, name, f'{name}_legacy')
+            view = compatibility_view(spec).compile(connection, compile_kwargs={'literal_binds': True})
+            connection.execute(text(f'CREATE VIEW {connection.dialect.identifier_preparer.quote(name)} AS {view}'))
+        logger.info('Converted {}: {} rows copied to {}', name, ret[name], spec.fact.__tablename__)
+    return ret
+
+
+def _load_dimensions(engine: engine_type.Engine, spec: FactSpec, dimensions: DimensionCache) -> None:
+    """Adds the names in a wide table to the dimension tables"""
+    table = spec.wide.__table__
+    for dimension in spec.dimensions:
+        columns = [table.c[i] for i in (dimension.name, *dimension.attributes) if i in table.c]
+        with engine.connect() as connection:
+            dimensions.keys(dimension, pd.read_sql(select(*columns).distinct(), connection))
+
+
+def _rename_table(connection: Connection, old: str, new: str) -> None:
+    preparer = connection.dialect.identifier_preparer
+    if connection.dialect.name == 'mssql':
+        connection.execute(text('EXEC sp_rename :old, :new'), {'old': old, 'new': new})
+    else:
+        connection.execute(text(f'ALTER TABLE {preparer.quote(old)} RENAME TO {preparer.quote(new)}'))
+
+
+def parse_args(args):
+    """Handles argument parsing"""
+    parser = setup_parser('Converts ccc_ridership and ccc_arrival_times to fact tables with dimension tables, and '
+                          'replaces them with views')
+    parser.add_argument('-t', '--tables', nargs='+', choices=list(FACTS), help='Tables to convert. Defaults to all')
+
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    parsed_args = parse_args(sys.argv[1:])
+    setup_logging(parsed_args.debug, parsed_args.verbose)
+    setup_reporting(parsed_args, 'normalize')
+    normalize(get_engine(parsed_args.conn_str), parsed_args.tables)
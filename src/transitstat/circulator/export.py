@@ -0,0 +1,160 @@
+"""Exports the Ridesystems tables to Parquet files partitioned by year, month and route, so that analysis can read
+columnar files instead of querying the database. Each day is written to its own file, and only the days that were
+loaded since they were last exported are written again"""
+from __future__ import annotations
+
+import sys
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, TYPE_CHECKING
+
+from loguru import logger
+from sqlalchemy import engine as engine_type, select  # type: ignore
+from sqlalchemy.orm.decl_api import DeclarativeMeta  # type: ignore
+from sqlalchemy.types import DateTime  # type: ignore
+
+from .schema import Base, CirculatorArrival, CirculatorRidership
+from ..args import setup_logging, setup_parser, setup_reporting
+from ..database import ensure_schema, get_engine
+from .._lazy import LazyModule
+from ..ledger import Ledger
+from ..metrics import metrics
+
+if TYPE_CHECKING:
+    import pandas as pd  # type: ignore
+    import pyarrow as pa  # type: ignore
+    import pyarrow.parquet as pq  # type: ignore
+else:
+    pd = LazyModule('pandas')
+    pa = LazyModule('pyarrow')
+    pq = LazyModule('pyarrow.parquet')
+
+PARTITION_COLUMNS = ['year', 'month', 'route']
+
+
+class ExportSpec(NamedTuple):
+    """Describes how a table is exported"""
+    model: DeclarativeMeta  # Table class to export
+    date_column: str  # Date or datetime column that the rows are exported by
+
+
+EXPORTS = {
+    CirculatorArrival.__tablename__: ExportSpec(CirculatorArrival, 'date'),
+    CirculatorRidership.__tablename__: ExportSpec(CirculatorRidership, 'datetime'),
+}
+
+
+def export_tables(conn_str: str, directory: Path, tables: Optional[Iterable[str]] = None,
+                  start_date: Optional[date] = None, end_date: Optional[date] = None) -> Dict[str, int]:
+    """
+    Exports the days of each table that were loaded since they were last exported. The files are written to
+    <directory>/<table>/year=<year>/month=<month>/route=<route>/<date>-0.parquet
+
+    :param conn_str: Database connection string
+    :param directory: Directory to write the export to
+    :param tables: Names of the tables to export. By default, all of the tables in EXPORTS
+    :param start_date: If set with end_date, export every day from start_date to end_date (inclusive) instead of using
+        the ledger to find the loaded days. This is how days loaded before the ledger existed are exported
+    :param end_date: Last date to export when start_date is set
+    :return: Dictionary of table -> number of rows exported
+    """
+    engine = get_engine(conn_str)
+    ensure_schema(engine, Base.metadata)
+    loads = Ledger(engine, 'ridesystems')
+    exports = Ledger(engine, 'parquet_export')
+
+    ret = {}
+    for table in tables or EXPORTS:
+        spec = EXPORTS[table]
+        if start_date is not None and end_date is not None:
+            days: Iterable[date] = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+        else:
+            days = days_to_export(loads.finished(table), exports.finished(table))
+
+        ret[table] = 0
+        for day in sorted(days):
+            with exports.track(table, day.isoformat()) as entry:
+                entry.rows = export_day(engine, spec, directory / table, day)
+            ret[table] += entry.rows
+        logger.info('Exported {} rows of {}', ret[table], table)
+    return ret
+
+
+def days_to_export(loaded: Dict[str, datetime], exported: Dict[str, datetime]) -> Set[date]:
+    """
+    Finds the days that finished loading after they were last exported
+
+    :param loaded: Dictionary of ISO date -> when it finished loading, from Ledger.finished
+    :param exported: Dictionary of ISO date -> when it finished exporting
+    """
+    return {date.fromisoformat(day) for day, finished in loaded.items()
+            if day not in exported or (finished is not None and exported[day] is not None and exported[day] < finished)}
+
+
+def export_day(engine: engine_type.Engine, spec: ExportSpec, directory: Path, day: date) -> int:
+    """
+    Writes one day of a table, replacing the files of any previous export of that day
+
+    :param engine: Engine for the database
+    :param spec: The table to export
+    :param directory: Directory with the export of the table
+    :param day: Day to export
+    :return: Number of rows written
+    """
+    column = spec.model.__table__.c[spec.date_column]
+    lower, upper = (day, day + timedelta(days=1)) if not isinstance(column.type, DateTime) else \
+        (datetime.combine(day, time()), datetime.combine(day + timedelta(days=1), time()))
+    table_name = spec.model.__tablename__
+    with metrics.stage(f'{table_name}.export_read') as stage, engine.connect() as connection:
+        df = pd.read_sql(select(spec.model.__table__).where(column >= lower, column < upper), connection)
+        stage.rows = len(df)
+
+    for path in directory.glob(f'*/*/*/{day.isoformat()}-*.parquet'):
+        path.unlink()
+    if df.empty:
+        return 0
+
+    with metrics.stage(f'{table_name}.export_write') as stage:
+        days = pd.to_datetime(df[spec.date_column])
+        df = df.assign(year=days.dt.year, month=days.dt.month)
+        pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), directory,
+                            partition_cols=PARTITION_COLUMNS, basename_template=f'{day.isoformat()}-{{i}}.parquet',
+                            existing_data_behavior='overwrite_or_ignore')
+        stage.rows = len(df)
+    return len(df)
+
+
+def read_export(directory: Path, table: str, columns: Optional[List[str]] = None,
+                filters: Optional[List] = None) -> pd.DataFrame:
+    """
+    Reads an exported table. Filters on year, month and route skip the partitions that don't match, and filters on the
+    other columns use the statistics in each file to skip the row groups that can't match
+
+    :param directory: Directory the tables were exported to
+    :param table: Name of the table to read
+    :param columns: Columns to read. By default, all of them
+    :param filters: Filters in the pyarrow format, like [('year', '=', 2022), ('route', 'in', ['Purple', 'Green'])]
+    """
+    return pd.read_parquet(directory / table, engine='pyarrow', columns=columns, filters=filters)
+
+
+def parse_args(args):
+    """Handles argument parsing"""
+    parser = setup_parser('Exports the Ridesystems tables to Parquet')
+    parser.add_argument('-d', '--dir', required=True, help='Directory to write the export to')
+    parser.add_argument('-t', '--tables', nargs='+', choices=list(EXPORTS), help='Tables to export. Defaults to all')
+    parser.add_argument('-s', '--startdate', type=date.fromisoformat,
+                        help='Export every day starting with this one, instead of the days loaded since the last '
+                             'export (format YYYY-MM-DD).')
+    parser.add_argument('-e', '--enddate', type=date.fromisoformat, default=date.today(),
+                        help='Last date to export with --startdate, inclusive (format YYYY-MM-DD).')
+
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    parsed_args = parse_args(sys.argv[1:])
+    setup_logging(parsed_args.debug, parsed_args.verbose)
+    setup_reporting(parsed_args, 'parquet_export')
+    export_tables(parsed_args.conn_str, Path(parsed_args.dir), parsed_args.tables, parsed_args.startdate,
+                  parsed_args.enddate)
@@ -1,36 +1,43 @@
 """Imports ridership data from the spreadsheets that are sent monthly"""
 import os
-import re
 import shutil
 import sys
 from datetime import datetime
-from math import isnan
 from pathlib import Path
-from typing import Optional
+from typing import Iterable, Iterator, Optional, Tuple
 
 import pandas as pd  # type: ignore
 from loguru import logger
-from sqlalchemy import create_engine  # type: ignore
 
-from transitstat.args import setup_logging, setup_parser
+from transitstat.args import setup_logging, setup_parser, setup_reporting
 from .schema import Base, CirculatorRidershipXLS
-from .._merge import insert_or_update
+from .._merge import bulk_merge
+from .._pool import map_files
+from .._transform import frame_to_records
+from .._xlsx import iter_sheets
+from ..database import ensure_schema, get_engine
+from ..ledger import Ledger, file_hash
+from ..metrics import metrics
+from ..row_hash import RowHashes
 
 
 class DataImporter:  # pylint:disable=too-few-public-methods
     """Imports ridership data from xlsx files"""
 
-    def __init__(self, conn_str: str):
+    def __init__(self, conn_str: str, jobs: int = 1):
         """
         :param conn_str: sqlalchemy connection string (IE sqlite:///crash.db or
         Driver={SQL Server};Server=balt-sql311-prd;Database=DOT_DATA;Trusted_Connection=yes;)
+        :param jobs: Number of processes used to parse the files in a directory. The database writes all happen in this
+        process
         """
-        logger.info('Creating db with connection string: {}', conn_str)
-        self.engine = create_engine(conn_str, echo=True, future=True)
+        self.engine = get_engine(conn_str)
         self.conn_str = conn_str
+        self.jobs = jobs
+        ensure_schema(self.engine, Base.metadata)
 
-        with self.engine.begin() as connection:
-            Base.metadata.create_all(connection)
+        self.ledger = Ledger(self.engine, 'ridership_xlsx')
+        self.row_hashes = RowHashes(self.engine, 'ridership_xlsx')
 
     def import_ridership(self, file: Optional[Path] = None, directory: Optional[Path] = None) -> bool:
         """
@@ -42,44 +49,80 @@ class DataImporter:  # pylint:disable=too-few-public-methods
         """
         if directory:
             logger.info('Processing directory {}', directory)
-            for xlsx in directory.glob('*.xlsx'):
-                if self.import_ridership(xlsx) and not self._file_move(xlsx, directory / '.processed'):
+            for xlsx, imported in self._import_files(sorted(directory.glob('*.xlsx'))):
+                if imported and not self._file_move(xlsx, directory / '.processed'):
                     return False
 
         if file:
+            return all(imported for _, imported in self._import_files([file]))
+        return True
+
+    def _import_files(self, files: Iterable[Path]) -> Iterator[Tuple[Path, bool]]:
+        """
+        Imports each of the files, skipping the ones that were already imported. Files are parsed on self.jobs
+        processes, and written to the database as they finish
+
+        :param files: xlsx files to import
+        :return: Generator of (file, whether it was imported or skipped)
+        """
+        table_name = CirculatorRidershipXLS.__tablename__
+        units = {}
+        for file in files:
             logger.info('Processing file {}', file)
-            dataframes = pd.read_excel(file, skiprows=[0, 1, 2, 3, 4, 5, 6], skipfooter=2,
-                                       sheet_name=None)
-            for key, dataframe in dataframes.items():
-                if key.lower().startswith('summary') or key.lower().startswith('sheet'):
-                    logger.warning('Skipping sheet name {}', key)
-                    continue
-
-                dataframe.dropna(axis=1, how='all', inplace=True, thresh=4)
-                dataframe.rename(columns={dataframe.columns[0]: 'Route', dataframe.columns[1]: 'Block'}, inplace=True)
-                cols = ['Route', 'Block']
-                dataframe.loc[:, cols] = dataframe.loc[:, cols].ffill()
-                dataframe.iloc[:, 2:] = dataframe.iloc[:, 2:].astype(int, errors='ignore')
-
-                if not any(isinstance(i, datetime) for i in dataframe.columns):
-                    logger.error('Expected data columns, and did not find any.\nFile: {}\nSheet: {}', file, key)
-                    return False
+            unit = file_hash(file)
+            if self.ledger.is_done(table_name, unit):
+                logger.info('Skipping {}. It was already imported', file)
+                yield file, True
+            else:
+                units[file] = unit
+
+        for file, rows, err in map_files(self._parse_file, units.keys(), self.jobs, stage=f'{table_name}.parse'):
+            if err is not None or rows is None:
+                self.ledger.fail(table_name, units[file], f'{file.name}: {err or "not in the expected format"}')
+                yield file, False
+                continue
+
+            with self.ledger.track(table_name, units[file], file.name) as entry, \
+                    metrics.stage(f'{table_name}.write') as stage:
+                # A corrected spreadsheet has a new file hash, so its rows are compared with the last file that covered
+                # the same days
+                hash_unit = _hash_unit(file, rows)
+                changed, _, hashes = self.row_hashes.diff(CirculatorRidershipXLS, table_name, hash_unit,
+                                                          frame_to_records(rows, CirculatorRidershipXLS))
+                with self.engine.begin() as connection:
+                    result = bulk_merge(CirculatorRidershipXLS, changed, connection)
+                    self.row_hashes.save(table_name, hash_unit, hashes, connection)
+                entry.rows = stage.rows = result.inserted + result.updated
+            logger.info('{}: {} rows inserted, {} rows updated', file, result.inserted, result.updated)
+            yield file, True
+
+    @staticmethod
+    def _parse_file(file: Path) -> Optional[pd.DataFrame]:
+        """
+        Reads the ridership from each of the sheets of a monthly spreadsheet
 
-                for _, row in dataframe.iterrows():
-                    if row['Block'] == 'Total' or (isinstance(row['Block'], float) and isnan(row['Block'])):
-                        continue
+        :param file: Path to the xlsx file to parse
+        :return: DataFrame with the columns RidershipDate, Route, BlockID and Riders, or None if the spreadsheet is not
+        in the expected format
+        """
+        def _include_sheet(sheet_name: str) -> bool:
+            if sheet_name.lower().startswith('summary') or sheet_name.lower().startswith('sheet'):
+                logger.warning('Skipping sheet name {}', sheet_name)
+                return False
+            return True
 
-                    for bus_date in dataframe.columns[2:]:
-                        if (isinstance(row[bus_date], float) and isnan(row[bus_date])) or \
-                                not isinstance(bus_date, datetime):
-                            continue
+        frames = []
+        # Sheets are read one at a time instead of loading the whole workbook
+        for key, dataframe in iter_sheets(file, skiprows=7, skipfooter=2, include=_include_sheet):
+            frame = _sheet_to_long(dataframe)
+            if frame is None:
+                logger.error('Expected data columns, and did not find any.\nFile: {}\nSheet: {}', file, key)
+                return None
+            frames.append(frame)
 
-                        if isinstance(row[bus_date], (int, float)):
-                            insert_or_update(CirculatorRidershipXLS(RidershipDate=bus_date.date(),
-                                                                    Route=row['Route'],
-                                                                    BlockID=int(re.sub('[^0-9]', '', row['Block'])),
-                                                                    Riders=int(row[bus_date])), self.engine)
-        return True
+        if not frames:
+            return pd.DataFrame(columns=['RidershipDate', 'Route', 'BlockID', 'Riders'])
+        return pd.concat(frames, ignore_index=True)
 
     @staticmethod
     def _file_move(file_name: Path, processed_dir: Path) -> bool:
@@ -109,6 +152,53 @@ class DataImporter:  # pylint:disable=too-few-public-methods
         return False
 
 
+def _sheet_to_long(dataframe: pd.DataFrame) -> Optional[pd.DataFrame]:
+    """
+    Converts a weekly sheet, which has a row per route and block and a column per day, to one row per route, block and
+    day. Route headers, Total rows and empty cells are dropped
+
+    :param dataframe: Sheet as read by iter_sheets
+    :return: DataFrame with the columns RidershipDate, Route, BlockID and Riders, or None if there are no date columns
+    """
+    # Drops the mostly empty spacer columns
+    dataframe = dataframe.dropna(axis=1, thresh=4)
+    dataframe = dataframe.rename(columns={dataframe.columns[0]: 'Route', dataframe.columns[1]: 'Block'})
+    date_columns = [i for i in dataframe.columns[2:] if isinstance(i, datetime)]
+    if not date_columns:
+        return None
+
+    # The route is only filled in on its header row
+    dataframe = dataframe.assign(Route=dataframe['Route'].ffill(), Block=dataframe['Block'].ffill())
+    dataframe = dataframe[dataframe['Block'].notna() & (dataframe['Block'] != 'Total')]
+
+    frame = dataframe.melt(id_vars=['Route', 'Block'], value_vars=date_columns, var_name='RidershipDate',
+                           value_name='Riders')
+    frame['Riders'] = pd.to_numeric(frame['Riders'], errors='coerce')
+    frame = frame[frame['Riders'].notna()]
+    return pd.DataFrame({
+        'RidershipDate': pd.to_datetime(frame['RidershipDate']).dt.date,
+        'Route': frame['Route'],
+        # Blocks are labeled like '#3'
+        'BlockID': frame['Block'].astype(str).str.replace('[^0-9]', '', regex=True).astype(int),
+        'Riders': frame['Riders'].astype(int),
+    })
+
+
+def _hash_unit(file: Path, rows: pd.DataFrame) -> str:
+    """
+    The unit that the row hashes of a spreadsheet are kept under. It is the days the spreadsheet covers, so files with
+    the same name from different months don't share hashes, while a corrected copy of a month is still compared with
+    the original
+
+    :param file: The spreadsheet
+    :param rows: Rows parsed from it
+    """
+    days = rows['RidershipDate'].dropna()
+    if days.empty:
+        return str(file.resolve())
+    return f'{days.min().isoformat()}/{days.max().isoformat()}'
+
+
 def parse_args(args):
     """Handles argument parsing"""
     parser = setup_parser('Imports ridership data from a standard XLSX file')
@@ -116,6 +206,8 @@ def parse_args(args):
     # Import harbor connector file
     parser.add_argument('-f', '--file', help='File to import')
     parser.add_argument('-d', '--dir', help='Directory to process that contains XLSX files with ridership data')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes to use to parse the files in a directory')
 
     return parser.parse_args(args)
 
@@ -123,9 +215,10 @@ def parse_args(args):
 if __name__ == '__main__':
     parsed_args = parse_args(sys.argv[1:])
     setup_logging(parsed_args.debug, parsed_args.verbose)
+    setup_reporting(parsed_args, 'ridership_xlsx')
 
     # Import ridership
-    di = DataImporter(parsed_args.conn_str)
+    di = DataImporter(parsed_args.conn_str, parsed_args.jobs)
     if parsed_args.file:
         di.import_ridership(file=Path(parsed_args.file))
 
@@ -5,51 +5,93 @@ from datetime import datetime
 from pathlib import Path
 
 import pandas as pd  # type: ignore
-from sqlalchemy import create_engine  # type: ignore
+from loguru import logger
 
-from transitstat.args import setup_logging, setup_parser
-from .schema import Base
+from transitstat.args import setup_logging, setup_parser, setup_reporting
+from transitstat.database import ensure_schema, get_engine
+from transitstat.metrics import metrics
+from .schema import Base, CirculatorOperator
+from .._merge import MergeResult, bulk_merge
+from .._transform import CategoryDictionary
+from .._xlsx import iter_sheets
 
 
-def read_operator_report(conn_str, path: Path):
-    """
-    Reads the operator reports sent by RMA
-    """
-    engine = create_engine(conn_str, echo=True, future=True)
-    with engine.begin() as connection:
-        Base.metadata.create_all(connection)
-
-    # Filter non-date sheets
-    excel_file = pd.ExcelFile(path)
-    valid_sheets = [i for i in excel_file.sheet_names if re.match(r'\d{1,2}\.\d{1,2}\.\d{2,4}', i)]
-    for sheet_name in valid_sheets:
-        df = excel_file.parse(sheet_name)
-
-        # Drop rows where the first column doesn't have numbers, or operator name is empty
-        df = df.loc[df.iloc[:, 0].str.contains(r'\d{3,4}', na=False)]
-        df = df.loc[df.iloc[:, 2].str.contains(r'.+', na=False)]
-        column_names = ['Bus', 'Block', 'Operator', 'Nextel', 'Clock In/Temp', 'Start Time', 'Notes', 'Relief Vehicle',
-                        'Relief Location/Time', 'End Time', 'Clock Out']
-        extra_cols = len(df.columns) - len(column_names)
-        if extra_cols > 0:
-            column_names += ['NA'] * extra_cols
-
-        df.columns = column_names
+CHUNK_SIZE = 5000
+OPERATOR_COLUMNS = ['Bus', 'Block', 'Operator', 'Nextel', 'Clock In/Temp', 'Start Time', 'Notes', 'Relief Vehicle',
+                    'Relief Location/Time', 'End Time', 'Clock Out']
+# Columns of the parsed sheets that repeat across rows and days, which are held in memory as categoricals
+OPERATOR_CATEGORIES = ('Bus', 'Vehicle', 'Route', 'Block', 'Operator', 'Time_of_day')
 
-        df['Vehicle'] = 'Bus ' + df['Bus'].str.upper().str.extract(r'CC\d{4}\((\d{2})\)')
-        df['Route'] = df['Block'].str.upper().str.extract(r'(ORANGE|PURPLE|BANNER|GREEN)')
-        df['Date'] = datetime.strptime(sheet_name.strip(), '%m.%d.%y')
-        df['Time_of_day'] = df['Block'].str.extract('(PM)').fillna('AM')
 
-        block_df = df['Block'].str.upper().str.extract(r'^(P|O|B|G)\w*[ ]?(\d)')
-        df['Block'] = block_df[0] + block_df[1]
-        df['Bus'] = 'CC' + df['Bus'].str.upper().str.extract(r'(\d{3,4})')
+def read_operator_report(conn_str, path: Path, chunk_size: int = CHUNK_SIZE) -> MergeResult:
+    """
+    Reads the operator reports sent by RMA. All of the daily sheets are combined and upserted together, so reloading
+    a report updates the rows that are already there instead of failing on them
 
-        for i in ['Nextel', 'NA', 'Clock In/Temp', 'Relief Location/Time', 'Clock Out', 'Start Time',
-                  'Notes', 'Relief Vehicle', 'End Time']:
-            df.drop(i, axis=1, inplace=True)
+    :param conn_str: Database connection string
+    :param path: Dispatch report to read
+    :param chunk_size: Number of rows to merge into the database at a time
+    :return: The number of inserted and updated rows
+    """
+    engine = get_engine(conn_str)
+    ensure_schema(engine, Base.metadata)
+
+    table_name = CirculatorOperator.__tablename__
+    categories = CategoryDictionary(OPERATOR_CATEGORIES)
+    with metrics.stage(f'{table_name}.parse') as stage:
+        # Filter non-date sheets
+        frames = [categories.compact(_parse_sheet(sheet_name, df)) for sheet_name, df in
+                  iter_sheets(path, include=lambda name: bool(re.match(r'\d{1,2}\.\d{1,2}\.\d{2,4}', name)))]
+        stage.rows = sum(len(frame) for frame in frames)
+    if not frames:
+        return MergeResult()
+
+    with metrics.stage(f'{table_name}.transform') as stage:
+        df = categories.concat(frames)
+
+        # Rows without a full key can't be stored, and a bus shows up once per key even if the sheet repeats it
+        primary_key = [column.name for column in CirculatorOperator.__table__.primary_key.columns]
+        missing = df[primary_key].isna().any(axis=1)
+        if missing.any():
+            logger.warning('Skipping {} operator rows in {} without a bus, block, operator or date', missing.sum(),
+                           path)
+        df = df[~missing].drop_duplicates(primary_key, keep='last')
+        stage.rows = len(df)
+
+    with metrics.stage(f'{table_name}.write') as stage:
+        result = bulk_merge(CirculatorOperator, df, engine, chunk_size=chunk_size)
+        stage.rows = result.inserted + result.updated
+    logger.info('{}: {} operator rows inserted, {} rows updated', path, result.inserted, result.updated)
+    return result
+
+
+def _parse_sheet(sheet_name: str, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts one daily sheet of the dispatch report to the columns of ccc_operators
 
-        df.to_sql('ccc_operators', con=engine, if_exists='append', index=False)
+    :param sheet_name: Name of the sheet, which is the date like 3.1.22
+    :param df: The sheet
+    """
+    # Drop rows where the first column doesn't have numbers, or operator name is empty
+    df = df.loc[df.iloc[:, 0].str.contains(r'\d{3,4}', na=False)]
+    df = df.loc[df.iloc[:, 2].str.contains(r'.+', na=False)]
+    column_names = list(OPERATOR_COLUMNS)
+    extra_cols = len(df.columns) - len(column_names)
+    if extra_cols > 0:
+        column_names += ['NA'] * extra_cols
+
+    df.columns = column_names
+
+    block_df = df['Block'].str.upper().str.extract(r'^(P|O|B|G)\w*[ ]?(\d)')
+    return pd.DataFrame({
+        'Bus': 'CC' + df['Bus'].str.upper().str.extract(r'(\d{3,4})', expand=False),
+        'Vehicle': 'Bus ' + df['Bus'].str.upper().str.extract(r'CC\d{4}\((\d{2})\)', expand=False),
+        'Route': df['Block'].str.upper().str.extract(r'(ORANGE|PURPLE|BANNER|GREEN)', expand=False),
+        'Block': block_df[0] + block_df[1],
+        'Operator': df['Operator'],
+        'Date': datetime.strptime(sheet_name.strip(), '%m.%d.%y'),
+        'Time_of_day': df['Block'].str.extract('(PM)', expand=False).fillna('AM'),
+    })
 
 
 def parse_args(args):
@@ -57,6 +99,7 @@ def parse_args(args):
     parser = setup_parser('Parses the operator reports')
 
     parser.add_argument('-f', '--file', required=True, help='Excel file to import')
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE, help='Number of rows to write at a time')
 
     return parser.parse_args(args)
 
@@ -64,5 +107,6 @@ def parse_args(args):
 if __name__ == '__main__':
     parsed_args = parse_args(sys.argv[1:])
     setup_logging(parsed_args.debug, parsed_args.verbose)
+    setup_reporting(parsed_args, 'operator_report')
 
-    read_operator_report(parsed_args.conn_str, parsed_args.file)
+    read_operator_report(parsed_args.conn_str, Path(parsed_args.file), parsed_args.chunk_size)
@@ -1,39 +1,140 @@
 """ Driver for the ridesystems report scraper"""
+from __future__ import annotations
+
+import importlib
+import queue
 import sys
-from datetime import date, datetime, timedelta
-from typing import Optional, Union
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
+from functools import cached_property
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple, TYPE_CHECKING, Union
 
-import pandas as pd  # type: ignore
 import sqlalchemy.orm  # type: ignore
 from loguru import logger
-from ridesystems.reports import Reports as RideSystemsInterface
-from sqlalchemy import create_engine  # type: ignore
+from sqlalchemy import Column, and_, func, inspect, select  # type: ignore
+from sqlalchemy.engine import Connection  # type: ignore
+from sqlalchemy.ext.compiler import compiles  # type: ignore
 from sqlalchemy.orm import Session  # type: ignore
+from sqlalchemy.orm.decl_api import DeclarativeMeta  # type: ignore
+from sqlalchemy.sql.elements import ColumnElement  # type: ignore
+from sqlalchemy.sql.functions import FunctionElement  # type: ignore
+from sqlalchemy.types import Date, DateTime  # type: ignore
+from tenacity import Retrying, stop_after_attempt, wait_random_exponential
 
-from .creds import RIDESYSTEMS_USERNAME, RIDESYSTEMS_PASSWORD
-from ..args import setup_logging, setup_parser
+from .dimensions import NormalizedStorage
+from ..cache import RECENT_DAYS, ReportCache
+from .rollups import refresh_otp_rollups, refresh_ridership_rollups
+from ..args import setup_logging, setup_parser, setup_reporting
+from ..database import ensure_schema, get_engine
+from ..ledger import DONE, Ledger
+from ..metrics import metrics
+from ..row_hash import Base as RowHashBase, RowHashes
 from .schema import Base, CirculatorArrival, CirculatorBusRuntimes, CirculatorRidership
-from .._merge import insert_or_update
+from .._merge import bulk_merge, bulk_replace
+from .._transform import CategoryDictionary, Record, frame_to_records
+from .._lazy import LazyModule
+
+if TYPE_CHECKING:
+    import pandas as pd  # type: ignore
+    from ridesystems.reports import Reports as RideSystemsInterface
+else:
+    pd = LazyModule('pandas')
+
+# Ridesystems report columns that are named differently in the database
+OTP_COLUMNS = {
+    'blockid': 'block_id',
+    'scheduledarrivaltime': 'scheduled_arrival_time',
+    'actualarrivaltime': 'actual_arrival_time',
+    'scheduleddeparturetime': 'scheduled_departure_time',
+    'actualdeparturetime': 'actual_departure_time',
+    'ontimestatus': 'on_time_status',
+}
+RUNTIME_COLUMNS = {'vehicle': 'busid', 'start_time': 'starttime', 'end_time': 'endtime'}
+RIDERSHIP_COLUMNS = {'entries': 'boardings', 'exits': 'alightings'}
+# Report columns with a handful of values repeated on every row, which are held in memory as categoricals
+REPORT_CATEGORIES = ('route', 'stop', 'vehicle', 'blockid', 'ontimestatus')
+
+# How the downloaded days are written. merge upserts the rows, and replace swaps out the whole day
+MERGE = 'merge'
+REPLACE = 'replace'
+
+DateRange = Tuple[date, date]
+
+
+class ReportSpec(NamedTuple):
+    """Describes how a Ridesystems report is downloaded and stored"""
+    method: str  # Name of the RideSystemsInterface method that pulls the report
+    model: DeclarativeMeta  # Table class that the report is written to
+    columns: Dict[str, str]  # Report column names that are named differently in the table
+    date_column: str  # Report column that is used to split a multi day report into days
 
 
-class RidesystemReports:
+OTP_REPORT = ReportSpec('get_otp', CirculatorArrival, OTP_COLUMNS, 'date')
+RUNTIME_REPORT = ReportSpec('get_runtimes', CirculatorBusRuntimes, RUNTIME_COLUMNS, 'start_time')
+RIDERSHIP_REPORT = ReportSpec('get_ridership', CirculatorRidership, RIDERSHIP_COLUMNS, 'datetime')
+
+
+class RidesystemReports:  # pylint:disable=too-many-instance-attributes
     """Populates data from the Ridesystems API into the database"""
 
-    def __init__(self, conn_str: str, rs_user: Optional[str] = None, rs_pass: Optional[str] = None):
+    def __init__(self, conn_str: str, rs_user: Optional[str] = None, rs_pass: Optional[str] = None,  # pylint:disable=too-many-arguments
+                 *, workers: int = 1, request_interval: float = 0.0, max_span: int = 7,
+                 cache: Optional[ReportCache] = None, mode: str = MERGE):
         """
         :param conn_str: Database connection string
         :param rs_user: Ridesystems username
         :param rs_pass: Ridesystems password
+        :param workers: Number of reports to download from Ridesystems at the same time. Each worker logs in with its
+        own session
+        :param request_interval: Minimum number of seconds between the start of two Ridesystems requests
+        :param max_span: Maximum number of consecutive days to request from Ridesystems in a single report
+        :param cache: If set, days that are already in the cache are read from it instead of Ridesystems, and
+        downloaded days are added to it
+        :param mode: MERGE to upsert the downloaded rows, or REPLACE to delete each downloaded day and insert it again
+        in one transaction. REPLACE also removes the rows that Ridesystems no longer has, which makes it the better
+        choice for forced reloads
         """
-        if rs_user is None:
-            rs_user = RIDESYSTEMS_USERNAME
-        if rs_pass is None:
-            rs_pass = RIDESYSTEMS_PASSWORD
-        self.rs_cls = RideSystemsInterface(rs_user, rs_pass)
+        if mode not in (MERGE, REPLACE):
+            raise ValueError(f'Unknown mode {mode}')
+        self._rs_creds = (rs_user, rs_pass)
+        # Logged in sessions of the worker threads, which are handed back when a download finishes
+        self._rs_pool: queue.Queue = queue.Queue()
+        self._rs_lock = threading.Lock()
+        self._rs_session: Optional[RideSystemsInterface] = None
 
-        self.engine = create_engine(conn_str, echo=True, future=True)
-        with self.engine.begin() as connection:
-            Base.metadata.create_all(connection)
+        self.workers = max(workers, 1)
+        self.max_span = max(max_span, 1)
+        self._rate_limiter = _RateLimiter(request_interval)
+        self.cache = cache
+        self.mode = mode
+        # Shared by all of the downloads, so the days of a backfill use the same categories
+        self.categories = CategoryDictionary(REPORT_CATEGORIES)
+
+        # The tables are only checked once there are days to load, so runs with nothing to do stay quick
+        self.engine = get_engine(conn_str)
+        self.storage = NormalizedStorage(self.engine)
+
+    @property
+    def rs_cls(self) -> RideSystemsInterface:
+        """Ridesystems session of the main thread. It logs in the first time it is used"""
+        with self._rs_lock:
+            if self._rs_session is None:
+                self._rs_session = self._login()
+            return self._rs_session
+
+    @cached_property
+    def ledger(self) -> Ledger:
+        """Ledger of the days that were loaded"""
+        return Ledger(self.engine, 'ridesystems')
+
+    @cached_property
+    def row_hashes(self) -> RowHashes:
+        """Hashes of the rows of the days that were loaded"""
+        return RowHashes(self.engine, 'ridesystems')
 
     def get_otp(self, start_date: date, end_date: date, force: bool = False, **kwargs) -> None:
         """
@@ -41,31 +142,18 @@ class RidesystemReports:
 
         :param start_date: First date (inclusive) to write to the database
         :param end_date: Last date (inclusive) to write to the database
-        :param force: Regenerate the data for the date range. By default, it skips dates with existing data.
+        :param force: Regenerate the data for the date range. By default, it skips dates with existing data. Forced
+        days only write the rows that changed since they were last loaded, unless the day's row count in the database
+        no longer matches, in which case every row is written to repair the rows that were deleted
         :param kwargs: passed directly to ridesystems.get_otp
         """
         logger.info("Processing on time%: {} to {}", start_date.strftime('%m/%d/%y'), end_date.strftime('%m/%d/%y'))
 
         dates_to_process = self.get_dates_to_process(start_date, end_date, CirculatorArrival.date, force)
-
-        for search_date in dates_to_process:
-            logger.info('Processing {}', search_date)
-            for _, row in self.rs_cls.get_otp(search_date, search_date, **kwargs).iterrows():
-                actualarrivaltime = row['actualarrivaltime'] if row['actualarrivaltime'] is not pd.NaT else None
-                actualdeparturetime = row['actualdeparturetime'] if row['actualdeparturetime'] is not pd.NaT else None
-                vehicle = row['vehicle'] if not pd.isnull(row['vehicle']) else None
-
-                insert_or_update(CirculatorArrival(
-                    date=row['date'],
-                    route=row['route'],
-                    stop=row['stop'],
-                    block_id=row['blockid'],
-                    scheduled_arrival_time=row['scheduledarrivaltime'],
-                    actual_arrival_time=actualarrivaltime,
-                    scheduled_departure_time=row['scheduleddeparturetime'],
-                    actual_departure_time=actualdeparturetime,
-                    on_time_status=row['ontimestatus'],
-                    vehicle=vehicle), self.engine)
+        loaded = self._load(OTP_REPORT, dates_to_process, force=force, **kwargs)
+        # Only the days that were just loaded can have changed
+        with metrics.stage('ccc_otp_daily.rollup') as stage:
+            stage.rows = refresh_otp_rollups(self.engine, loaded)
 
     def get_vehicle_assignments(self, start_date: date, end_date: date, force: bool = False) -> None:
         """
@@ -73,19 +161,13 @@ class RidesystemReports:
 
         :param start_date: First date (inclusive) to write to the database
         :param end_date: Last date (inclusive) to write to the database
-        :param force: Regenerate the data for the date range. By default, it skips dates with existing data.
+        :param force: Regenerate the data for the date range. By default, it skips dates with existing data. Forced
+        days only write the rows that changed since they were last loaded, unless the day's row count in the database
+        no longer matches, in which case every row is written to repair the rows that were deleted
         """
         logger.info("Processing bus arrivals: {} to {}", start_date.strftime('%m/%d/%y'), end_date.strftime('%m/%d/%y'))
         dates_to_process = self.get_dates_to_process(start_date, end_date, CirculatorBusRuntimes.starttime, force)
-        for search_date in dates_to_process:
-            logger.info('Processing {}', search_date)
-            for _, row in self.rs_cls.get_runtimes(search_date, search_date).iterrows():
-                insert_or_update(CirculatorBusRuntimes(
-                    busid=row['vehicle'],
-                    route=row['route'],
-                    starttime=row['start_time'],
-                    endtime=row['end_time']
-                ), self.engine)
+        self._load(RUNTIME_REPORT, dates_to_process, force=force)
 
     def get_ridership(self, start_date: date, end_date: date, force: bool = False) -> None:
         """
@@ -93,45 +175,282 @@ class RidesystemReports:
 
         :param start_date: First date (inclusive) to write to the database
         :param end_date: Last date (inclusive) to write to the database
-        :param force: Regenerate the data for the date range. By default, it skips dates with existing data.
+        :param force: Regenerate the data for the date range. By default, it skips dates with existing data. Forced
+        days only write the rows that changed since they were last loaded, unless the day's row count in the database
+        no longer matches, in which case every row is written to repair the rows that were deleted
         """
         logger.info("Processing ridership: {} to {}", start_date.strftime('%m/%d/%y'), end_date.strftime('%m/%d/%y'))
         dates_to_process = self.get_dates_to_process(start_date, end_date, CirculatorRidership.datetime, force)
-        for search_date in dates_to_process:
-            logger.info('Processing {}', search_date)
-            for _, row in self.rs_cls.get_ridership(search_date, search_date).iterrows():
-                insert_or_update(CirculatorRidership(
-                    vehicle=row['vehicle'],
-                    route=row['route'],
-                    stop=row['stop'],
-                    latitude=row['latitude'],
-                    longitude=row['longitude'],
-                    datetime=row['datetime'],
-                    boardings=row['entries'],
-                    alightings=row['exits'],
-                ), self.engine)
+        loaded = self._load(RIDERSHIP_REPORT, dates_to_process, force=force)
+        with metrics.stage('ccc_ridership_hourly.rollup') as stage:
+            stage.rows = refresh_ridership_rollups(self.engine, loaded)
+
+    def _load(self, report: ReportSpec, dates: List[date], force: bool = False, **kwargs) -> List[date]:
+        """
+        Downloads a report for the dates and writes it to the database. Consecutive dates are requested together, in
+        ranges of up to self.max_span days. Downloads run on self.workers threads, while the writes all happen on the
+        calling thread
+
+        :param report: The report to download
+        :param dates: Dates to download
+        :param force: Check each day's row count in the database before trusting the hashes of its last load
+        :param kwargs: passed directly to the RideSystemsInterface method
+        :return: The days that were written
+        """
+        table_name = report.model.__tablename__
+        if dates:
+            self._create_tables()
+        loaded = []
+        for date_range, df in self._fetch(report, get_date_ranges(dates, self.max_span), **kwargs):
+            for search_date, day_df in split_days(df, report.date_column, date_range):
+                logger.info('Processing {}', search_date)
+                with metrics.stage(f'{table_name}.transform') as stage:
+                    records = frame_to_records(day_df, report.model, report.columns)
+                    stage.rows = len(records)
+                if not date_range[0] <= search_date <= date_range[1]:
+                    # Only days that were requested in full are recorded in the ledger
+                    self._write(report.model, records)
+                    loaded.append(search_date)
+                    continue
+
+                with self.ledger.track(table_name, search_date.isoformat()) as entry:
+                    if self.mode == REPLACE:
+                        entry.rows = self._replace_day(report, search_date, records)
+                    else:
+                        entry.rows = self._merge_day(report, search_date, records, force)
+                if entry.rows or self.mode == REPLACE:
+                    # A day without new or changed rows doesn't need its rollups refreshed
+                    loaded.append(search_date)
+
+        if self.cache is not None:
+            self.cache.evict()
+        return loaded
+
+    def _fetch(self, report: ReportSpec, date_ranges: List[DateRange],
+               **kwargs) -> Iterator[Tuple[DateRange, pd.DataFrame]]:
+        """
+        Generator that downloads a report for each of the date ranges. With more than one worker, the reports are
+        yielded in the order they finish. Up to 2 * self.workers finished reports can be held in memory waiting for the
+        writer: self.workers in the queue, and one more in each worker that is blocked handing its report over
+
+        :param report: The report to download
+        :param date_ranges: First and last date (inclusive) of each report to download
+        :param kwargs: passed directly to the RideSystemsInterface method
+        """
+        if self.workers == 1 or len(date_ranges) < 2:
+            for date_range in date_ranges:
+                yield date_range, self._fetch_range(report, date_range, **kwargs)
+            return
+
+        results: queue.Queue = queue.Queue(maxsize=self.workers)
+        stop = threading.Event()
+
+        def _worker(date_range: DateRange) -> None:
+            try:
+                ret: Tuple[DateRange, Union[pd.DataFrame, Exception]] = \
+                    (date_range, self._fetch_range(report, date_range, **kwargs))
+            except Exception as err:  # pylint:disable=broad-except
+                ret = (date_range, err)
+
+            # The queue is bounded, so this blocks until the writer catches up, or gives up if the writer has stopped
+            while not stop.is_set():
+                try:
+                    results.put(ret, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ridesystems')
+        try:
+            for date_range in date_ranges:
+                executor.submit(_worker, date_range)
+
+            for _ in date_ranges:
+                date_range, df = results.get()
+                if isinstance(df, Exception):
+                    raise df
+                yield date_range, df
+        finally:
+            stop.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _fetch_range(self, report: ReportSpec, date_range: DateRange, **kwargs) -> pd.DataFrame:
+        """
+        Gets a report for a range of days, from the cache if every day is in it and otherwise from Ridesystems
+
+        :param report: The report to download
+        :param date_range: First and last date (inclusive) to download
+        :param kwargs: passed directly to the RideSystemsInterface method
+        """
+        if self.cache is None:
+            return self._download(report, date_range, **kwargs)
+
+        days = [date_range[0] + timedelta(days=i) for i in range((date_range[1] - date_range[0]).days + 1)]
+        cached = [self.cache.get(report.method, day, kwargs) for day in days]
+        if all(df is not None for df in cached):
+            logger.info('Using the cached {} for {} to {}', report.method, *date_range)
+            metrics.count(f'{report.model.__tablename__}.cache_hits', len(days))
+            return self.categories.concat(cached)
+
+        df = self._download(report, date_range, **kwargs)
+        for search_date, day_df in split_days(df, report.date_column, date_range):
+            if date_range[0] <= search_date <= date_range[1]:
+                self.cache.put(report.method, search_date, day_df, kwargs)
+        return df
+
+    def _download(self, report: ReportSpec, date_range: DateRange, **kwargs) -> pd.DataFrame:
+        """
+        Downloads a report for a range of days from Ridesystems, retrying if the download fails
+
+        :param report: The report to download
+        :param date_range: First and last date (inclusive) to download
+        :param kwargs: passed directly to the RideSystemsInterface method
+        """
+        table_name = report.model.__tablename__
+        for attempt in Retrying(wait=wait_random_exponential(multiplier=1, max=60), stop=stop_after_attempt(3),
+                                before_sleep=lambda _: metrics.count(f'{table_name}.retries'), reraise=True):
+            with attempt:
+                self._rate_limiter.wait()
+                with metrics.stage(f'{table_name}.fetch') as stage:
+                    with self._session() as client:
+                        df = getattr(client, report.method)(*date_range, **kwargs)
+                    stage.rows = len(df)
+                return self.categories.compact(df)
+        raise AssertionError('Unreachable')  # pragma: no cover
+
+    @contextmanager
+    def _session(self) -> Iterator[RideSystemsInterface]:
+        """
+        Checks out a Ridesystems session. The mechanize browser in RideSystemsInterface is not thread safe, so each
+        worker thread uses a session of its own. The sessions are returned to a pool that outlives the worker threads,
+        so later downloads and later loads reuse the logins. A session that raised is dropped, in case it is broken
+        """
+        if self.workers == 1 or threading.current_thread() is threading.main_thread():
+            yield self.rs_cls
+            return
+
+        try:
+            client = self._rs_pool.get_nowait()
+        except queue.Empty:
+            client = self._login()
+        yield client
+        self._rs_pool.put(client)
+
+    def _create_tables(self) -> None:
+        """
+        Creates the missing tables, once there are days to load. It has to happen before the first write, since sqlite
+        can't check the schema from another connection while a write is in progress
+        """
+        ensure_schema(self.engine, Base.metadata)
+        ensure_schema(self.engine, RowHashBase.metadata)
+
+    def _login(self) -> RideSystemsInterface:
+        """Starts a Ridesystems session, with the credentials from creds.py unless others were passed in"""
+        rs_user, rs_pass = self._rs_creds
+        if rs_user is None or rs_pass is None:
+            # pylint:disable=import-outside-toplevel
+            from .creds import RIDESYSTEMS_USERNAME, RIDESYSTEMS_PASSWORD
+            rs_user = RIDESYSTEMS_USERNAME if rs_user is None else rs_user
+            rs_pass = RIDESYSTEMS_PASSWORD if rs_pass is None else rs_pass
+        return _rs_interface()(rs_user, rs_pass)
+
+    def _write(self, model: DeclarativeMeta, rows: List[Record], bind: Optional[Connection] = None) -> int:
+        """
+        Upserts a batch of rows from one report into the database
+
+        :param model: Table class that the rows belong to
+        :param rows: The rows to insert or update
+        :param bind: Connection with an open transaction to write in. By default, the write gets its own transaction
+        :return: Number of rows written
+        """
+        with metrics.stage(f'{model.__tablename__}.write') as stage:
+            target, rows = self.storage.prepare(model, rows)
+            result = bulk_merge(target, rows, bind if bind is not None else self.engine)
+            stage.rows = result.inserted + result.updated
+        logger.info('{}: {} rows inserted, {} rows updated', model.__tablename__, result.inserted, result.updated)
+        return result.inserted + result.updated
+
+    def _merge_day(self, report: ReportSpec, day: date, rows: List[Record], force: bool = False) -> int:
+        """
+        Upserts the rows of one day of a report that are new or changed since the day was last loaded
+
+        :param report: The report the rows are from
+        :param day: The day the rows are for
+        :param rows: All of the rows for the day
+        :param force: Check the stored hashes against the table first. They only describe what was written, so if the
+        day doesn't have as many rows in the table as there are hashes, all of the rows are written
+        :return: Number of rows written
+        """
+        table_name = report.model.__tablename__
+        stale = False
+        if force:
+            table_rows, hashed_rows = self._count_day(report, day), self.row_hashes.count(table_name, day.isoformat())
+            if table_rows != hashed_rows:
+                logger.warning('{} has {} rows for {}, but {} stored hashes. Writing every row', table_name,
+                               table_rows, day, hashed_rows)
+                stale = True
+        changed, _, update = self.row_hashes.diff(report.model, table_name, day.isoformat(), rows, stale)
+        with self.engine.begin() as connection:
+            written = self._write(report.model, changed, connection)
+            self.row_hashes.save(table_name, day.isoformat(), update, connection)
+        return written
+
+    def _count_day(self, report: ReportSpec, day: date) -> int:
+        """
+        Counts the rows that one day of a report has in the database
+
+        :param report: The report to count
+        :param day: The day to count
+        """
+        table = report.model.__table__
+        with self.engine.connect() as connection:
+            return connection.execute(select(func.count()).select_from(table).where(
+                date_condition(table.c[report.columns.get(report.date_column, report.date_column)], day, day))).scalar()
+
+    def _replace_day(self, report: ReportSpec, day: date, rows: List[Record]) -> int:
+        """
+        Replaces one day of a report in the database with the rows that were just downloaded
+
+        :param report: The report the rows are from
+        :param day: The day to replace
+        :param rows: All of the rows for the day
+        :return: Number of rows written
+        """
+        target, facts = self.storage.prepare(report.model, rows)
+        column = target.__table__.c[report.columns.get(report.date_column, report.date_column)]
+
+        table_name = report.model.__tablename__
+        # Every row is written, so the hashes of all of them are saved
+        _, _, update = self.row_hashes.diff(report.model, table_name, day.isoformat(), rows, write_all=True)
+        with metrics.stage(f'{table_name}.write') as stage, self.engine.begin() as connection:
+            result = bulk_replace(target, facts, connection, date_condition(column, day, day))
+            # Keeps the hashes in step, so a later merge of the day only writes what changed after this
+            self.row_hashes.save(table_name, day.isoformat(), update, connection)
+            stage.rows = result.inserted
+        logger.info('{}: replaced {} rows with {} rows for {}', table_name, result.deleted,
+                    result.inserted, day)
+        return result.inserted
 
     def get_dates_to_process(self, start_date: date, end_date: date, column: sqlalchemy.column,
                              force: bool = False) -> list:
         """
+        Finds the dates in the range that still need to be loaded. A date is skipped if the ledger says it was
+        loaded, or if column already has data for it and the ledger doesn't know of a failed or unfinished load
 
         :param start_date: First date (inclusive) to write to the database
         :param end_date: Last date (inclusive) to write to the database
         :param column: sqlalchemy date column to search for matching dates to skip
         :param force: Regenerate the data for the date range. By default, it skips dates with existing data.
         """
-        def _convert_to_date(dte: Union[date, datetime]):
-            if isinstance(dte, datetime):
-                try:
-                    return dte.date()
-                except AttributeError:
-                    pass
-            if isinstance(dte, date):
-                return dte
-            raise AssertionError(f'Unknown type of date: {dte}')
         with Session(bind=self.engine, future=True) as session:
-            if not force:
-                existing_dates = set(_convert_to_date(i[0]) for i in session.query(column).all())
+            # Nothing was loaded yet if the table doesn't exist, and it is created once the first day is loaded
+            if not force and inspect(self.engine).has_table(column.table.name):
+                existing_dates = set(session.execute(
+                    select(_AsDate(column)).where(date_condition(column, start_date, end_date)).distinct()).scalars())
+
+                statuses = self.ledger.statuses(column.table.name, start_date.isoformat(), end_date.isoformat())
+                existing_dates = {i for i in existing_dates if statuses.get(i.isoformat(), DONE) == DONE} | \
+                                 {date.fromisoformat(unit) for unit, status in statuses.items() if status == DONE}
             else:
                 existing_dates = set()
 
@@ -142,6 +461,110 @@ class RidesystemReports:
             return dates_to_process
 
 
+def get_date_ranges(dates: List[date], max_span: int) -> List[DateRange]:
+    """
+    Collapses dates into ranges of consecutive days, with no range longer than max_span days
+
+    :param dates: Dates to collapse, in any order
+    :param max_span: Maximum number of days in a range
+    :return: List of (first date, last date) tuples, both inclusive, with the most recent range first
+    """
+    ranges: List[DateRange] = []
+    for search_date in sorted(set(dates)):
+        if ranges and search_date - ranges[-1][1] == timedelta(days=1) and \
+                (search_date - ranges[-1][0]).days < max_span:
+            ranges[-1] = (ranges[-1][0], search_date)
+        else:
+            ranges.append((search_date, search_date))
+    ranges.reverse()
+    return ranges
+
+
+def date_condition(column: Column, start_date: date, end_date: date) -> ColumnElement:
+    """
+    Condition that selects the rows of a range of days. The range is half open so that it can use the index on column
+    when column is a datetime
+
+    :param column: sqlalchemy date or datetime column
+    :param start_date: First date (inclusive)
+    :param end_date: Last date (inclusive)
+    """
+    lower: Union[date, datetime] = start_date
+    upper: Union[date, datetime] = end_date + timedelta(days=1)
+    if isinstance(column.type, DateTime):
+        lower = datetime.combine(lower, time())
+        upper = datetime.combine(upper, time())
+    return and_(column >= lower, column < upper)
+
+
+def split_days(df: pd.DataFrame, date_column: str, date_range: DateRange) -> Iterator[Tuple[date, pd.DataFrame]]:
+    """
+    Splits a multi day report into one DataFrame per day. Every day in date_range is yielded, even if the report had
+    no rows for it, as are any days outside of the range that the report returned anyway
+
+    :param df: The report to split
+    :param date_column: Column of df with the date or datetime of each row
+    :param date_range: First and last date (inclusive) that were requested
+    """
+    days = pd.to_datetime(df[date_column]).dt.date if not df.empty else pd.Series(dtype=object)
+    requested = [date_range[0] + timedelta(days=i) for i in range((date_range[1] - date_range[0]).days + 1)]
+    for search_date in sorted(set(requested) | set(days.dropna()), reverse=True):
+        yield search_date, df[(days == search_date).to_numpy()] if not df.empty else df
+
+
+class _AsDate(FunctionElement):  # pylint:disable=too-many-ancestors
+    """Truncates a date or datetime column to its date"""
+    type = Date()
+    name = 'as_date'
+    inherit_cache = True
+
+
+@compiles(_AsDate)
+def _compile_as_date(element, compiler, **kwargs):
+    return f'CAST({compiler.process(element.clauses, **kwargs)} AS DATE)'
+
+
+@compiles(_AsDate, 'sqlite')
+def _compile_as_date_sqlite(element, compiler, **kwargs):
+    # Sqlite has no date type, so a CAST would turn '2022-03-01 10:00:00' into 2022
+    return f'DATE({compiler.process(element.clauses, **kwargs)})'
+
+
+class _RateLimiter:  # pylint:disable=too-few-public-methods
+    """Spaces out requests that are shared between threads"""
+
+    def __init__(self, interval: float):
+        """
+        :param interval: Minimum number of seconds between calls to wait() returning
+        """
+        self.interval = interval
+        self._next_request = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Blocks until the next request is allowed"""
+        if self.interval <= 0:
+            return
+        with self._lock:
+            now = monotonic()
+            delay = self._next_request - now
+            self._next_request = max(now, self._next_request) + self.interval
+        if delay > 0:
+            sleep(delay)
+
+
+def __getattr__(name: str):
+    # ridesystems brings in requests and mechanize, so it isn't imported until the first login
+    if name == 'RideSystemsInterface':
+        return importlib.import_module('ridesystems.reports').Reports
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def _rs_interface() -> type:
+    """RideSystemsInterface, which can be patched before it is imported"""
+    return globals().get('RideSystemsInterface') or __getattr__('RideSystemsInterface')
+
+
 def parse_args(args):
     """Handles argument parsing"""
     parser = setup_parser()
@@ -169,14 +592,35 @@ def parse_args(args):
                                  help='By default, it skips dates that already have data. This flag regenerates the '
                                       'date range.')
 
-    parser_runtimes = subparsers.add_parser('ridership', help='Pulls the ridership report from RideSystems')
-    parser_runtimes.add_argument('-s', '--startdate', type=date.fromisoformat, default=start_date,
-                                 help='First date to process, inclusive (format YYYY-MM-DD).')
-    parser_runtimes.add_argument('-e', '--enddate', type=date.fromisoformat, default=end_date,
-                                 help='Last date to process, inclusive (format YYYY-MM-DD).')
-    parser_runtimes.add_argument('-f', '--force', action='store_true',
-                                 help='By default, it skips dates that already have data. This flag regenerates the '
-                                      'date range.')
+    parser_ridership = subparsers.add_parser('ridership', help='Pulls the ridership report from RideSystems')
+    parser_ridership.add_argument('-s', '--startdate', type=date.fromisoformat, default=start_date,
+                                  help='First date to process, inclusive (format YYYY-MM-DD).')
+    parser_ridership.add_argument('-e', '--enddate', type=date.fromisoformat, default=end_date,
+                                  help='Last date to process, inclusive (format YYYY-MM-DD).')
+    parser_ridership.add_argument('-f', '--force', action='store_true',
+                                  help='By default, it skips dates that already have data. This flag regenerates the '
+                                       'date range.')
+
+    for subparser in (parser_otp, parser_runtimes, parser_ridership):
+        subparser.add_argument('--max_span', type=int, default=7,
+                               help='Maximum number of consecutive days to request from Ridesystems at once.')
+        subparser.add_argument('-w', '--workers', type=int, default=1,
+                               help='Number of days to download from Ridesystems at the same time.')
+        subparser.add_argument('--request_interval', type=float, default=1.0,
+                               help='Minimum number of seconds between Ridesystems requests when using more than one '
+                                    'worker.')
+        subparser.add_argument('--mode', choices=[MERGE, REPLACE], default=MERGE,
+                               help='merge upserts the downloaded rows. replace deletes each downloaded day and '
+                                    'inserts it again in one transaction, which also removes rows that Ridesystems no '
+                                    'longer has. Use replace with --force to reload days.')
+        subparser.add_argument('--cache_dir',
+                               help='Directory to cache the downloaded reports in, so they are only downloaded once.')
+        subparser.add_argument('--cache_max_age', type=float,
+                               help='Number of days to keep cached reports. By default, they are kept forever.')
+        subparser.add_argument('--cache_max_size', type=float,
+                               help='Maximum size of the cache in megabytes. By default, it is unlimited.')
+        subparser.add_argument('--cache_recent_days', type=int, default=RECENT_DAYS,
+                               help='Reports from the last number of days can still change, so they are not cached.')
 
     return parser.parse_args(args)
 
@@ -184,7 +628,18 @@ def parse_args(args):
 if __name__ == '__main__':
     parsed_args = parse_args(sys.argv[1:])
     setup_logging(parsed_args.debug, parsed_args.verbose)
-    rs = RidesystemReports(parsed_args.conn_str)
+    setup_reporting(parsed_args, f'ridesystems_{parsed_args.subparser_name}')
+    report_cache = None
+    if parsed_args.cache_dir:
+        report_cache = ReportCache(
+            Path(parsed_args.cache_dir),
+            max_age=timedelta(days=parsed_args.cache_max_age) if parsed_args.cache_max_age else None,
+            max_size=int(parsed_args.cache_max_size * 1024 * 1024) if parsed_args.cache_max_size else None,
+            recent_days=parsed_args.cache_recent_days)
+    rs = RidesystemReports(parsed_args.conn_str, workers=parsed_args.workers,
+                           request_interval=parsed_args.request_interval if parsed_args.workers > 1 else 0.0,
+                           max_span=parsed_args.max_span, cache=report_cache,
+                           mode=parsed_args.mode)
 
     # On time percentage
     if parsed_args.subparser_name == 'otp':
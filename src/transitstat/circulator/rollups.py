@@ -0,0 +1,189 @@
+"""Rollups of the Ridesystems reports, so dashboards can read a few rows per stop and day (or hour) instead of scanning
+the raw tables. They are rebuilt for the days that RidesystemReports loads"""
+from __future__ import annotations
+
+from datetime import date, datetime, time, timedelta
+from typing import Iterable, List, Optional, Sequence, Tuple, TYPE_CHECKING, Union
+
+from loguru import logger
+from sqlalchemy import and_, delete, engine as engine_type, func, or_, select  # type: ignore
+from sqlalchemy.engine import Connection  # type: ignore
+
+from .schema import CirculatorArrival, CirculatorOtpDaily, CirculatorOtpDailyStatus, CirculatorRidership, \
+    CirculatorRidershipHourly
+from .._merge import bulk_merge
+from .._lazy import LazyModule
+
+if TYPE_CHECKING:
+    import pandas as pd  # type: ignore
+else:
+    pd = LazyModule('pandas')
+
+ROLLUP_KEYS = ['date', 'route', 'stop', 'block_id']
+# Number of days to read from ccc_arrival_times at once
+DAYS_PER_QUERY = 31
+HALF_DAY = 12 * 60 * 60
+
+
+def refresh_otp_rollups(bind: Union[engine_type.Engine, Connection], dates: Iterable[date]) -> int:
+    """
+    Recomputes the daily on time rollups for the dates. The rollup rows for each date are replaced, so stops or
+    statuses that are no longer in ccc_arrival_times are removed
+
+    :param bind: Engine or connection to use. An engine gets its own transaction
+    :param dates: Days to recompute
+    :return: Number of ccc_otp_daily rows written
+    """
+    if not isinstance(bind, Connection):
+        with bind.begin() as connection:
+            return refresh_otp_rollups(connection, dates)
+
+    dates = sorted(set(dates))
+    rows = 0
+    for i in range(0, len(dates), DAYS_PER_QUERY):
+        chunk = dates[i:i + DAYS_PER_QUERY]
+        arrivals = pd.read_sql(select(CirculatorArrival).where(CirculatorArrival.date.in_(chunk)), bind)
+        daily, daily_status = otp_rollups(arrivals)
+
+        for model in (CirculatorOtpDaily, CirculatorOtpDailyStatus):
+            bind.execute(delete(model.__table__).where(model.__table__.c.date.in_(chunk)))
+        bulk_merge(CirculatorOtpDaily, daily, bind)
+        bulk_merge(CirculatorOtpDailyStatus, daily_status, bind)
+        rows += len(daily)
+
+    logger.info('Refreshed the on time rollups of {} days: {} rows', len(dates), rows)
+    return rows
+
+
+def otp_rollups(arrivals: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Aggregates arrivals by date, route, stop and block
+
+    :param arrivals: Rows of ccc_arrival_times
+    :return: Tuple of DataFrames for ccc_otp_daily and ccc_otp_daily_status
+    """
+    # The stop is part of the rollup key, which can't be null
+    arrivals = arrivals.assign(stop=arrivals['stop'].fillna(''), lateness=lateness(arrivals))
+
+    grouped = arrivals.groupby(ROLLUP_KEYS)['lateness']
+    daily = pd.DataFrame({'arrivals': grouped.size(),
+                          'lateness_mean': grouped.mean(),
+                          'lateness_median': grouped.median(),
+                          'lateness_p90': grouped.quantile(0.9)}).reset_index()
+
+    daily_status = arrivals.dropna(subset=['on_time_status']) \
+        .groupby(ROLLUP_KEYS + ['on_time_status']).size().rename('arrivals').reset_index()
+    return daily, daily_status
+
+
+def lateness(arrivals: pd.DataFrame) -> pd.Series:
+    """
+    Seconds between the scheduled and actual arrival times. Both are times of day, so differences of more than half a
+    day are taken to cross midnight
+
+    :param arrivals: Rows of ccc_arrival_times
+    :return: Lateness in seconds, or NaN when either time is missing
+    """
+    def _seconds(times: pd.Series) -> pd.Series:
+        return pd.to_timedelta(times.astype('string'), errors='coerce').dt.total_seconds()
+
+    diff = _seconds(arrivals['actual_arrival_time']) - _seconds(arrivals['scheduled_arrival_time'])
+    diff[diff > HALF_DAY] -= 2 * HALF_DAY
+    diff[diff < -HALF_DAY] += 2 * HALF_DAY
+    return diff
+
+
+def refresh_ridership_rollups(bind: Union[engine_type.Engine, Connection], dates: Iterable[date]) -> int:
+    """
+    Recomputes the hourly ridership rollup for the dates, replacing the rollup rows of each date
+
+    :param bind: Engine or connection to use. An engine gets its own transaction
+    :param dates: Days to recompute
+    :return: Number of ccc_ridership_hourly rows written
+    """
+    if not isinstance(bind, Connection):
+        with bind.begin() as connection:
+            return refresh_ridership_rollups(connection, dates)
+
+    dates = sorted(set(dates))
+    rows = 0
+    table = CirculatorRidershipHourly.__table__
+    for i in range(0, len(dates), DAYS_PER_QUERY):
+        chunk = dates[i:i + DAYS_PER_QUERY]
+        # A range on datetime can use its index, so each run of consecutive days is read with one range, and the days
+        # in between that weren't loaded aren't read at all
+        events = pd.read_sql(select(CirculatorRidership.route, CirculatorRidership.stop, CirculatorRidership.datetime,
+                                    CirculatorRidership.boardings, CirculatorRidership.alightings)
+                             .where(or_(*[and_(CirculatorRidership.datetime >= datetime.combine(first, time()),
+                                               CirculatorRidership.datetime < datetime.combine(last + timedelta(days=1),
+                                                                                               time()))
+                                          for first, last in day_runs(chunk)])), bind)
+        hourly = ridership_rollup(events)
+
+        bind.execute(delete(table).where(table.c.date.in_(chunk)))
+        bulk_merge(CirculatorRidershipHourly, hourly, bind)
+        rows += len(hourly)
+
+    logger.info('Refreshed the hourly ridership rollup of {} days: {} rows', len(dates), rows)
+    return rows
+
+
+def day_runs(dates: Sequence[date]) -> List[Tuple[date, date]]:
+    """
+    Collapses sorted dates into runs of consecutive days
+
+    :param dates: Sorted dates without duplicates
+    :return: List of (first date, last date) tuples, both inclusive
+    """
+    runs: List[Tuple[date, date]] = []
+    for day in dates:
+        if runs and day - runs[-1][1] == timedelta(days=1):
+            runs[-1] = (runs[-1][0], day)
+        else:
+            runs.append((day, day))
+    return runs
+
+
+def ridership_rollup(events: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds up the boardings and alightings by date, hour, route and stop
+
+    :param events: Rows of ccc_ridership
+    :return: DataFrame for ccc_ridership_hourly
+    """
+    timestamps = pd.to_datetime(events['datetime'])
+    return events.assign(date=timestamps.dt.date, hour=timestamps.dt.hour) \
+        .groupby(['date', 'hour', 'route', 'stop'])[['boardings', 'alightings']].sum(min_count=1).reset_index()
+
+
+def query_ridership(bind: Union[engine_type.Engine, Connection], start_date: date, end_date: date,  # pylint:disable=too-many-arguments
+                    group_by: Sequence[str] = ('date', 'route'), *, routes: Optional[Sequence[str]] = None,
+                    stops: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    """
+    Total boardings and alightings from the hourly rollup. Use ccc_ridership directly only to look at the individual
+    events
+
+    :param bind: Engine or connection to use
+    :param start_date: First date (inclusive) to include
+    :param end_date: Last date (inclusive) to include
+    :param group_by: Columns of ccc_ridership_hourly to total by: any of date, hour, route and stop
+    :param routes: If set, only include these routes
+    :param stops: If set, only include these stops
+    :return: DataFrame with the group_by columns, boardings and alightings
+    """
+    table = CirculatorRidershipHourly.__table__
+    keys = [table.c[column] for column in group_by]
+    qry = select(*keys, func.sum(table.c.boardings).label('boardings'),
+                 func.sum(table.c.alightings).label('alightings')) \
+        .where(table.c.date >= start_date, table.c.date <= end_date) \
+        .group_by(*keys) \
+        .order_by(*keys)
+    if routes is not None:
+        qry = qry.where(table.c.route.in_(routes))
+    if stops is not None:
+        qry = qry.where(table.c.stop.in_(stops))
+
+    if isinstance(bind, Connection):
+        return pd.read_sql(qry, bind)
+    with bind.connect() as connection:
+        return pd.read_sql(qry, connection)
@@ -3,10 +3,14 @@
 from sqlalchemy import Column  # type: ignore
 from sqlalchemy.ext.declarative import DeclarativeMeta  # type: ignore
 from sqlalchemy.orm import declarative_base  # type: ignore
-from sqlalchemy.types import Date, DateTime, Integer, Numeric, String, Time  # type: ignore
+from sqlalchemy.types import Date, DateTime, Float, Integer, Numeric, String, Time  # type: ignore
 
 Base: DeclarativeMeta = declarative_base()
 
+# Length of the stop names of the on time report. The stop is part of the key of the on time rollups, so it needs a
+# length that Sql Server can index. dim_stop allows the same length
+STOP_LENGTH = 255
+
 
 class CirculatorRidershipXLS(Base):
     """Table holding the ridership by vehicle, route and date"""
@@ -24,7 +28,7 @@ class CirculatorArrival(Base):
 
     date = Column(Date, primary_key=True)
     route = Column(String(length=50), primary_key=True)
-    stop = Column(String)
+    stop = Column(String(length=STOP_LENGTH))
     block_id = Column(String(length=100), primary_key=True)
     scheduled_arrival_time = Column(Time, primary_key=True)
     actual_arrival_time = Column(Time)
@@ -34,13 +38,52 @@ class CirculatorArrival(Base):
     vehicle = Column(String(length=20))
 
 
+class CirculatorOtpDaily(Base):
+    """Daily rollup of ccc_arrival_times with the lateness of the arrivals at each stop. Lateness is in seconds, and
+    negative when the bus was early"""
+    __tablename__ = 'ccc_otp_daily'
+
+    date = Column(Date, primary_key=True)
+    route = Column(String(length=50), primary_key=True)
+    stop = Column(String(length=STOP_LENGTH), primary_key=True)
+    block_id = Column(String(length=100), primary_key=True)
+    arrivals = Column(Integer)
+    lateness_mean = Column(Float)
+    lateness_median = Column(Float)
+    lateness_p90 = Column(Float)
+
+
+class CirculatorOtpDailyStatus(Base):
+    """Daily rollup of ccc_arrival_times with the number of arrivals with each on time status"""
+    __tablename__ = 'ccc_otp_daily_status'
+
+    date = Column(Date, primary_key=True)
+    route = Column(String(length=50), primary_key=True)
+    stop = Column(String(length=STOP_LENGTH), primary_key=True)
+    block_id = Column(String(length=100), primary_key=True)
+    on_time_status = Column(String(length=10), primary_key=True)
+    arrivals = Column(Integer)
+
+
+class CirculatorRidershipHourly(Base):
+    """Hourly rollup of ccc_ridership by route and stop"""
+    __tablename__ = 'ccc_ridership_hourly'
+
+    date = Column(Date, primary_key=True)
+    hour = Column(Integer, primary_key=True)
+    route = Column(String(length=20), primary_key=True)
+    stop = Column(String(length=70), primary_key=True)
+    boardings = Column(Integer)
+    alightings = Column(Integer)
+
+
 class CirculatorBusRuntimes(Base):
     """Table holding the realtime runtimes of the circulator"""
     __tablename__ = 'ccc_bus_runtimes'
 
     busid = Column(String(length=10), primary_key=True)
     route = Column(String)
-    starttime = Column(DateTime, primary_key=True)
+    starttime = Column(DateTime, primary_key=True, index=True)
     endtime = Column(DateTime)
 
 
@@ -53,7 +96,7 @@ class CirculatorRidership(Base):
     stop = Column(String(length=70), primary_key=True)
     latitude = Column(Numeric(precision=9, scale=6))
     longitude = Column(Numeric(precision=9, scale=6))
-    datetime = Column(DateTime, primary_key=True)
+    datetime = Column(DateTime, primary_key=True, index=True)
     boardings = Column(Integer)
     alightings = Column(Integer)
 
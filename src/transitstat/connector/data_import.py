@@ -1,41 +1,83 @@
 """Read the Harbor Connector ridership from an excel spreadsheet and put it in the database"""
-import math
 import re
 import sys
 from collections import defaultdict
 from datetime import date
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import Dict, Iterable, Optional, Tuple, Union
 
-from loguru import logger
 import pandas as pd  # type: ignore
+from loguru import logger
 from dateutil import parser as date_parser
 from dateutil.parser import ParserError
-from sqlalchemy import create_engine  # type: ignore
 
-from transitstat.args import setup_logging, setup_parser
+from transitstat.args import setup_logging, setup_parser, setup_reporting
 from .schema import Base, HcRidership
-from .._merge import insert_or_update
+from .._merge import bulk_merge
+from .._pool import map_files
+from .._xlsx import iter_sheets
+from ..database import ensure_schema, get_engine
+from ..ledger import Ledger, file_hash
+from ..metrics import metrics
 
 RidershipDict = Dict[date, int]
 ParsedDataDict = Dict[int, RidershipDict]
 
+# Formats the text dates in the reports come in. Dates in any other format go through dateutil
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d', '%m/%d/%Y', '%m/%d/%Y %H:%M:%S')
+
 
 class ConnectorImport:
     """Imports ridership data from the Harbor Connector reports"""
-    def __init__(self, conn_str):
+    def __init__(self, conn_str, jobs: int = 1):
         """
         :param conn_str: Connection string passed to SqlAlchemy
+        :param jobs: Number of processes used to parse the reports in a directory
+        """
+        self.jobs = jobs
+        self.engine = get_engine(conn_str)
+        ensure_schema(self.engine, Base.metadata)
+
+        self.ledger = Ledger(self.engine, 'harbor_connector')
+
+    def import_path(self, path: Path) -> bool:
         """
-        self.engine = create_engine(conn_str, echo=True, future=True)
-        with self.engine.begin() as connection:
-            Base.metadata.create_all(connection)
+        Parses and inserts each Harbor Connector report in a file or directory. Reports that the ledger says were
+        already imported are skipped, and reports that can't be parsed are marked as failed in the ledger
+
+        :param path: Path of the file or directory to import
+        :return: True if every report was imported or skipped, False if any of them couldn't be parsed
+        """
+        logger.info('Processing {}', path)
+        units = {}
+        for hc_file in self._file_list(path):
+            unit = file_hash(hc_file)
+            if self.ledger.is_done(HcRidership.__tablename__, unit):
+                logger.info('Skipping {}. It was already imported', hc_file)
+            else:
+                units[hc_file] = unit
+
+        # Parsing happens on self.jobs processes, and the results are written here one report at a time
+        success = True
+        for hc_file, parsed, err in map_files(self._parse_sheets, units.keys(), self.jobs,
+                                              stage=f'{HcRidership.__tablename__}.parse'):
+            if err is not None or not parsed:
+                detail = f'{hc_file.name}: {err or "the file name does not have the route"}'
+                logger.error('Unable to import {}', detail)
+                self.ledger.fail(HcRidership.__tablename__, units[hc_file], detail)
+                success = False
+                continue
+
+            route_id, ridership = parsed
+            with self.ledger.track(HcRidership.__tablename__, units[hc_file], hc_file.name) as entry:
+                entry.rows = self.insert_into_db(ridership.assign(route_id=route_id))
+        return success
 
     def parse_sheets(self, path: Path) -> ParsedDataDict:
         """
         Parse the specified file or directory for all of the ridership data in each of its sheets, and return a
         dictionary of values with date (yyyy-mm-dd) -> total ridership. If a directory is provided, then all xlsx files
-        will be processed
+        will be processed. This is a dictionary view of parse_frames
 
         :param path: Path of the file or directory to parse
         :return ridership: (dict) The dates and ridership numbers of the Harbor Connector from parse_sheet()
@@ -43,76 +85,113 @@ class ConnectorImport:
          ...
         }
         """
-        logger.info('Processing {}', path)
         ret: ParsedDataDict = defaultdict(dict)
-        file_list = path.glob('HC* *.*.xlsx') if path.exists() else [path]
-
-        for hc_file in file_list:
-            parsed = self._parse_sheets(hc_file)
-            if parsed:
-                route_id, ridership = parsed
-                ridership.update(ret[route_id])
-                ret[route_id] = ridership
+        for row in self.parse_frames(path).itertuples(index=False):
+            ret[row.route_id][row.date] = row.riders
         return ret
 
+    def parse_frames(self, path: Path) -> pd.DataFrame:
+        """
+        Parse the specified file or directory for the total ridership by route and date. If a directory is provided,
+        then all xlsx files will be processed, and when two reports have the same route and date the first one wins
+
+        :param path: Path of the file or directory to parse
+        :return: DataFrame with the columns route_id, date and riders
+        """
+        logger.info('Processing {}', path)
+        hc_files = list(self._file_list(path))
+        results = {hc_file: parsed for hc_file, parsed, _ in
+                   map_files(self._parse_sheets, hc_files, self.jobs, stage=f'{HcRidership.__tablename__}.parse')}
+        # Merged in file order, so the result doesn't depend on which process finished first
+        frames = [ridership.assign(route_id=route_id)
+                  for route_id, ridership in filter(None, (results[hc_file] for hc_file in hc_files))]
+        if not frames:
+            return pd.DataFrame(columns=['route_id', 'date', 'riders'])
+        ridership = pd.concat(frames, ignore_index=True).drop_duplicates(['route_id', 'date'])
+        return ridership[['route_id', 'date', 'riders']]
+
     @staticmethod
-    def _parse_sheets(filename: Path) -> Optional[Tuple[int, Dict]]:
-        def _count_converter(val):
-            try:
-                val = int(val)
-            except ValueError:
-                return 0
+    def _file_list(path: Path) -> Iterable[Path]:
+        """The Harbor Connector reports in path, or path itself if it is a file"""
+        return sorted(path.glob('HC* *.*.xlsx')) if path.is_dir() else [path]
 
-            if math.isnan(val):
-                return 0
-            return val
+    @staticmethod
+    def _parse_sheets(filename: Path) -> Optional[Tuple[int, pd.DataFrame]]:
+        """
+        Adds up the boardings by date across the sheets of a report
 
+        :param filename: Report named like 'HC<route id> <month>.<year>.xlsx'
+        :return: Tuple of the route id and a DataFrame with the columns date and riders, or None if the file name
+            doesn't have the route
+        """
         filename_parse = re.search(r'HC(\d*) \d{1,2}.\d{4}.xlsx', str(filename))
         if not filename_parse:
             return None
 
         route_id: int = int(filename_parse.group(1))
-        sheets_dict = pd.read_excel(filename, sheet_name=None,
-                                    converters={'Count': _count_converter, 'Boardings': _count_converter},
-                                    dtype={'Date': str,
-                                           'Depart Location': str})
-        ridership: RidershipDict = {}
-
-        for _, sheet in sheets_dict.items():
-            for _, row in sheet.iterrows():
-                if isinstance(row['Date'], float) and math.isnan(row['Date']):
-                    break
-                try:
-                    created_on = row['Date']
-                    rider_date: date = date_parser.parse(created_on).date()
-                except ParserError as err:
-                    logger.error('Parse failure. {}', err)
-                    continue
-
-                if isinstance(row.get('Boardings'), str) and row.get('Boardings').isdigit():
-                    boarding = int(row.get('Boardings'))
-                elif isinstance(row.get('Boardings'), (int, float)) and not math.isnan(row.get('Boardings')):
-                    boarding = int(row.get('Boardings'))
-                else:
-                    boarding = 0
-                ridership[rider_date] = ridership.setdefault(rider_date, 0) + boarding
-
-        logger.info('Route id: {}, ridership: {}', route_id, ridership)
+        frames = []
+
+        # Sheets are read one at a time instead of loading the whole workbook
+        for _, sheet in iter_sheets(filename):
+            if 'Date' not in sheet.columns:
+                continue
+
+            # The trips end at the first row without a date; anything after that are notes or totals
+            sheet = sheet[sheet['Date'].isna().cumsum() == 0]
+            boardings = sheet['Boardings'] if 'Boardings' in sheet.columns else pd.Series(0, index=sheet.index)
+            frames.append(pd.DataFrame({'date': _parse_dates(sheet['Date']).dt.date,
+                                        'riders': pd.to_numeric(boardings, errors='coerce').fillna(0).astype(int)}))
+
+        if not frames:
+            ridership = pd.DataFrame({'date': pd.Series(dtype=object), 'riders': pd.Series(dtype=int)})
+        else:
+            ridership = pd.concat(frames).dropna(subset=['date']).groupby('date', as_index=False)['riders'].sum()
+        logger.info('Route id: {}, {} days with {} riders', route_id, len(ridership), ridership['riders'].sum())
         return route_id, ridership
 
-    def insert_into_db(self, parsed_data: ParsedDataDict) -> None:
+    def insert_into_db(self, parsed_data: Union[ParsedDataDict, pd.DataFrame]) -> int:
         """
-        Insert the ridership dictionary into the database
+        Insert the ridership into the database
 
-        :param parsed_data: The route, dates and ridership numbers of the Harbor Connector from parse_sheet()
-        :type parsed_data: dict
-        :return: None
+        :param parsed_data: The route, dates and ridership numbers of the Harbor Connector, either from parse_sheets()
+            or as a DataFrame from parse_frames()
+        :return: Number of rows written
         """
-        for route_id, ridership in parsed_data.items():
-            for _date, riders in ridership.items():
-                insert_or_update(HcRidership(route_id=route_id,
-                                             date=_date,
-                                             riders=riders), self.engine)
+        if not isinstance(parsed_data, pd.DataFrame):
+            parsed_data = pd.DataFrame([(route_id, _date, riders)
+                                        for route_id, ridership in parsed_data.items()
+                                        for _date, riders in ridership.items()],
+                                       columns=['route_id', 'date', 'riders'])
+        with metrics.stage(f'{HcRidership.__tablename__}.write') as stage:
+            result = bulk_merge(HcRidership, parsed_data, self.engine)
+            stage.rows = result.inserted + result.updated
+        logger.info('Harbor Connector ridership: {} rows inserted, {} rows updated', result.inserted, result.updated)
+        return result.inserted + result.updated
+
+
+def _parse_dates(dates: pd.Series) -> pd.Series:
+    """
+    Converts the Date column of a report. Text dates are parsed with each of DATE_FORMATS in turn, and only the ones
+    that match none of them go through dateutil. Dates that can't be parsed at all are logged and become NaT
+
+    :param dates: Date column, either already datetimes or text
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+
+    text = dates.astype(str)
+    parsed = pd.Series(pd.NaT, index=text.index, dtype='datetime64[ns]')
+    for date_format in DATE_FORMATS:
+        missing = parsed.isna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(text[missing], format=date_format, errors='coerce')
+    for i in parsed.index[parsed.isna()]:
+        try:
+            parsed[i] = date_parser.parse(text[i])
+        except ParserError as err:
+            logger.error('Parse failure. {}', err)
+    return parsed
 
 
 def parse_args(args):
@@ -121,6 +200,8 @@ def parse_args(args):
 
     parser.add_argument('-p', '--path',
                         help='File or directory to import. If directory is provided, then all files will be processed')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes to use to parse the files in a directory')
 
     return parser.parse_args(args)
 
@@ -128,5 +209,6 @@ def parse_args(args):
 if __name__ == '__main__':
     _args = parse_args(sys.argv[1:])
     setup_logging(_args.debug, _args.verbose)
-    clss = ConnectorImport(_args.conn_str)
-    clss.insert_into_db(clss.parse_sheets(Path(_args.path)))
+    setup_reporting(_args, 'harbor_connector')
+    clss = ConnectorImport(_args.conn_str, _args.jobs)
+    clss.import_path(Path(_args.path))
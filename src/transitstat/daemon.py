@@ -0,0 +1,284 @@
+"""Long running replacement for starting each of the scripts from cron. One process keeps the database engine and the
+Ridesystems session warm, pulls the Ridesystems reports once a day, and imports the spreadsheets that show up in the
+drop directories. Jobs run on a bounded pool of threads, and the same job never runs twice at once"""
+import signal
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from loguru import logger
+
+from .args import setup_logging, setup_parser
+from .cache import ReportCache
+from .circulator.import_ridership import DataImporter
+from .circulator.otp_reports import read_operator_report
+from .circulator.reports import RidesystemReports
+from .connector.data_import import ConnectorImport
+from .metrics import metrics
+
+REPORTS = ('otp', 'runtimes', 'ridership')
+
+# Stat of a file (size, modified time), which has to stay the same for one poll before the file is imported
+FileStat = Tuple[int, float]
+
+
+class DaemonConfig(NamedTuple):
+    """Settings for the daemon"""
+    conn_str: str
+    workers: int = 2  # Number of jobs that can run at the same time
+    poll_interval: float = 60.0  # Seconds between checks for due reports and new files
+    report_time: time = time(3)  # Time of day to pull the Ridesystems reports
+    lookback: int = 7  # Number of days before today to pull. Days that were already loaded are skipped
+    reports: Sequence[str] = REPORTS  # Ridesystems reports to pull
+    run_now: bool = False  # Pull the reports when the daemon starts instead of waiting for report_time
+    ridership_dir: Optional[Path] = None  # Drop directory for the monthly ridership spreadsheets
+    connector_dir: Optional[Path] = None  # Drop directory for the Harbor Connector reports
+    operator_dir: Optional[Path] = None  # Drop directory for the RMA dispatch reports
+    cache: Optional[ReportCache] = None  # Cache for the Ridesystems reports
+    metrics_json: Optional[str] = None  # File to write the metrics of each poll interval to, as JSON
+    metrics_prom: Optional[str] = None  # File to write the metrics of each poll interval to, in the Prometheus format
+
+
+class Daemon:  # pylint:disable=too-many-instance-attributes
+    """Schedules and runs the report pulls and the spreadsheet imports"""
+
+    def __init__(self, config: DaemonConfig):
+        """
+        :param config: Settings for the daemon
+        """
+        self.config = config
+        self.executor = ThreadPoolExecutor(max_workers=max(config.workers, 1), thread_name_prefix='daemon')
+        self.running: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+        now = datetime.now()
+        first_run = now if config.run_now else next_run(now, config.report_time)
+        self.next_reports: Dict[str, datetime] = {report: first_run for report in config.reports}
+
+        # Files seen in the last poll that haven't been imported yet, and the files that have been
+        self._pending: Dict[Path, FileStat] = {}
+        self._handled: Dict[Path, FileStat] = {}
+
+        # Created the first time they are needed, and then kept so the session and engine stay warm. The importers are
+        # created under _init_lock, since jobs for two files can start at once
+        self._reports: Optional[RidesystemReports] = None
+        self._ridership: Optional[DataImporter] = None
+        self._connector: Optional[ConnectorImport] = None
+        self._init_lock = threading.Lock()
+
+    def run(self, stop: threading.Event) -> None:
+        """
+        Runs until stop is set, and then waits for the running jobs to finish
+
+        :param stop: Event that ends the loop
+        """
+        logger.info('Starting the daemon with {} workers', self.config.workers)
+        try:
+            while not stop.is_set():
+                self.tick(datetime.now())
+                stop.wait(self.config.poll_interval)
+                self.emit_metrics()
+        finally:
+            logger.info('Stopping the daemon. Waiting for {} running jobs', len(self.running))
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.emit_metrics()
+
+    def emit_metrics(self) -> None:
+        """
+        Emits the metrics of the jobs that made progress since the last call, and starts the totals over, so they cover
+        one poll interval instead of growing for as long as the daemon runs. Stages are counted in the interval they
+        finish in. Nothing is emitted for an interval where nothing happened
+        """
+        if metrics.stages or metrics.counters or metrics.queries:
+            metrics.emit('daemon', self.config.metrics_json, self.config.metrics_prom, reset=True)
+
+    def tick(self, now: datetime) -> List[Future]:
+        """
+        Starts the reports that are due and imports the new files that have stopped changing
+
+        :param now: Current time
+        :return: The jobs that were started
+        """
+        started = []
+        due = [report for report, next_time in self.next_reports.items() if next_time <= now]
+        if due:
+            # A pull that is still running from the last schedule isn't started again until the next one
+            for report in due:
+                self.next_reports[report] = next_run(now, self.config.report_time)
+            # mechanize isn't thread safe, so the reports are pulled one after the other on the shared session, in one
+            # job that only holds one of the worker threads
+            future = self._submit('reports', self._pull_reports, due, now.date())
+            if future is not None:
+                started.append(future)
+
+        for directory, pattern, func in self._watched():
+            for path, file_stat in self._ready_files(directory, pattern):
+                future = self._submit(f'file:{path}', func, path)
+                if future is not None:
+                    # Otherwise it stays pending, and is tried again on the next poll
+                    del self._pending[path]
+                    self._handled[path] = file_stat
+                    started.append(future)
+        return started
+
+    def _watched(self) -> List[Tuple[Path, str, Callable[[Path], None]]]:
+        """The drop directories that are set, with the pattern of the files to import and the function that does it"""
+        watched = [(self.config.ridership_dir, '*.xlsx', self._import_ridership),
+                   (self.config.connector_dir, 'HC* *.*.xlsx', self._import_connector),
+                   (self.config.operator_dir, '*.xlsx', self._import_operator)]
+        return [(directory, pattern, func) for directory, pattern, func in watched if directory is not None]
+
+    def _ready_files(self, directory: Path, pattern: str) -> List[Tuple[Path, FileStat]]:
+        """
+        Finds the files that are new or changed since they were imported. A file is only ready once its size and
+        modified time are the same in two polls in a row, so files that are still being copied aren't read
+
+        :param directory: Directory to look in
+        :param pattern: Glob pattern of the files to import
+        :return: List of (file, stat of the file)
+        """
+        ready = []
+        for path in sorted(directory.glob(pattern)):
+            if path.name.startswith('~$'):
+                # Excel lock file
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            file_stat = (stat.st_size, stat.st_mtime)
+            if self._handled.get(path) == file_stat:
+                continue
+            if self._pending.get(path) == file_stat:
+                ready.append((path, file_stat))
+            else:
+                self._pending[path] = file_stat
+        return ready
+
+    def _submit(self, key: str, func: Callable, *args) -> Optional[Future]:
+        """
+        Starts a job, unless the job with the same key is still running
+
+        :param key: Name of the job
+        :param func: Function that runs the job
+        :param args: Arguments for func
+        :return: The job, or None if it is already running
+        """
+        with self._lock:
+            if key in self.running:
+                logger.info('Skipping {}. It is still running', key)
+                return None
+            future = self.executor.submit(self._run_job, key, func, *args)
+            self.running[key] = future
+        return future
+
+    def _run_job(self, key: str, func: Callable, *args) -> None:
+        logger.info('Starting {}', key)
+        try:
+            with metrics.stage(f'daemon.{key.split(":")[0]}'):
+                func(*args)
+        except Exception as err:  # pylint:disable=broad-except
+            # One failed job shouldn't stop the daemon. It is tried again on the next schedule or change to the file
+            metrics.count('daemon.failures')
+            logger.exception('{} failed: {}', key, err)
+        else:
+            logger.info('Finished {}', key)
+        finally:
+            with self._lock:
+                self.running.pop(key, None)
+
+    def _pull_reports(self, reports: Sequence[str], today: date) -> None:
+        """
+        Pulls Ridesystems reports for the last lookback days, one after the other. A report that fails doesn't stop
+        the rest; the job fails once they have all been tried
+        """
+        start_date = today - timedelta(days=self.config.lookback)
+        end_date = today - timedelta(days=1)
+        failed = []
+        for report in reports:
+            if self._reports is None:
+                self._reports = RidesystemReports(self.config.conn_str, cache=self.config.cache)
+            try:
+                {'otp': self._reports.get_otp,
+                 'runtimes': self._reports.get_vehicle_assignments,
+                 'ridership': self._reports.get_ridership}[report](start_date, end_date)
+            except Exception as err:  # pylint:disable=broad-except
+                logger.exception('Pulling {} failed: {}', report, err)
+                failed.append(report)
+                # The session might have expired, so the next pull logs in again
+                self._reports = None
+        if failed:
+            raise RuntimeError(f'Unable to pull {", ".join(failed)}')
+
+    def _import_ridership(self, path: Path) -> None:
+        with self._init_lock:
+            if self._ridership is None:
+                self._ridership = DataImporter(self.config.conn_str)
+        self._ridership.import_ridership(file=path)
+
+    def _import_connector(self, path: Path) -> None:
+        with self._init_lock:
+            if self._connector is None:
+                self._connector = ConnectorImport(self.config.conn_str)
+        self._connector.import_path(path)
+
+    def _import_operator(self, path: Path) -> None:
+        read_operator_report(self.config.conn_str, path)
+
+
+def next_run(now: datetime, at_time: time) -> datetime:
+    """
+    The next time after now that it is at_time
+
+    :param now: Current time
+    :param at_time: Time of day
+    """
+    ret = datetime.combine(now.date(), at_time)
+    return ret if ret > now else ret + timedelta(days=1)
+
+
+def parse_args(args):
+    """Handles argument parsing"""
+    parser = setup_parser('Runs the Ridesystems report pulls and the spreadsheet imports in one long running process')
+    parser.add_argument('-w', '--workers', type=int, default=2, help='Number of jobs to run at the same time')
+    parser.add_argument('--poll_interval', type=float, default=60.0,
+                        help='Number of seconds between checks for new files and due reports')
+    parser.add_argument('--report_time', type=time.fromisoformat, default=time(3),
+                        help='Time of day to pull the Ridesystems reports (format HH:MM)')
+    parser.add_argument('--lookback', type=int, default=7,
+                        help='Number of days before today to pull. Days that were already loaded are skipped')
+    parser.add_argument('--reports', nargs='*', choices=REPORTS, default=list(REPORTS),
+                        help='Ridesystems reports to pull. Defaults to all of them')
+    parser.add_argument('--run_now', action='store_true',
+                        help='Pull the reports when the daemon starts, instead of waiting for --report_time')
+    parser.add_argument('--ridership_dir', type=Path, help='Directory to watch for monthly ridership spreadsheets')
+    parser.add_argument('--connector_dir', type=Path, help='Directory to watch for Harbor Connector reports')
+    parser.add_argument('--operator_dir', type=Path, help='Directory to watch for RMA dispatch reports')
+    parser.add_argument('--cache_dir', help='Directory to cache the downloaded Ridesystems reports in')
+
+    parsed = parser.parse_args(args)
+    if parsed.profile:
+        # The profiler keeps every latency until the process exits, which for the daemon is never
+        parser.error('--profile is not supported by the daemon. Profile the individual scripts instead')
+    return parsed
+
+
+if __name__ == '__main__':
+    parsed_args = parse_args(sys.argv[1:])
+    setup_logging(parsed_args.debug, parsed_args.verbose)
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+
+    Daemon(DaemonConfig(
+        parsed_args.conn_str, workers=parsed_args.workers, poll_interval=parsed_args.poll_interval,
+        report_time=parsed_args.report_time, lookback=parsed_args.lookback, reports=parsed_args.reports,
+        run_now=parsed_args.run_now, ridership_dir=parsed_args.ridership_dir, connector_dir=parsed_args.connector_dir,
+        operator_dir=parsed_args.operator_dir, metrics_json=parsed_args.metrics_json,
+        metrics_prom=parsed_args.metrics_prom,
+        cache=ReportCache(Path(parsed_args.cache_dir)) if parsed_args.cache_dir else None,
+    )).run(stop_event)
@@ -0,0 +1,99 @@
+"""Creates the database engines, so every script in transitstat shares one engine (and connection pool) per database and
+gets the same dialect specific settings"""
+import threading
+import weakref
+from typing import Dict, MutableMapping, Set
+
+from loguru import logger
+from sqlalchemy import create_engine, engine as engine_type, inspect, MetaData  # type: ignore
+from sqlalchemy.engine import make_url  # type: ignore
+
+from .metrics import metrics
+
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+
+_ENGINES: Dict[str, engine_type.Engine] = {}
+# Metadata already checked for each engine
+_SCHEMAS: MutableMapping[engine_type.Engine, Set[int]] = weakref.WeakKeyDictionary()
+_LOCK = threading.Lock()
+
+
+def get_engine(conn_str: str) -> engine_type.Engine:
+    """
+    Gets the engine for a connection string, creating it the first time. SQL statements are not echoed; they are
+    logged by the sqlalchemy.engine logger, which setup_logging turns on at the debug level. The statements are counted
+    in the run metrics
+
+    :param conn_str: sqlalchemy connection string (IE sqlite:///crash.db or
+        mssql+pyodbc://balt-sql311-prd/DOT_DATA?driver=ODBC Driver 17 for SQL Server)
+    """
+    with _LOCK:
+        if conn_str not in _ENGINES:
+            logger.info('Creating engine for {}', conn_str)
+            _ENGINES[conn_str] = create_engine(conn_str, future=True, **_engine_options(conn_str))
+            metrics.watch(_ENGINES[conn_str])
+        return _ENGINES[conn_str]
+
+
+def _engine_options(conn_str: str) -> dict:
+    """Keyword arguments for create_engine that depend on the database"""
+    url = make_url(conn_str)
+    if url.get_backend_name() == 'sqlite':
+        # sqlite uses a NullPool or SingletonThreadPool, which don't take a size
+        return {}
+
+    options = {'pool_size': POOL_SIZE, 'max_overflow': MAX_OVERFLOW, 'pool_pre_ping': True}
+    if url.get_backend_name() == 'mssql' and url.get_driver_name() == 'pyodbc':
+        # Sends executemany parameters in one round trip instead of one per row
+        options['fast_executemany'] = True
+    return options
+
+
+def ensure_schema(engine: engine_type.Engine, metadata: MetaData) -> bool:
+    """
+    Creates the tables and indexes in metadata that are missing from the database. The schema is only inspected the
+    first time for each engine and metadata, and create_all is skipped when everything is already there
+
+    :param engine: Engine for the database
+    :param metadata: Metadata with the tables, like Base.metadata from one of the schema modules
+    :return: True if anything had to be created
+    """
+    # Threads that share the engine check the schema one at a time, so the tables are only created once
+    with _LOCK:
+        checked = _SCHEMAS.setdefault(engine, set())
+        if id(metadata) in checked:
+            return False
+
+        created = False
+        if not _schema_exists(engine, metadata):
+            logger.info('Creating the missing tables and indexes of {}', ', '.join(metadata.tables))
+            # Tables that were replaced by views (see circulator.dimensions) are left alone
+            views = set(inspect(engine).get_view_names())
+            tables = [table for table in metadata.sorted_tables if table.name not in views]
+            with engine.begin() as connection:
+                metadata.create_all(connection, tables=tables)
+                # create_all skips tables that already exist, so indexes added to the schema later need to be created
+                # here
+                for table in tables:
+                    for index in table.indexes:
+                        index.create(connection, checkfirst=True)
+            created = True
+
+        checked.add(id(metadata))
+    return created
+
+
+def _schema_exists(engine: engine_type.Engine, metadata: MetaData) -> bool:
+    """Checks if every table and index in metadata is already in the database"""
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    views = set(inspector.get_view_names())
+    for table in metadata.sorted_tables:
+        if table.name in views:
+            continue
+        if table.name not in existing:
+            return False
+        if table.indexes and {i.name for i in table.indexes} - {i['name'] for i in inspector.get_indexes(table.name)}:
+            return False
+    return True
@@ -0,0 +1,155 @@
+"""Keeps track of which units of work (report days, spreadsheets) have been loaded, so reruns only redo the missing or
+partially loaded ones"""
+# pylint:disable=too-few-public-methods
+import hashlib
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, Iterator, Optional
+
+from loguru import logger
+from sqlalchemy import Column, engine as engine_type, select  # type: ignore
+from sqlalchemy.ext.declarative import DeclarativeMeta  # type: ignore
+from sqlalchemy.orm import declarative_base  # type: ignore
+from sqlalchemy.types import DateTime, Float, Integer, String  # type: ignore
+
+from ._merge import bulk_merge
+from .database import ensure_schema
+
+Base: DeclarativeMeta = declarative_base()
+
+STARTED = 'started'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class IngestLedger(Base):
+    """Table holding the status of each unit of work loaded into the database"""
+    __tablename__ = 'ingest_ledger'
+
+    source = Column(String(length=50), primary_key=True)
+    report = Column(String(length=50), primary_key=True)
+    unit = Column(String(length=64), primary_key=True)
+    status = Column(String(length=10))
+    rows = Column(Integer)
+    started = Column(DateTime)
+    finished = Column(DateTime)
+    duration = Column(Float)
+    detail = Column(String(length=255))
+
+
+class LedgerEntry:
+    """Handed out by Ledger.track so the caller can report how many rows were written"""
+    rows: Optional[int] = None
+
+
+class Ledger:
+    """Reads and updates the ingest_ledger table for one source of data"""
+
+    def __init__(self, engine: engine_type.Engine, source: str):
+        """
+        :param engine: Engine for the database with the ingest_ledger table
+        :param source: Where the data comes from (IE ridesystems or harbor_connector)
+        """
+        self.engine = engine
+        self.source = source
+
+        ensure_schema(self.engine, Base.metadata)
+
+    def statuses(self, report: str, first: Optional[str] = None, last: Optional[str] = None) -> Dict[str, str]:
+        """
+        Gets the status of the units of a report
+
+        :param report: Report or table name the units belong to
+        :param first: If set, skip units that sort before it. Units that are ISO formatted dates sort by date
+        :param last: If set, skip units that sort after it
+        :return: Dictionary of unit -> status
+        """
+        qry = select(IngestLedger.unit, IngestLedger.status).where(IngestLedger.source == self.source,
+                                                                   IngestLedger.report == report)
+        if first is not None:
+            qry = qry.where(IngestLedger.unit >= first)
+        if last is not None:
+            qry = qry.where(IngestLedger.unit <= last)
+
+        with self.engine.connect() as connection:
+            return dict(connection.execute(qry).all())
+
+    def finished(self, report: str) -> Dict[str, datetime]:
+        """
+        Gets when each unit of a report that is done finished loading
+
+        :param report: Report or table name the units belong to
+        :return: Dictionary of unit -> finish time
+        """
+        qry = select(IngestLedger.unit, IngestLedger.finished).where(IngestLedger.source == self.source,
+                                                                     IngestLedger.report == report,
+                                                                     IngestLedger.status == DONE)
+        with self.engine.connect() as connection:
+            return dict(connection.execute(qry).all())
+
+    def is_done(self, report: str, unit: str) -> bool:
+        """
+        Checks if a unit was completely loaded
+
+        :param report: Report or table name the unit belongs to
+        :param unit: Identifier of the unit, like an ISO date or a file hash
+        """
+        return self.statuses(report, unit, unit).get(unit) == DONE
+
+    @contextmanager
+    def track(self, report: str, unit: str, detail: Optional[str] = None) -> Iterator[LedgerEntry]:
+        """
+        Context manager that marks a unit as started, and then as done when the block finishes or failed if it raises.
+        Set `rows` on the yielded entry to record the number of rows written
+
+        :param report: Report or table name the unit belongs to
+        :param unit: Identifier of the unit, like an ISO date or a file hash
+        :param detail: Free text to store with the unit, like the file name
+        """
+        entry = LedgerEntry()
+        started = datetime.now()
+        start_time = perf_counter()
+        self._save(report, unit, status=STARTED, started=started, finished=None, duration=None, rows=None,
+                   detail=detail)
+        try:
+            yield entry
+        except Exception as err:
+            self._save(report, unit, status=FAILED, started=started, finished=datetime.now(),
+                       duration=perf_counter() - start_time, rows=entry.rows, detail=str(err)[:255])
+            raise
+
+        self._save(report, unit, status=DONE, started=started, finished=datetime.now(),
+                   duration=perf_counter() - start_time, rows=entry.rows, detail=detail)
+
+    def fail(self, report: str, unit: str, detail: str) -> None:
+        """
+        Marks a unit as failed outside of track, like a file that couldn't be parsed, so the failure shows up in the
+        ledger. It is tried again on the next run
+
+        :param report: Report or table name the unit belongs to
+        :param unit: Identifier of the unit, like an ISO date or a file hash
+        :param detail: Why it failed
+        """
+        now = datetime.now()
+        self._save(report, unit, status=FAILED, started=now, finished=now, duration=None, rows=None,
+                   detail=detail[:255])
+
+    def _save(self, report: str, unit: str, **kwargs) -> None:
+        logger.debug('Ledger {} {} {}: {}', self.source, report, unit, kwargs.get('status'))
+        bulk_merge(IngestLedger, [IngestLedger(source=self.source, report=report, unit=unit, **kwargs)], self.engine)
+
+
+def file_hash(path: Path) -> str:
+    """
+    Hashes the contents of a file, so a file is recognized even if it is renamed or moved
+
+    :param path: File to hash
+    :return: Hex encoded sha256 of the file
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
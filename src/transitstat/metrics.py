@@ -0,0 +1,207 @@
+"""Per stage timing, row counts and database round trips for a run of one of the scripts. The stages are wrapped with
+`metrics.stage`, and the scripts call `metrics.emit` at the end to log a JSON summary and optionally write it to a file
+or to a Prometheus textfile collector"""
+import atexit
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, Optional
+
+from loguru import logger
+from sqlalchemy import engine as engine_type, event  # type: ignore
+
+
+class StageStats:  # pylint:disable=too-few-public-methods
+    """Totals for one stage. Set `rows` on the object yielded by Metrics.stage to count the rows it handled"""
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.queries = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        """The totals as a dictionary"""
+        return {'calls': self.calls, 'seconds': round(self.seconds, 6), 'rows': self.rows, 'queries': self.queries}
+
+
+class StageTimer:  # pylint:disable=too-few-public-methods
+    """Handed out by Metrics.stage so the caller can report how many rows the stage handled"""
+    rows: Optional[int] = None
+
+
+class Metrics:
+    """Collects the stage totals and counters of a run. Stages can run on several threads at once"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.started = datetime.now()
+        self._start_time = perf_counter()
+        self.stages: Dict[str, StageStats] = {}
+        self.counters: Dict[str, int] = {}
+        self.queries = 0
+
+    def reset(self) -> None:
+        """Clears the totals, and restarts the run"""
+        with self._lock:
+            self._clear()
+
+    def _clear(self) -> None:
+        self.started = datetime.now()
+        self._start_time = perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.queries = 0
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageTimer]:
+        """
+        Context manager that times a stage. Database queries made on this thread while the stage is running are counted
+        against it. When stages are nested, the queries count against the innermost one
+
+        :param name: Name of the stage, like ridesystems.fetch
+        """
+        timer = StageTimer()
+        stack = self._stack()
+        stack.append(name)
+        start_time = perf_counter()
+        try:
+            yield timer
+        finally:
+            stack.pop()
+            self.record(name, perf_counter() - start_time, timer.rows)
+
+    def record(self, name: str, seconds: float, rows: Optional[int] = None) -> None:
+        """
+        Adds a stage that was timed somewhere else, like in a worker process
+
+        :param name: Name of the stage
+        :param seconds: How long it took
+        :param rows: Number of rows it handled
+        """
+        with self._lock:
+            stats = self.stages.setdefault(name, StageStats())
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.rows += rows or 0
+
+    def count(self, name: str, value: int = 1) -> None:
+        """
+        Increments a counter, like the number of retries
+
+        :param name: Name of the counter
+        :param value: Amount to add
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def watch(self, engine: engine_type.Engine) -> None:
+        """Counts the statements sent through engine, both in total and against the running stage"""
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def summary(self, run: str, reset: bool = False) -> Dict[str, Any]:
+        """
+        The totals of the run
+
+        :param run: Name of the run, like the script and report
+        :param reset: If true, the totals are also cleared, in the same step so nothing recorded in between is lost
+        """
+        with self._lock:
+            ret = {
+                'run': run,
+                'started': self.started.isoformat(),
+                'seconds': round(perf_counter() - self._start_time, 6),
+                'queries': self.queries,
+                'stages': {name: stats.as_dict() for name, stats in self.stages.items()},
+                'counters': dict(self.counters),
+            }
+            if reset:
+                self._clear()
+        return ret
+
+    def emit(self, run: str, json_path: Optional[str] = None, prometheus_path: Optional[str] = None,
+             reset: bool = False) -> None:
+        """
+        Logs the summary of the run, and writes it to the files that are set
+
+        :param run: Name of the run, like the script and report
+        :param json_path: If set, the summary is written to this file as JSON
+        :param prometheus_path: If set, the summary is written to this file in the Prometheus text format, for the
+            node exporter textfile collector
+        :param reset: If true, the totals are cleared once they are read, so the next summary only covers what happened
+            after this one. Used by long running processes, which emit a summary per interval
+        """
+        summary = self.summary(run, reset)
+        logger.info('Metrics: {}', json.dumps(summary))
+        if json_path:
+            _write_atomic(Path(json_path), json.dumps(summary, indent=2))
+        if prometheus_path:
+            _write_atomic(Path(prometheus_path), to_prometheus(summary))
+
+    def _stack(self) -> List[str]:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _on_execute(self, *_) -> None:
+        stack = self._stack()
+        with self._lock:
+            self.queries += 1
+            if stack:
+                self.stages.setdefault(stack[-1], StageStats()).queries += 1
+
+
+def emit_at_exit(run: str, json_path: Optional[str] = None, prometheus_path: Optional[str] = None) -> None:
+    """
+    Emits the metrics when the script exits, including when it fails, so a failed run still shows where the time went
+
+    :param run: Name of the run, like the script and report
+    :param json_path: If set, the summary is written to this file as JSON
+    :param prometheus_path: If set, the summary is written to this file in the Prometheus text format
+    """
+    atexit.register(metrics.emit, run, json_path, prometheus_path)
+
+
+def to_prometheus(summary: Dict[str, Any]) -> str:
+    """
+    Formats a run summary in the Prometheus text exposition format
+
+    :param summary: Summary from Metrics.summary
+    """
+    run = summary['run'].replace('\\', '\\\\').replace('"', '\\"')
+    lines = ['# HELP transitstat_run_seconds Duration of the last run',
+             '# TYPE transitstat_run_seconds gauge',
+             f'transitstat_run_seconds{{run="{run}"}} {summary["seconds"]}',
+             '# HELP transitstat_run_queries Database round trips in the last run',
+             '# TYPE transitstat_run_queries gauge',
+             f'transitstat_run_queries{{run="{run}"}} {summary["queries"]}',
+             '# HELP transitstat_run_timestamp_seconds When the last run started',
+             '# TYPE transitstat_run_timestamp_seconds gauge',
+             f'transitstat_run_timestamp_seconds{{run="{run}"}} '
+             f'{datetime.fromisoformat(summary["started"]).timestamp()}']
+    for field in ('calls', 'seconds', 'rows', 'queries'):
+        lines += [f'# HELP transitstat_stage_{field} Stage {field} in the last run',
+                  f'# TYPE transitstat_stage_{field} gauge']
+        lines += [f'transitstat_stage_{field}{{run="{run}",stage="{name}"}} {stats[field]}'
+                  for name, stats in summary['stages'].items()]
+    lines += ['# HELP transitstat_counter Counters from the last run, like retries',
+              '# TYPE transitstat_counter gauge']
+    lines += [f'transitstat_counter{{run="{run}",name="{name}"}} {value}'
+              for name, value in summary['counters'].items()]
+    return '\n'.join(lines) + '\n'
+
+
+def _write_atomic(path: Path, text: str) -> None:
+    """Writes the file all at once, so a collector never reads half of it"""
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
+
+
+# Shared by everything in the process
+metrics = Metrics()
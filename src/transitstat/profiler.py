@@ -0,0 +1,143 @@
+"""Opt in profiler of the SQL statements sent to the database. Statements are grouped after replacing their literals and
+parameter lists, so the same query with different values is counted together. Turned on with --profile, which prints
+the report when the script exits"""
+import atexit
+import heapq
+import math
+import re
+import sys
+import threading
+from collections import defaultdict
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+from sqlalchemy import event  # type: ignore
+from sqlalchemy.engine import Engine  # type: ignore
+
+TOP_N = 10
+STATEMENT_WIDTH = 100
+
+_WHITESPACE = re.compile(r'\s+')
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAMETER_LISTS = re.compile(r'\?(?:\s*,\s*\?)+')
+_ROW_LISTS = re.compile(r'\(\?, \.\.\.\)(?:\s*,\s*\(\?, \.\.\.\))+')
+
+
+class QueryProfiler:
+    """Records the latency of every statement sent through the engines it is listening to"""
+
+    def __init__(self, top_n: int = TOP_N):
+        """
+        :param top_n: Number of statements to list in each part of the report
+        """
+        self.top_n = top_n
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.slowest: List[Tuple[float, str, int]] = []
+        self._lock = threading.Lock()
+        self._target = None
+
+    def start(self, target=Engine) -> None:
+        """
+        Starts listening for statements
+
+        :param target: Engine to profile. By default, every engine in the process is profiled
+        """
+        event.listen(target, 'before_cursor_execute', self._before_execute)
+        event.listen(target, 'after_cursor_execute', self._after_execute)
+        self._target = target
+
+    def stop(self) -> None:
+        """Stops listening for statements. What was already recorded is kept"""
+        if self._target is not None:
+            event.remove(self._target, 'before_cursor_execute', self._before_execute)
+            event.remove(self._target, 'after_cursor_execute', self._after_execute)
+            self._target = None
+
+    def stats(self) -> List[Dict]:
+        """
+        Totals for each normalized statement, with the slowest in total first
+
+        :return: List of dictionaries with the statement, count, and the total, mean, p50, p95, p99 and max latency in
+            seconds
+        """
+        with self._lock:
+            items = [(statement, sorted(latencies)) for statement, latencies in self.latencies.items()]
+
+        ret = [{'statement': statement, 'count': len(latencies), 'total': sum(latencies),
+                'mean': sum(latencies) / len(latencies), 'p50': _percentile(latencies, 50),
+                'p95': _percentile(latencies, 95), 'p99': _percentile(latencies, 99), 'max': latencies[-1]}
+               for statement, latencies in items]
+        ret.sort(key=lambda i: i['total'], reverse=True)
+        return ret
+
+    def report(self) -> str:
+        """The statements that took the most time in total, followed by the slowest single executions"""
+        stats = self.stats()
+        lines = [f'Query profile: {sum(i["count"] for i in stats)} statements, '
+                 f'{sum(i["total"] for i in stats):.3f} s in the database',
+                 f'{"count":>8} {"total s":>9} {"mean ms":>9} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} '
+                 f'{"max ms":>9}  statement']
+        for i in stats[:self.top_n]:
+            lines.append(f'{i["count"]:>8} {i["total"]:>9.3f} {i["mean"] * 1000:>9.2f} {i["p50"] * 1000:>9.2f} '
+                         f'{i["p95"] * 1000:>9.2f} {i["p99"] * 1000:>9.2f} {i["max"] * 1000:>9.2f}  '
+                         f'{_shorten(i["statement"])}')
+
+        lines += ['', f'Slowest {self.top_n} executions:', f'{"ms":>9} {"rows":>8}  statement']
+        with self._lock:
+            slowest = sorted(self.slowest, reverse=True)
+        lines += [f'{elapsed * 1000:>9.2f} {rows:>8}  {_shorten(statement)}' for elapsed, statement, rows in slowest]
+        return '\n'.join(lines)
+
+    def print_report(self) -> None:
+        """Prints the report to stderr"""
+        sys.stderr.write(self.report() + '\n')
+
+    @staticmethod
+    def _before_execute(conn, *_) -> None:
+        # Statements on one connection don't overlap, but a stack keeps nested executes (like in event handlers) apart
+        conn.info.setdefault('profiler_start_time', []).append(perf_counter())
+
+    def _after_execute(self, conn, _cursor, statement, parameters, _context, executemany) -> None:
+        elapsed = perf_counter() - conn.info['profiler_start_time'].pop()
+        normalized = normalize(statement)
+        rows = len(parameters) if executemany else 1
+        with self._lock:
+            self.latencies[normalized].append(elapsed)
+            if len(self.slowest) < self.top_n:
+                heapq.heappush(self.slowest, (elapsed, normalized, rows))
+            elif elapsed > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (elapsed, normalized, rows))
+
+
+def normalize(statement: str) -> str:
+    """
+    Groups statements that only differ in their values: whitespace is collapsed, literals become ?, and lists of
+    parameters (like an IN list or multi row VALUES) are shortened to their first item
+
+    :param statement: SQL statement as sent to the database
+    """
+    statement = _WHITESPACE.sub(' ', statement).strip()
+    statement = _LITERALS.sub('?', statement)
+    statement = _PARAMETER_LISTS.sub('?, ...', statement)
+    return _ROW_LISTS.sub('(?, ...), ...', statement)
+
+
+def profile_at_exit(top_n: int = TOP_N) -> QueryProfiler:
+    """
+    Profiles every engine in the process, and prints the report when the script exits
+
+    :param top_n: Number of statements to list in each part of the report
+    """
+    profiler = QueryProfiler(top_n)
+    profiler.start()
+    atexit.register(profiler.print_report)
+    return profiler
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    """Nearest rank percentile of sorted values"""
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)]
+
+
+def _shorten(statement: str) -> str:
+    return statement if len(statement) <= STATEMENT_WIDTH else statement[:STATEMENT_WIDTH - 3] + '...'
@@ -0,0 +1,159 @@
+"""Change detection for reloaded data. The rows of each unit of work (report day, spreadsheet) are hashed when they are
+written, so the next load of the same unit only sends the rows that are new or changed to the database. Only the
+hashes of those rows are written back, along with deleting the hashes of rows that are no longer in the unit"""
+from __future__ import annotations
+
+# pylint:disable=too-few-public-methods
+from typing import List, NamedTuple, Tuple, TYPE_CHECKING
+
+from loguru import logger
+from sqlalchemy import Column, delete, engine as engine_type, func, select  # type: ignore
+from sqlalchemy.engine import Connection  # type: ignore
+from sqlalchemy.ext.declarative import DeclarativeMeta  # type: ignore
+from sqlalchemy.orm import declarative_base  # type: ignore
+from sqlalchemy.types import BigInteger, String  # type: ignore
+
+from ._merge import bulk_merge
+from ._transform import Record
+from .database import ensure_schema
+from .metrics import metrics
+from ._lazy import LazyModule
+
+if TYPE_CHECKING:
+    import numpy as np  # type: ignore
+    import pandas as pd  # type: ignore
+else:
+    np = LazyModule('numpy')
+    pd = LazyModule('pandas')
+
+Base: DeclarativeMeta = declarative_base()
+
+# Hashes deleted in one statement, which keeps under the parameter limits of Sqlite and Sql Server
+DELETE_CHUNK_SIZE = 500
+
+
+class IngestRowHash(Base):
+    """Table holding the hash of each row of a unit of work, as of the last time the unit was written"""
+    __tablename__ = 'ingest_row_hash'
+
+    source = Column(String(length=50), primary_key=True)
+    report = Column(String(length=50), primary_key=True)
+    unit = Column(String(length=255), primary_key=True)
+    key_hash = Column(BigInteger, primary_key=True, autoincrement=False)
+    row_hash = Column(BigInteger)
+
+
+class HashCounts(NamedTuple):
+    """Number of rows of a unit that are new, changed and unchanged since it was last written"""
+    new: int = 0
+    changed: int = 0
+    unchanged: int = 0
+
+
+class HashUpdate(NamedTuple):
+    """Changes to the stored hashes of a unit, from RowHashes.diff, for RowHashes.save to write"""
+    hashes: pd.DataFrame  # key_hash and row_hash of the rows that are written
+    removed: List[int]  # key_hash of the stored rows that are no longer in the unit
+
+
+class RowHashes:
+    """Reads and updates the ingest_row_hash table for one source of data"""
+
+    def __init__(self, engine: engine_type.Engine, source: str):
+        """
+        :param engine: Engine for the database with the ingest_row_hash table
+        :param source: Where the data comes from (IE ridesystems or ridership_xlsx)
+        """
+        self.engine = engine
+        self.source = source
+
+        ensure_schema(self.engine, Base.metadata)
+
+    def diff(self, model: DeclarativeMeta, report: str, unit: str, records: List[Record],  # pylint:disable=too-many-arguments
+             write_all: bool = False) -> Tuple[List[Record], HashCounts, HashUpdate]:
+        """
+        Compares rows with the hashes stored the last time the unit was written
+
+        :param model: `sqlalchemy.ext.declarative.DeclarativeMeta` class of the table the rows are going into
+        :param report: Report or table name the unit belongs to
+        :param unit: Identifier of the unit, like an ISO date or a file name
+        :param records: All of the rows of the unit
+        :param write_all: Return every row to be written, like when the table no longer matches the stored hashes. The
+            counts are still against the stored hashes
+        :return: Tuple of the rows to write, the counts, and the changes to pass to save once the rows are written
+        """
+        hashes = hash_records(model, records)
+        stored = self._stored(report, unit)
+
+        # Nullable integers, because the hashes don't survive a round trip through float
+        stored_hash = hashes.merge(stored.astype('Int64'), on='key_hash', how='left')['stored_hash']
+        new = stored_hash.isna().to_numpy()
+        changed = ~new & (stored_hash != hashes['row_hash']).fillna(False).to_numpy(dtype=bool)
+        write = new | changed
+
+        counts = HashCounts(new=int(new.sum()), changed=int(changed.sum()), unchanged=int((~write).sum()))
+        logger.info('{} {}: {} new, {} changed and {} unchanged rows', report, unit, *counts)
+        for name, value in counts._asdict().items():
+            metrics.count(f'{report}.rows_{name}', value)
+
+        if write_all:
+            write[:] = True
+        return [record for record, keep in zip(records, write) if keep], counts, \
+            HashUpdate(hashes[write], stored.loc[~stored['key_hash'].isin(hashes['key_hash']), 'key_hash'].tolist())
+
+    def _stored(self, report: str, unit: str) -> pd.DataFrame:
+        """The stored hashes of a unit, with the columns key_hash and stored_hash"""
+        with self.engine.connect() as connection:
+            return pd.DataFrame(connection.execute(select(IngestRowHash.key_hash, IngestRowHash.row_hash).where(
+                IngestRowHash.source == self.source, IngestRowHash.report == report, IngestRowHash.unit == unit)
+            ).all(), columns=['key_hash', 'stored_hash'])
+
+    def count(self, report: str, unit: str) -> int:
+        """
+        Counts the stored hashes of a unit, which is the number of rows it had the last time it was written
+
+        :param report: Report or table name the unit belongs to
+        :param unit: Identifier of the unit
+        """
+        with self.engine.connect() as connection:
+            return connection.execute(select(func.count()).select_from(IngestRowHash).where(
+                IngestRowHash.source == self.source, IngestRowHash.report == report, IngestRowHash.unit == unit)
+            ).scalar()
+
+    def save(self, report: str, unit: str, update: HashUpdate, connection: Connection) -> None:
+        """
+        Upserts the hashes of the rows that were written, and deletes the ones of rows that are no longer in the unit.
+        Call this in the same transaction as the write, so the hashes never describe rows that weren't written
+
+        :param report: Report or table name the unit belongs to
+        :param unit: Identifier of the unit
+        :param update: Changes from diff
+        :param connection: Connection with the transaction of the write
+        """
+        bulk_merge(IngestRowHash, update.hashes.assign(source=self.source, report=report, unit=unit), connection)
+        for i in range(0, len(update.removed), DELETE_CHUNK_SIZE):
+            connection.execute(delete(IngestRowHash).where(
+                IngestRowHash.source == self.source, IngestRowHash.report == report, IngestRowHash.unit == unit,
+                IngestRowHash.key_hash.in_(update.removed[i:i + DELETE_CHUNK_SIZE])))
+
+
+def hash_records(model: DeclarativeMeta, records: List[Record]) -> pd.DataFrame:
+    """
+    Hashes the primary key and the rest of the columns of each row. Values are hashed by their text, so the hashes
+    are the same from run to run as long as the rows are built the same way (like with frame_to_records)
+
+    :param model: `sqlalchemy.ext.declarative.DeclarativeMeta` class of the table the rows are going into
+    :param records: Rows keyed by column name
+    :return: DataFrame with the columns key_hash and row_hash, in the order of records
+    """
+    columns = [column.name for column in model.__table__.columns]
+    keys = [column.name for column in model.__table__.primary_key.columns]
+    values = [column for column in columns if column not in keys]
+
+    frame = pd.DataFrame.from_records(records, columns=columns).astype(object)
+    frame = frame.where(frame.notna(), None).astype(str)
+    key_hash = pd.util.hash_pandas_object(frame[keys], index=False).to_numpy()
+    row_hash = pd.util.hash_pandas_object(frame[values], index=False).to_numpy() if values else \
+        np.zeros(len(frame), dtype=np.uint64)
+    # The database only has signed integers
+    return pd.DataFrame({'key_hash': key_hash.view(np.int64), 'row_hash': row_hash.view(np.int64)})
@@ -0,0 +1,59 @@
+"""Test suite for transitstat.cache"""
+import os
+import time
+from datetime import date, timedelta
+
+import pandas as pd  # type: ignore
+import pytest
+
+from transitstat.cache import ReportCache
+
+
+def test_report_cache(tmp_path_factory):
+    """Test storing and looking up reports"""
+    cache = ReportCache(tmp_path_factory.mktemp('cache'))
+    df = pd.DataFrame({'route': ['Purple', 'Orange'], 'riders': [1, 2]})
+
+    assert cache.get('get_otp', date(2022, 3, 1)) is None
+    assert cache.put('get_otp', date(2022, 3, 1), df)
+    pd.testing.assert_frame_equal(cache.get('get_otp', date(2022, 3, 1)), df)
+
+    # The key includes the report and its arguments
+    assert cache.get('get_ridership', date(2022, 3, 1)) is None
+    assert cache.get('get_otp', date(2022, 3, 1), {'hours': '12'}) is None
+    assert cache.put('get_otp', date(2022, 3, 1), df.iloc[:1], {'hours': '12'})
+    assert len(cache.get('get_otp', date(2022, 3, 1), {'hours': '12'})) == 1
+
+    # Recent days might still change
+    assert not cache.put('get_otp', date.today(), df)
+    assert cache.get('get_otp', date.today()) is None
+
+
+def test_report_cache_evict(tmp_path_factory):
+    """Test that expired and least recently used reports are deleted"""
+    directory = tmp_path_factory.mktemp('cache')
+    cache = ReportCache(directory)
+    df = pd.DataFrame({'route': ['Purple'] * 100, 'riders': range(100)})
+    paths = {}
+    for day in range(1, 5):
+        cache.put('get_otp', date(2022, 3, day), df)
+        paths[day] = cache._path('get_otp', date(2022, 3, day), None)  # pylint:disable=protected-access
+    size = paths[1].stat().st_size
+
+    # Make the reports look like they were downloaded and last used on different days
+    now = time.time()
+    for day, (downloaded, used) in {1: (10, 5), 2: (9, 4), 3: (7, 3), 4: (6, 2)}.items():
+        os.utime(paths[day], (now - used * 86400, now - downloaded * 86400))
+    # Reading a report marks it as used, but doesn't make it any younger
+    cache.get('get_otp', date(2022, 3, 1))
+    assert paths[1].stat().st_mtime == pytest.approx(now - 10 * 86400)
+
+    assert ReportCache(directory, max_age=timedelta(days=20)).evict() == 0
+    assert ReportCache(directory, max_size=size * 3).evict() == 1
+    assert not paths[2].exists()
+    # The report that was just read is still the oldest download, so it expires
+    assert ReportCache(directory, max_age=timedelta(days=8)).evict() == 1
+    assert sorted(directory.glob('*/*.parquet')) == sorted([paths[3], paths[4]])
+
+    assert ReportCache(directory, max_age=timedelta(days=1)).get('get_otp', date(2022, 3, 3)) is None
+    assert not paths[3].exists()
@@ -0,0 +1,90 @@
+"""Test suite for transitstat.circulator.dimensions"""
+from datetime import date, datetime, time
+from unittest.mock import patch
+
+import pandas as pd  # type: ignore
+import pytest
+from sqlalchemy import inspect, select  # type: ignore
+from sqlalchemy.orm import Session  # type: ignore
+
+from transitstat._merge import bulk_merge
+from transitstat.circulator.dimensions import CirculatorArrivalFact, CirculatorRidershipFact, DimensionCache, DimStop, \
+    normalize, parse_args, ROUTE
+from transitstat.circulator.schema import CirculatorArrival, CirculatorRidership
+from transitstat.database import get_engine
+from transitstat.metrics import metrics
+from .test_circulator_reports import body_testing
+
+RIDERSHIP = [
+    {'vehicle': 'CC1211', 'route': 'Purple', 'stop': 'Penn Station', 'datetime': datetime(2022, 3, 1, 8),
+     'latitude': 39.307, 'longitude': -76.615, 'boardings': 5, 'alightings': 2},
+    {'vehicle': 'CC1212', 'route': 'Orange', 'stop': 'Harbor East', 'datetime': datetime(2022, 4, 15, 9),
+     'latitude': 39.283, 'longitude': -76.600, 'boardings': 3, 'alightings': 4},
+]
+ARRIVALS = [
+    {'date': date(2022, 3, 1), 'route': 'Purple', 'stop': 'Penn Station', 'block_id': 'P_1',
+     'scheduled_arrival_time': time(8), 'actual_arrival_time': time(8, 2), 'scheduled_departure_time': time(8, 1),
+     'actual_departure_time': time(8, 3), 'on_time_status': 'On Time', 'vehicle': 'CC1211'},
+    {'date': date(2022, 3, 1), 'route': 'Purple', 'stop': None, 'block_id': 'P_1',
+     'scheduled_arrival_time': time(9), 'actual_arrival_time': None, 'scheduled_departure_time': time(9, 1),
+     'actual_departure_time': None, 'on_time_status': 'Missed', 'vehicle': None},
+]
+
+
+def test_normalize(conn_str):
+    """Test that the views return the rows of the wide tables after the conversion"""
+    engine = get_engine(conn_str)
+    bulk_merge(CirculatorRidership, RIDERSHIP, engine)
+    bulk_merge(CirculatorArrival, ARRIVALS, engine)
+
+    assert normalize(engine) == {'ccc_ridership': 2, 'ccc_arrival_times': 2}
+    assert {'ccc_ridership', 'ccc_arrival_times'} <= set(inspect(engine).get_view_names())
+    assert {'ccc_ridership_legacy', 'ccc_arrival_times_legacy'} <= set(inspect(engine).get_table_names())
+
+    with Session(bind=engine, future=True) as session:
+        assert session.query(CirculatorRidershipFact).count() == 2
+        assert session.query(CirculatorArrivalFact).count() == 2
+        ridership = session.execute(select(CirculatorRidership).order_by(CirculatorRidership.datetime)).scalars()
+        assert [(i.vehicle, i.route, i.stop, i.boardings) for i in ridership] == [
+            ('CC1211', 'Purple', 'Penn Station', 5), ('CC1212', 'Orange', 'Harbor East', 3)]
+        arrivals = session.execute(select(CirculatorArrival).order_by(CirculatorArrival.scheduled_arrival_time))
+        assert [(i.stop, i.vehicle) for i in arrivals.scalars()] == [('Penn Station', 'CC1211'), (None, None)]
+        # The stop is shared by both tables
+        assert session.query(DimStop).count() == 2
+
+    # Converting again does nothing
+    assert not normalize(engine)
+
+
+def test_dimension_cache(conn_str):
+    """Test that names are only looked up in the database the first time"""
+    engine = get_engine(conn_str)
+    cache = DimensionCache(engine)
+    frame = pd.DataFrame({'route': ['Purple', 'Orange', None, 'Purple']})
+    keys = cache.keys(ROUTE, frame)
+    assert keys[0] == keys[3] != keys[1]
+    assert keys.isna().tolist() == [False, False, True, False]
+
+    metrics.reset()
+    assert cache.keys(ROUTE, frame).equals(keys)
+    assert metrics.summary('test')['queries'] == 0
+
+    # Another process sees the same keys
+    assert DimensionCache(engine).keys(ROUTE, frame).equals(keys)
+
+
+@pytest.mark.filterwarnings("ignore::sqlalchemy.exc.SAWarning")
+@patch('transitstat.circulator.reports.RideSystemsInterface')
+def test_reports_normalized(mocked_rs_cls, conn_str, ridership_dataset):
+    """Test that the reports are written to the fact table once the database is converted"""
+    normalize(get_engine(conn_str))
+    body_testing(mocked_rs_cls, conn_str, 'ridership', ridership_dataset, force=True)
+
+    with Session(bind=get_engine(conn_str), future=True) as session:
+        assert session.query(CirculatorRidershipFact).count() == 100
+
+
+def test_parse_args():
+    """Test for parse_args"""
+    assert parse_args(['-t', 'ccc_ridership']).tables == ['ccc_ridership']
+    assert parse_args([]).tables is None
@@ -0,0 +1,58 @@
+"""Test suite for transitstat.circulator.export"""
+from datetime import date, datetime, time
+
+from transitstat._merge import bulk_merge
+from transitstat.circulator.export import export_tables, parse_args, read_export
+from transitstat.circulator.schema import CirculatorArrival, CirculatorRidership
+from transitstat.database import get_engine
+from transitstat.ledger import Ledger
+
+
+def _load(engine, model, rows, days):
+    """Writes the rows, and records the days in the ledger like RidesystemReports does"""
+    ledger = Ledger(engine, 'ridesystems')
+    for day in days:
+        with ledger.track(model.__tablename__, day.isoformat()):
+            bulk_merge(model, rows, engine)
+
+
+def test_export_tables(conn_str, tmp_path_factory):
+    """Test exporting the tables, and that only newly loaded days are exported again"""
+    directory = tmp_path_factory.mktemp('export')
+    engine = get_engine(conn_str)
+    arrivals = [CirculatorArrival(date=date(2022, month, day), route=route, block_id=f'{route[0]}_1', stop='Stop 1',
+                                  scheduled_arrival_time=time(8, 0), actual_arrival_time=time(8, 1),
+                                  on_time_status='On Time')
+                for month, day in ((2, 28), (3, 1)) for route in ('Purple', 'Green')]
+    _load(engine, CirculatorArrival, arrivals, [date(2022, 2, 28), date(2022, 3, 1)])
+    _load(engine, CirculatorRidership, [CirculatorRidership(vehicle='CC1201', route='Purple', stop='Stop 1',
+                                                            datetime=datetime(2022, 3, 1, 8), boardings=2)],
+          [date(2022, 3, 1)])
+
+    assert export_tables(conn_str, directory) == {'ccc_arrival_times': 4, 'ccc_ridership': 1}
+    assert (directory / 'ccc_arrival_times' / 'year=2022' / 'month=3' / 'route=Green' / '2022-03-01-0.parquet').exists()
+
+    ret = read_export(directory, 'ccc_arrival_times', columns=['date', 'route', 'actual_arrival_time'],
+                      filters=[('month', '=', 3), ('route', '=', 'Purple')])
+    assert ret.to_dict('records') == [{'date': date(2022, 3, 1), 'route': 'Purple', 'actual_arrival_time': time(8, 1)}]
+    assert read_export(directory, 'ccc_ridership')['boardings'].tolist() == [2]
+
+    # Nothing was loaded since the export
+    assert export_tables(conn_str, directory) == {'ccc_arrival_times': 0, 'ccc_ridership': 0}
+
+    # Reloading a day replaces its files
+    _load(engine, CirculatorArrival, arrivals[2:3], [date(2022, 3, 1)])
+    assert export_tables(conn_str, directory, ['ccc_arrival_times']) == {'ccc_arrival_times': 2}
+    assert len(read_export(directory, 'ccc_arrival_times')) == 4
+
+    assert export_tables(conn_str, directory, ['ccc_ridership'], date(2022, 3, 1), date(2022, 3, 2)) == \
+        {'ccc_ridership': 1}
+
+
+def test_parse_args():
+    """Test argument parsing"""
+    args = parse_args(['-d', 'export', '-t', 'ccc_ridership', '-s', '2022-03-01', '-e', '2022-03-31'])
+    assert args.dir == 'export'
+    assert args.tables == ['ccc_ridership']
+    assert args.startdate == date(2022, 3, 1)
+    assert args.enddate == date(2022, 3, 31)
@@ -1,12 +1,16 @@
 """Tests circulator.import_ridership"""
 import shutil
+from datetime import date, datetime
 from pathlib import Path
 
+import pandas as pd  # type: ignore
+
 from sqlalchemy import create_engine  # type: ignore
 from sqlalchemy.orm import Session  # type: ignore
 
 from transitstat.circulator.schema import CirculatorRidershipXLS  # type: ignore
-from transitstat.circulator.import_ridership import parse_args
+from transitstat.circulator.import_ridership import DataImporter, _hash_unit, _sheet_to_long, parse_args
+from transitstat.ledger import FAILED, file_hash
 
 
 def test_import_ridership_file(dataimporter):
@@ -21,7 +25,11 @@ def test_import_ridership_file(dataimporter):
 
 def test_import_ridership_validate_dates(dataimporter):
     """Tests that there are actually dates in the header"""
-    assert not dataimporter.import_ridership(file=Path(__file__).parent.absolute() / 'data' / 'testdata3.xlsx')
+    xlsx = Path(__file__).parent.absolute() / 'data' / 'testdata3.xlsx'
+    assert not dataimporter.import_ridership(file=xlsx)
+    # The failure is recorded in the ledger
+    unit = file_hash(xlsx)
+    assert dataimporter.ledger.statuses(CirculatorRidershipXLS.__tablename__, unit, unit) == {unit: FAILED}
 
 
 def test_import_ridership_dir(dataimporter, tmp_path_factory):
@@ -37,14 +45,80 @@ def test_import_ridership_dir(dataimporter, tmp_path_factory):
         assert len(ret) == 748
 
 
+def test_import_ridership_dir_jobs(conn_str, tmp_path_factory):
+    """Test import_ridership with the files parsed in worker processes"""
+    working_dir = tmp_path_factory.mktemp('data')
+    for xlsx in ('testdata.xlsx', 'testdata2.xlsx', 'testdata3.xlsx'):
+        shutil.copy(Path(__file__).parent / 'data' / xlsx, working_dir)
+    dataimporter = DataImporter(conn_str, jobs=2)
+    assert dataimporter.import_ridership(directory=working_dir)
+
+    # testdata3.xlsx doesn't have dates in the header, so it stays behind to be looked at
+    assert sorted(i.name for i in (working_dir / '.processed').iterdir()) == ['testdata.xlsx', 'testdata2.xlsx']
+    assert (working_dir / 'testdata3.xlsx').exists()
+    with Session(bind=dataimporter.engine, future=True) as session:
+        assert session.query(CirculatorRidershipXLS).count() == 748
+
+
+def test_sheet_to_long():
+    """Test converting a weekly sheet to one row per route, block and day"""
+    nan = float('nan')
+    rows = [[nan, 'Purple', nan, nan, nan, nan],
+            [nan, nan, '#1', 10.0, nan, 10.0],
+            [nan, nan, '#2', 20.0, 21.0, 41.0],
+            [nan, nan, 'Total', 30.0, 21.0, 51.0]]
+    for route in ('Orange', 'Green', 'Banner'):
+        rows += [[nan, route, nan, nan, nan, nan], [nan, nan, 'Total', 0.0, 0.0, 0.0]]
+    rows.insert(5, [nan, nan, '#12', 5.0, 6.0, 11.0])
+    sheet = pd.DataFrame(rows, columns=['Unnamed: 0', 'Unnamed: 1', 'Unnamed: 2', datetime(2022, 3, 1),
+                                        datetime(2022, 3, 2), 'Week'])
+    ret = _sheet_to_long(sheet).sort_values(['Route', 'BlockID', 'RidershipDate'])
+    assert ret.to_dict('records') == [
+        {'RidershipDate': date(2022, 3, 1), 'Route': 'Orange', 'BlockID': 12, 'Riders': 5},
+        {'RidershipDate': date(2022, 3, 2), 'Route': 'Orange', 'BlockID': 12, 'Riders': 6},
+        {'RidershipDate': date(2022, 3, 1), 'Route': 'Purple', 'BlockID': 1, 'Riders': 10},
+        {'RidershipDate': date(2022, 3, 1), 'Route': 'Purple', 'BlockID': 2, 'Riders': 20},
+        {'RidershipDate': date(2022, 3, 2), 'Route': 'Purple', 'BlockID': 2, 'Riders': 21},
+    ]
+
+    assert _sheet_to_long(sheet.drop(columns=[datetime(2022, 3, 1), datetime(2022, 3, 2)])) is None
+
+
+def test_hash_unit():
+    """Test that spreadsheets with the same name only share hashes if they cover the same days"""
+    march = pd.DataFrame({'RidershipDate': [date(2022, 3, 1), date(2022, 3, 31)]})
+    april = pd.DataFrame({'RidershipDate': [date(2022, 4, 1), date(2022, 4, 30)]})
+    assert _hash_unit(Path('a/ridership.xlsx'), march) == '2022-03-01/2022-03-31'
+    assert _hash_unit(Path('b/ridership.xlsx'), march) == _hash_unit(Path('a/ridership.xlsx'), march)
+    assert _hash_unit(Path('a/ridership.xlsx'), april) != _hash_unit(Path('a/ridership.xlsx'), march)
+
+
 def test_parse_args():
     """Test argument parsing"""
     file_str = 'thisfile'
     dir_str = 'thisdir'
     conn_str = 'thisconnstr'
-    args = parse_args(['-f', file_str, '-d', dir_str, '-c', conn_str, '-vv'])
+    args = parse_args(['-f', file_str, '-d', dir_str, '-c', conn_str, '-vv', '-j', '4'])
     assert args.file == file_str
     assert args.dir == dir_str
     assert args.conn_str == conn_str
+    assert args.jobs == 4
     assert args.debug
     assert not args.verbose
+
+
+def test_import_ridership_skip_imported(dataimporter, tmp_path_factory):
+    """Test that a file that was already imported is skipped, even under a different name"""
+    working_dir = tmp_path_factory.mktemp('data')
+    shutil.copy(Path(__file__).parent / 'data' / 'testdata.xlsx', working_dir / 'renamed.xlsx')
+    assert dataimporter.import_ridership(file=Path(__file__).parent.absolute() / 'data' / 'testdata.xlsx')
+
+    engine = create_engine(dataimporter.conn_str, echo=True, future=True)
+    with Session(bind=engine, future=True) as session:
+        session.query(CirculatorRidershipXLS).delete()
+        session.commit()
+
+    assert dataimporter.import_ridership(directory=working_dir)
+    assert (working_dir / '.processed' / 'renamed.xlsx').exists()
+    with Session(bind=engine, future=True) as session:
+        assert session.query(CirculatorRidershipXLS).count() == 0
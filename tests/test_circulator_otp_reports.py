@@ -1,9 +1,25 @@
 """Test suite for transitstat.circulator.otp_reports"""
 from pathlib import Path
 
+from sqlalchemy.orm import Session  # type: ignore
+
+from transitstat._merge import MergeResult
 from transitstat.circulator.otp_reports import read_operator_report
+from transitstat.circulator.schema import CirculatorOperator
+from transitstat.database import get_engine
 
 
 def test_read_operator_report(conn_str):
     """Test for read_operator_report"""
-    read_operator_report(conn_str, Path('tests') / "data" / 'March 2022 - Dispatch Report.xlsx')
+    assert read_operator_report(conn_str, Path('tests') / "data" / 'March 2022 - Dispatch Report.xlsx') == \
+        MergeResult(inserted=56, updated=0)
+
+
+def test_read_operator_report_reload(conn_str):
+    """Test that loading the same report again updates the rows instead of failing on the primary key"""
+    read_operator_report(conn_str, Path('tests') / "data" / 'March 2022 - Dispatch Report.xlsx', chunk_size=10)
+    assert read_operator_report(conn_str, Path('tests') / "data" / 'March 2022 - Dispatch Report.xlsx',
+                                chunk_size=10) == MergeResult(inserted=0, updated=56)
+
+    with Session(bind=get_engine(conn_str), future=True) as session:
+        assert session.query(CirculatorOperator).count() == 56
@@ -1,13 +1,22 @@
 """Test suites for circulator.circulator_reports"""
-from datetime import date, timedelta
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import List, Tuple
 from unittest.mock import patch
 
 import pytest
 import pandas as pd  # type: ignore
+from sqlalchemy import delete  # type: ignore
 from sqlalchemy.orm import Session  # type: ignore
 
-from transitstat.circulator.schema import CirculatorArrival, CirculatorBusRuntimes, CirculatorRidership
-from transitstat.circulator.reports import parse_args, RidesystemReports
+from transitstat._merge import bulk_merge
+from transitstat.circulator.schema import CirculatorArrival, CirculatorBusRuntimes, CirculatorOtpDaily, \
+    CirculatorRidership, CirculatorRidershipHourly
+from transitstat.cache import ReportCache
+from transitstat.circulator.reports import get_date_ranges, parse_args, REPLACE, RidesystemReports, \
+    RUNTIME_REPORT
+from transitstat.metrics import metrics
 
 
 def body_testing(mocked_rs_cls, conn_str: str, func, factory, force: bool = False):
@@ -44,6 +53,10 @@ def body_testing(mocked_rs_cls, conn_str: str, func, factory, force: bool = Fals
     with Session(bind=inst.engine, future=True) as session:
         ret = session.query(model)
         assert ret.count() == 100
+        if func == 'otp':
+            assert sum(i.arrivals for i in session.query(CirculatorOtpDaily)) == 100
+        if func == 'ridership':
+            assert session.query(CirculatorRidershipHourly).count() > 0
 
     if force:
         assert len(inst.get_dates_to_process(date_start, date_end, date_column, force)) == 3
@@ -159,3 +172,185 @@ def test_parse_args():
     assert args.startdate == start_date
     assert args.enddate == end_date
     assert not args.force
+    assert args.workers == 1
+
+    args = parse_args(['ridership', '-w', '4'])
+    assert args.workers == 4
+    assert args.mode == 'merge'
+
+    args = parse_args(['otp', '-f', '--mode', 'replace'])
+    assert args.mode == REPLACE
+
+
+class FakeRideSystems:  # pylint:disable=too-few-public-methods
+    """Stand in for RideSystemsInterface that takes a while to answer, and tracks how many requests are in flight"""
+    latency = 0.1
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+    calls: List[Tuple[date, date]] = []
+    logins = 0
+
+    def __init__(self, *_):
+        with self.lock:
+            FakeRideSystems.logins += 1
+
+    def get_runtimes(self, start_date: date, end_date: date) -> pd.DataFrame:
+        """Returns one runtime for each day in the range"""
+        with self.lock:
+            FakeRideSystems.calls.append((start_date, end_date))
+            FakeRideSystems.in_flight += 1
+            FakeRideSystems.max_in_flight = max(FakeRideSystems.max_in_flight, FakeRideSystems.in_flight)
+        time.sleep(self.latency)
+        with self.lock:
+            FakeRideSystems.in_flight -= 1
+
+        days = pd.date_range(start_date, end_date)
+        return pd.DataFrame({'route': 'Purple', 'vehicle': 'CC1211', 'start_time': days + pd.Timedelta(hours=6),
+                             'end_time': days + pd.Timedelta(hours=7)})
+
+
+@patch('transitstat.circulator.reports.RideSystemsInterface', FakeRideSystems)
+def test_get_vehicle_assignments_workers(conn_str):
+    """Test that get_vehicle_assignments downloads days concurrently and writes all of them"""
+    FakeRideSystems.logins = 0
+    inst = RidesystemReports(conn_str, 'username', 'superdupersecretpassword', workers=4, max_span=1)
+    date_start = date(2022, 3, 1)
+    date_end = date(2022, 3, 8)
+
+    inst.get_vehicle_assignments(date_start, date_end)
+
+    assert FakeRideSystems.max_in_flight > 1
+    with Session(bind=inst.engine, future=True) as session:
+        assert session.query(CirculatorBusRuntimes).count() == 8
+    assert len(inst.get_dates_to_process(date_start, date_end, CirculatorBusRuntimes.starttime)) == 0
+
+    # The worker sessions are kept for the next load instead of logging in for each download
+    inst.get_vehicle_assignments(date_start, date_end, force=True)
+    assert 1 < FakeRideSystems.logins <= inst.workers
+
+
+@patch('transitstat.circulator.reports.RideSystemsInterface', FakeRideSystems)
+def test_get_vehicle_assignments_ranges(conn_str):
+    """Test that consecutive missing days are requested together"""
+    FakeRideSystems.calls = []
+    inst = RidesystemReports(conn_str, 'username', 'superdupersecretpassword', max_span=3)
+
+    inst.get_vehicle_assignments(date(2022, 3, 1), date(2022, 3, 7))
+
+    assert FakeRideSystems.calls == [(date(2022, 3, 7), date(2022, 3, 7)), (date(2022, 3, 4), date(2022, 3, 6)),
+                                     (date(2022, 3, 1), date(2022, 3, 3))]
+    assert len(inst.get_dates_to_process(date(2022, 3, 1), date(2022, 3, 7), CirculatorBusRuntimes.starttime)) == 0
+
+
+@patch('transitstat.circulator.reports.RideSystemsInterface', FakeRideSystems)
+def test_get_vehicle_assignments_cache(conn_str, tmp_path_factory):
+    """Test that a forced reload reads the days from the report cache instead of Ridesystems"""
+    FakeRideSystems.calls = []
+    cache = ReportCache(tmp_path_factory.mktemp('cache'))
+    inst = RidesystemReports(conn_str, 'username', 'superdupersecretpassword', max_span=3, cache=cache)
+
+    inst.get_vehicle_assignments(date(2022, 3, 1), date(2022, 3, 3))
+    inst.get_vehicle_assignments(date(2022, 3, 1), date(2022, 3, 3), force=True)
+    assert FakeRideSystems.calls == [(date(2022, 3, 1), date(2022, 3, 3))]
+
+    # Only the day that isn't cached yet is downloaded
+    inst.get_vehicle_assignments(date(2022, 3, 1), date(2022, 3, 4), force=True)
+    assert FakeRideSystems.calls[1:] == [(date(2022, 3, 4), date(2022, 3, 4))]
+    with Session(bind=inst.engine, future=True) as session:
+        assert session.query(CirculatorBusRuntimes).count() == 4
+
+
+@patch('transitstat.circulator.reports.RideSystemsInterface', FakeRideSystems)
+def test_get_vehicle_assignments_unchanged(conn_str):
+    """Test that reloading the same report doesn't write the rows again, unless the reload is forced"""
+    inst = RidesystemReports(conn_str, 'username', 'superdupersecretpassword')
+    days = [date(2022, 3, i) for i in range(1, 4)]
+    inst.get_vehicle_assignments(days[0], days[-1])
+    with patch('transitstat.circulator.reports.bulk_merge', wraps=bulk_merge) as mocked_merge:
+        inst._load(RUNTIME_REPORT, days)  # pylint:disable=protected-access
+        assert all(not call.args[1] for call in mocked_merge.call_args_list)
+    assert inst.ledger.statuses(CirculatorBusRuntimes.__tablename__) == {
+        f'2022-03-0{i}': 'done' for i in range(1, 4)}
+
+    # A forced reload of days that still match their hashes is diffed too
+    metrics.reset()
+    with patch('transitstat.circulator.reports.bulk_merge', wraps=bulk_merge) as mocked_merge:
+        inst.get_vehicle_assignments(days[0], days[-1], force=True)
+        assert all(not call.args[1] for call in mocked_merge.call_args_list)
+    assert metrics.summary('test')['counters'][f'{CirculatorBusRuntimes.__tablename__}.rows_unchanged'] == 3
+
+    # The hashes still describe the deleted rows, so only a forced reload brings them back
+    with Session(bind=inst.engine, future=True) as session, session.begin():
+        session.execute(delete(CirculatorBusRuntimes))
+    inst.get_vehicle_assignments(days[0], days[-1], force=True)
+    with Session(bind=inst.engine, future=True) as session:
+        assert session.query(CirculatorBusRuntimes).count() == 3
+
+
+@patch('transitstat.circulator.reports.RideSystemsInterface', FakeRideSystems)
+def test_get_vehicle_assignments_replace(conn_str):
+    """Test that a forced reload in replace mode removes the rows that are no longer in the report"""
+    inst = RidesystemReports(conn_str, 'username', 'superdupersecretpassword', mode=REPLACE)
+    inst.get_vehicle_assignments(date(2022, 3, 1), date(2022, 3, 3))
+    bulk_merge(CirculatorBusRuntimes, [{'busid': 'CC1200', 'route': 'Green', 'starttime': datetime(2022, 3, 2, 8),
+                                        'endtime': datetime(2022, 3, 2, 9)}], inst.engine)
+
+    inst.get_vehicle_assignments(date(2022, 3, 2), date(2022, 3, 2), force=True)
+    with Session(bind=inst.engine, future=True) as session:
+        assert session.query(CirculatorBusRuntimes).count() == 3
+        assert session.get(CirculatorBusRuntimes, ('CC1200', datetime(2022, 3, 2, 8))) is None
+
+    with pytest.raises(ValueError):
+        RidesystemReports(conn_str, 'username', 'superdupersecretpassword', mode='upsert')
+
+
+@patch('transitstat.circulator.reports.RideSystemsInterface')
+def test_no_login_without_work(mocked_rs_cls, conn_str):
+    """Test that a run that finds every day already loaded never logs in to Ridesystems"""
+    inst = RidesystemReports(conn_str, 'username', 'superdupersecretpassword')
+    bulk_merge(CirculatorBusRuntimes, [{'busid': 'CC1200', 'route': 'Green', 'starttime': datetime(2022, 3, 2, 8),
+                                        'endtime': datetime(2022, 3, 2, 9)}], inst.engine)
+
+    inst.get_vehicle_assignments(date(2022, 3, 2), date(2022, 3, 2))
+    mocked_rs_cls.assert_not_called()
+
+
+def test_get_date_ranges():
+    """Test get_date_ranges"""
+    dates = [date(2022, 3, 1), date(2022, 3, 2), date(2022, 3, 3), date(2022, 3, 5), date(2022, 3, 2)]
+    assert get_date_ranges(dates, 7) == [(date(2022, 3, 5), date(2022, 3, 5)), (date(2022, 3, 1), date(2022, 3, 3))]
+    assert get_date_ranges(dates, 2) == [(date(2022, 3, 5), date(2022, 3, 5)), (date(2022, 3, 3), date(2022, 3, 3)),
+                                         (date(2022, 3, 1), date(2022, 3, 2))]
+    assert not get_date_ranges([], 7)
+
+
+@patch('transitstat.circulator.reports.RideSystemsInterface')
+def test_get_dates_to_process_range(_, conn_str):
+    """Test that get_dates_to_process only looks at data inside the date range"""
+    inst = RidesystemReports(conn_str, 'username', 'superdupersecretpassword')
+    bulk_merge(CirculatorRidership, [
+        {'vehicle': 'CC1211', 'route': 'Purple', 'stop': 'Penn Station', 'datetime': datetime(2022, 3, day, 23, 59)}
+        for day in (1, 3, 5)], inst.engine)
+
+    assert inst.get_dates_to_process(date(2022, 3, 2), date(2022, 3, 4), CirculatorRidership.datetime) == \
+        [date(2022, 3, 4), date(2022, 3, 2)]
+    assert not inst.get_dates_to_process(date(2022, 3, 1), date(2022, 3, 1), CirculatorRidership.datetime)
+
+
+@patch('transitstat.circulator.reports.RideSystemsInterface')
+def test_get_dates_to_process_ledger(_, conn_str):
+    """Test that days the ledger knows were not finished are processed again, even if they have data"""
+    inst = RidesystemReports(conn_str, 'username', 'superdupersecretpassword')
+    bulk_merge(CirculatorRidership, [
+        {'vehicle': 'CC1211', 'route': 'Purple', 'stop': 'Penn Station', 'datetime': datetime(2022, 3, day, 12)}
+        for day in (1, 2)], inst.engine)
+
+    with pytest.raises(ValueError):
+        with inst.ledger.track(CirculatorRidership.__tablename__, '2022-03-01'):
+            raise ValueError('Lost the database connection')
+    with inst.ledger.track(CirculatorRidership.__tablename__, '2022-03-03'):
+        pass
+
+    assert inst.get_dates_to_process(date(2022, 3, 1), date(2022, 3, 4), CirculatorRidership.datetime) == \
+        [date(2022, 3, 4), date(2022, 3, 1)]
@@ -0,0 +1,111 @@
+"""Test suite for transitstat.circulator.rollups"""
+from datetime import date, datetime, time
+
+import pandas as pd  # type: ignore
+from sqlalchemy.orm import Session  # type: ignore
+
+from transitstat._merge import bulk_merge
+from transitstat.circulator.rollups import day_runs, lateness, otp_rollups, query_ridership, refresh_otp_rollups, \
+    refresh_ridership_rollups
+from transitstat.circulator.schema import Base, CirculatorArrival, CirculatorOtpDaily, CirculatorOtpDailyStatus, \
+    CirculatorRidership, CirculatorRidershipHourly
+from transitstat.database import ensure_schema, get_engine
+
+
+def _arrival(day, scheduled, actual, status, stop='Stop 1'):
+    return CirculatorArrival(date=date(2022, 3, day), route='Purple', stop=stop, block_id='P_1',
+                             scheduled_arrival_time=scheduled, actual_arrival_time=actual, on_time_status=status)
+
+
+def test_refresh_otp_rollups(conn_str):
+    """Test that the rollups are computed for the dates, and replaced when they are refreshed"""
+    engine = get_engine(conn_str)
+    ensure_schema(engine, Base.metadata)
+    bulk_merge(CirculatorArrival, [_arrival(1, time(8, 0), time(8, 1), 'On Time'),
+                                   _arrival(1, time(8, 15), time(8, 25), 'Late'),
+                                   _arrival(1, time(8, 30), time(8, 28), 'Early'),
+                                   _arrival(1, time(8, 45), None, None),
+                                   _arrival(2, time(8, 0), time(8, 0), 'On Time', stop=None)], engine)
+
+    assert refresh_otp_rollups(engine, [date(2022, 3, 1), date(2022, 3, 2)]) == 2
+    with Session(bind=engine, future=True) as session:
+        daily = session.get(CirculatorOtpDaily, (date(2022, 3, 1), 'Purple', 'Stop 1', 'P_1'))
+        assert daily.arrivals == 4
+        assert daily.lateness_mean == (60 + 600 - 120) / 3
+        assert daily.lateness_median == 60
+        assert session.get(CirculatorOtpDaily, (date(2022, 3, 2), 'Purple', '', 'P_1')).lateness_mean == 0
+        assert {i.on_time_status: i.arrivals for i in session.query(CirculatorOtpDailyStatus)
+                .filter(CirculatorOtpDailyStatus.date == date(2022, 3, 1))} == {'On Time': 1, 'Late': 1, 'Early': 1}
+
+    # Only the refreshed day changes
+    with engine.begin() as connection:
+        connection.execute(CirculatorArrival.__table__.delete().where(CirculatorArrival.on_time_status == 'Late'))
+        connection.execute(CirculatorArrival.__table__.delete().where(CirculatorArrival.date == date(2022, 3, 2)))
+    refresh_otp_rollups(engine, [date(2022, 3, 1)])
+    with Session(bind=engine, future=True) as session:
+        assert session.query(CirculatorOtpDailyStatus).count() == 3
+        assert session.get(CirculatorOtpDaily, (date(2022, 3, 1), 'Purple', 'Stop 1', 'P_1')).arrivals == 3
+        assert session.get(CirculatorOtpDaily, (date(2022, 3, 2), 'Purple', '', 'P_1')) is not None
+
+
+def test_otp_rollups_long_stop():
+    """Test that long stop names that share a beginning stay separate stops"""
+    assert CirculatorOtpDaily.__table__.c.stop.type.length == CirculatorArrival.__table__.c.stop.type.length
+    assert CirculatorOtpDailyStatus.__table__.c.stop.type.length == CirculatorArrival.__table__.c.stop.type.length
+
+    stops = ['x' * 150 + ' North', 'x' * 150 + ' South']
+    arrivals = pd.DataFrame([{c.name: getattr(i, c.name) for c in CirculatorArrival.__table__.columns} for i in
+                             [_arrival(1, time(8, 0), time(8, 1), 'On Time', stop=stops[0]),
+                              _arrival(1, time(8, 15), time(8, 25), 'Late', stop=stops[1])]])
+    daily, daily_status = otp_rollups(arrivals)
+    assert daily['stop'].tolist() == stops
+    assert daily['arrivals'].tolist() == [1, 1]
+    assert daily_status['stop'].tolist() == stops
+
+
+def test_lateness():
+    """Test lateness, including arrivals on the other side of midnight"""
+    arrivals = pd.DataFrame({'scheduled_arrival_time': [time(8, 0), time(23, 59), time(0, 1), time(8, 0)],
+                             'actual_arrival_time': [time(8, 2), time(0, 1), time(23, 59), None]})
+    assert lateness(arrivals).tolist()[:3] == [120, 120, -120]
+    assert pd.isna(lateness(arrivals)[3])
+
+
+def test_day_runs():
+    """Test that consecutive days are collapsed into runs"""
+    assert day_runs([date(2022, 3, 1), date(2022, 3, 2), date(2022, 3, 4), date(2022, 3, 31), date(2022, 4, 1)]) == [
+        (date(2022, 3, 1), date(2022, 3, 2)), (date(2022, 3, 4), date(2022, 3, 4)),
+        (date(2022, 3, 31), date(2022, 4, 1))]
+    assert not day_runs([])
+
+
+def test_refresh_ridership_rollups(conn_str):
+    """Test the hourly ridership rollup, and querying it"""
+    engine = get_engine(conn_str)
+    ensure_schema(engine, Base.metadata)
+    bulk_merge(CirculatorRidership, [
+        CirculatorRidership(vehicle='CC1201', route='Purple', stop='Penn Station', datetime=datetime(2022, 3, 1, 8, 5),
+                            boardings=3, alightings=1),
+        CirculatorRidership(vehicle='CC1202', route='Purple', stop='Penn Station', datetime=datetime(2022, 3, 1, 8, 50),
+                            boardings=4, alightings=0),
+        CirculatorRidership(vehicle='CC1201', route='Purple', stop='City Hall', datetime=datetime(2022, 3, 1, 9, 5),
+                            boardings=1, alightings=5),
+        CirculatorRidership(vehicle='CC1203', route='Orange', stop='City Hall', datetime=datetime(2022, 3, 2, 9, 5),
+                            boardings=2, alightings=2),
+        CirculatorRidership(vehicle='CC1203', route='Orange', stop='City Hall', datetime=datetime(2022, 3, 3, 9, 5),
+                            boardings=6, alightings=6),
+    ], engine)
+
+    # March 2nd is between the days that are refreshed, but it isn't read so it is left out
+    assert refresh_ridership_rollups(engine, [date(2022, 3, 1), date(2022, 3, 3)]) == 3
+    with Session(bind=engine, future=True) as session:
+        hourly = session.get(CirculatorRidershipHourly, (date(2022, 3, 1), 8, 'Purple', 'Penn Station'))
+        assert (hourly.boardings, hourly.alightings) == (7, 1)
+        assert session.query(CirculatorRidershipHourly).filter(CirculatorRidershipHourly.date == date(2022, 3, 2)) \
+            .count() == 0
+
+    ret = query_ridership(engine, date(2022, 3, 1), date(2022, 3, 3))
+    assert ret.to_dict('records') == [{'date': date(2022, 3, 1), 'route': 'Purple', 'boardings': 8, 'alightings': 6},
+                                      {'date': date(2022, 3, 3), 'route': 'Orange', 'boardings': 6, 'alightings': 6}]
+    ret = query_ridership(engine, date(2022, 3, 1), date(2022, 3, 1), group_by=['hour'], stops=['City Hall'])
+    assert ret.to_dict('records') == [{'hour': 9, 'boardings': 1, 'alightings': 5}]
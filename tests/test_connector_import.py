@@ -3,10 +3,12 @@ import shutil
 from datetime import date
 from pathlib import Path
 
+import pandas as pd  # type: ignore
 from sqlalchemy.orm import Session  # type: ignore
 
-from transitstat.connector.data_import import parse_args
+from transitstat.connector.data_import import ConnectorImport, _parse_dates, parse_args
 from transitstat.connector.schema import HcRidership
+from transitstat.ledger import FAILED, file_hash
 
 
 def test_parse_sheets(tmp_path_factory, connector_import):
@@ -33,5 +35,61 @@ def test_parse_sheets(tmp_path_factory, connector_import):
 def test_parse_args():
     """Tests parse_args"""
     path_str = 'path_str'
-    args = parse_args(['-p', path_str])
+    args = parse_args(['-p', path_str, '--jobs', '2'])
     assert args.path == path_str
+    assert args.jobs == 2
+
+
+def test_import_path(tmp_path_factory, connector_import):
+    """Test for import_path, including skipping files that were already imported"""
+    tmp_path = tmp_path_factory.mktemp('data')
+    shutil.copy(Path(__file__).parent / 'data' / 'HC2 03.2022.xlsx', tmp_path)
+    assert connector_import.import_path(tmp_path)
+
+    with Session(bind=connector_import.engine, future=True) as session:
+        assert session.query(HcRidership).count() == 3
+        session.query(HcRidership).delete()
+        session.commit()
+
+    assert connector_import.import_path(tmp_path / 'HC2 03.2022.xlsx')
+    with Session(bind=connector_import.engine, future=True) as session:
+        assert session.query(HcRidership).count() == 0
+
+    # A report without the route in its name is marked as failed
+    notes = tmp_path / 'notes.xlsx'
+    shutil.copy(Path(__file__).parent / 'data' / 'HC3 08-2021.xlsx', notes)
+    assert not connector_import.import_path(notes)
+    unit = file_hash(notes)
+    assert connector_import.ledger.statuses(HcRidership.__tablename__, unit, unit) == {unit: FAILED}
+
+
+def test_parse_sheets_jobs(tmp_path_factory, conn_str):
+    """Test for parse_sheets with the reports parsed in worker processes"""
+    tmp_path = tmp_path_factory.mktemp('data')
+    shutil.copy(Path(__file__).parent / 'data' / 'HC2 03.2022.xlsx', tmp_path)
+    shutil.copy(Path(__file__).parent / 'data' / 'HC2 03.2022.xlsx', tmp_path / 'HC3 03.2022.xlsx')
+    sheets = ConnectorImport(conn_str, jobs=2).parse_sheets(tmp_path)
+    assert sorted(sheets.keys()) == [2, 3]
+    assert sheets[2] == sheets[3] == {date(2022, 3, 2): 69, date(2022, 3, 3): 55, date(2022, 3, 4): 34}
+
+
+def test_parse_frames(tmp_path_factory, connector_import):
+    """Test for parse_frames, and inserting its result"""
+    tmp_path = tmp_path_factory.mktemp('data')
+    shutil.copy(Path(__file__).parent / 'data' / 'HC2 03.2022.xlsx', tmp_path)
+    ridership = connector_import.parse_frames(tmp_path)
+    assert ridership.to_dict('records') == [{'route_id': 2, 'date': date(2022, 3, 2), 'riders': 69},
+                                            {'route_id': 2, 'date': date(2022, 3, 3), 'riders': 55},
+                                            {'route_id': 2, 'date': date(2022, 3, 4), 'riders': 34}]
+
+    assert connector_import.insert_into_db(ridership) == 3
+
+
+def test_parse_dates():
+    """Test for _parse_dates with text that doesn't all have the same format"""
+    ret = _parse_dates(pd.Series(['2022-03-02 00:00:00', '2022-03-03 00:00:00', 'March 4, 2022', 'not a date']))
+    assert list(ret.dt.date[:3]) == [date(2022, 3, 2), date(2022, 3, 3), date(2022, 3, 4)]
+    assert pd.isna(ret[3])
+
+    ret = _parse_dates(pd.Series(['03/02/2022', '2022-03-03']))
+    assert list(ret.dt.date) == [date(2022, 3, 2), date(2022, 3, 3)]
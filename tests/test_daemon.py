@@ -0,0 +1,104 @@
+"""Test suite for transitstat.daemon"""
+import json
+import shutil
+from concurrent.futures import wait
+from datetime import date, datetime, time
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy.orm import Session  # type: ignore
+
+from transitstat.circulator.schema import CirculatorBusRuntimes
+from transitstat.connector.schema import HcRidership
+from transitstat.daemon import Daemon, DaemonConfig, next_run, parse_args
+from transitstat.metrics import metrics
+from .test_circulator_reports import FakeRideSystems
+
+
+def test_next_run():
+    """Test for next_run"""
+    assert next_run(datetime(2022, 3, 1, 2, 0), time(3)) == datetime(2022, 3, 1, 3, 0)
+    assert next_run(datetime(2022, 3, 1, 3, 0), time(3)) == datetime(2022, 3, 2, 3, 0)
+
+
+def test_watch_directory(tmp_path_factory, conn_str):
+    """Test that files are imported once they stop changing, and only once"""
+    tmp_path = tmp_path_factory.mktemp('connector')
+    daemon = Daemon(DaemonConfig(conn_str, connector_dir=tmp_path, reports=[]))
+    shutil.copy(Path(__file__).parent / 'data' / 'HC2 03.2022.xlsx', tmp_path)
+    (tmp_path / 'notes.txt').write_text('Not a report')
+
+    # The first poll only sees the file, in case it is still being copied
+    assert not daemon.tick(datetime.now())
+    wait(daemon.tick(datetime.now()))
+    assert not daemon.tick(datetime.now())
+
+    with Session(bind=daemon._connector.engine, future=True) as session:  # pylint:disable=protected-access
+        assert session.query(HcRidership).count() == 3
+    daemon.executor.shutdown()
+
+
+@patch('transitstat.circulator.reports.RideSystemsInterface', FakeRideSystems)
+def test_reports(conn_str):
+    """Test that the reports are pulled when they are due, and scheduled for the next day"""
+    FakeRideSystems.calls = []
+    daemon = Daemon(DaemonConfig(conn_str, reports=['runtimes'], lookback=3, report_time=time(3)))
+    assert not daemon.tick(datetime(2022, 3, 5, 2, 59))
+
+    daemon.next_reports['runtimes'] = datetime(2022, 3, 5, 3, 0)
+    wait(daemon.tick(datetime(2022, 3, 5, 3, 0)))
+    assert FakeRideSystems.calls == [(date(2022, 3, 2), date(2022, 3, 4))]
+    assert daemon.next_reports['runtimes'] == datetime(2022, 3, 6, 3, 0)
+    with Session(bind=daemon._reports.engine, future=True) as session:  # pylint:disable=protected-access
+        assert session.query(CirculatorBusRuntimes).count() == 3
+    daemon.executor.shutdown()
+
+
+@patch('transitstat.circulator.reports.RideSystemsInterface', FakeRideSystems)
+def test_reports_one_job(conn_str):
+    """Test that the due reports are pulled in one job, and that a report that fails doesn't stop the others"""
+    FakeRideSystems.calls = []
+    metrics.reset()
+    daemon = Daemon(DaemonConfig(conn_str, reports=['otp', 'runtimes'], lookback=3))
+    daemon.next_reports = {'otp': datetime(2022, 3, 5, 3, 0), 'runtimes': datetime(2022, 3, 5, 3, 0)}
+    started = daemon.tick(datetime(2022, 3, 5, 3, 0))
+    # The fake doesn't have get_otp, so that pull fails
+    assert len(started) == 1
+    wait(started)
+    assert FakeRideSystems.calls == [(date(2022, 3, 2), date(2022, 3, 4))]
+    assert metrics.summary('test')['counters']['daemon.failures'] == 1
+    daemon.executor.shutdown()
+
+
+@patch('transitstat.circulator.reports.RideSystemsInterface', FakeRideSystems)
+def test_emit_metrics(conn_str, tmp_path_factory):
+    """Test that the metrics are emitted per interval, and start over after each one"""
+    tmp_path = tmp_path_factory.mktemp('metrics')
+    metrics.reset()
+    daemon = Daemon(DaemonConfig(conn_str, reports=['runtimes'], lookback=1, run_now=True,
+                                 metrics_json=str(tmp_path / 'daemon.json')))
+    wait(daemon.tick(datetime.now()))
+    daemon.emit_metrics()
+    summary = json.loads((tmp_path / 'daemon.json').read_text())
+    assert summary['stages']['daemon.reports']['calls'] == 1
+    assert not metrics.stages and not metrics.queries
+
+    # A quiet interval doesn't overwrite the last summary
+    daemon.emit_metrics()
+    assert json.loads((tmp_path / 'daemon.json').read_text()) == summary
+    daemon.executor.shutdown()
+
+
+def test_parse_args(tmp_path_factory):
+    """Test for parse_args"""
+    tmp_path = tmp_path_factory.mktemp('drop')
+    args = parse_args(['-w', '4', '--report_time', '04:30', '--reports', 'otp', '--connector_dir', str(tmp_path)])
+    assert args.workers == 4
+    assert args.report_time == time(4, 30)
+    assert args.reports == ['otp']
+    assert args.connector_dir == tmp_path
+    assert args.ridership_dir is None
+
+    with pytest.raises(SystemExit):
+        parse_args(['--profile'])
@@ -0,0 +1,44 @@
+"""Test suite for transitstat.database"""
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, inspect  # type: ignore
+
+from transitstat.connector.schema import Base
+from transitstat.database import _engine_options, ensure_schema, get_engine
+
+
+def test_get_engine(tmp_path_factory):
+    """Test that get_engine returns one engine per connection string"""
+    tmp_path = tmp_path_factory.mktemp('data')
+    engine = get_engine(f'sqlite:///{tmp_path / "one.db"}')
+    assert get_engine(f'sqlite:///{tmp_path / "one.db"}') is engine
+    assert get_engine(f'sqlite:///{tmp_path / "two.db"}') is not engine
+    assert not engine.echo
+
+
+def test_engine_options():
+    """Test the dialect specific engine settings"""
+    assert not _engine_options('sqlite:///transitstat.db')
+    assert _engine_options('mssql+pyodbc://server/DOT_DATA?driver=ODBC Driver 17 for SQL Server')['fast_executemany']
+    assert 'fast_executemany' not in _engine_options('postgresql://server/dot_data')
+
+
+def test_ensure_schema(tmp_path_factory):
+    """Test that ensure_schema only creates the schema when it is missing"""
+    tmp_path = tmp_path_factory.mktemp('data')
+    engine = get_engine(f'sqlite:///{tmp_path / "schema.db"}')
+    assert ensure_schema(engine, Base.metadata)
+    assert set(Base.metadata.tables) <= set(inspect(engine).get_table_names())
+    assert not ensure_schema(engine, Base.metadata)
+
+    # Another engine for the same database, like in a new process, finds that the tables are already there
+    assert not ensure_schema(create_engine(f'sqlite:///{tmp_path / "schema.db"}', future=True), Base.metadata)
+
+
+def test_ensure_schema_threads(tmp_path_factory):
+    """Test that the schema is only created once when several threads ensure it at the same time"""
+    tmp_path = tmp_path_factory.mktemp('data')
+    engine = get_engine(f'sqlite:///{tmp_path / "threads.db"}')
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        created = list(executor.map(lambda _: ensure_schema(engine, Base.metadata), range(4)))
+    assert created.count(True) == 1
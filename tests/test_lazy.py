@@ -0,0 +1,10 @@
+"""Test suite for transitstat._lazy"""
+from transitstat._lazy import LazyModule
+
+
+def test_lazy_module():
+    """Test that attributes come from the module, and are kept once they are looked up"""
+    module = LazyModule('json')
+    assert 'dumps' not in vars(module)
+    assert module.dumps([1]) == '[1]'
+    assert 'dumps' in vars(module)
@@ -0,0 +1,43 @@
+"""Test suite for transitstat.ledger"""
+import pytest
+from sqlalchemy import create_engine  # type: ignore
+from sqlalchemy.orm import Session  # type: ignore
+
+from transitstat.ledger import DONE, FAILED, IngestLedger, Ledger, file_hash
+
+
+def test_ledger(conn_str):
+    """Test tracking units through the ledger"""
+    ledger = Ledger(create_engine(conn_str, echo=True, future=True), 'test')
+
+    with ledger.track('report', '2022-03-01') as entry:
+        entry.rows = 10
+
+    with pytest.raises(ValueError):
+        with ledger.track('report', '2022-03-02'):
+            raise ValueError('Bad data')
+
+    assert ledger.is_done('report', '2022-03-01')
+    assert not ledger.is_done('report', '2022-03-02')
+    assert not ledger.is_done('report', '2022-03-03')
+    assert not ledger.is_done('other_report', '2022-03-01')
+    assert ledger.statuses('report') == {'2022-03-01': DONE, '2022-03-02': FAILED}
+    assert ledger.statuses('report', '2022-03-02', '2022-03-31') == {'2022-03-02': FAILED}
+
+    with Session(bind=ledger.engine, future=True) as session:
+        ret = session.get(IngestLedger, ('test', 'report', '2022-03-01'))
+        assert ret.rows == 10
+        assert ret.finished >= ret.started
+        assert session.get(IngestLedger, ('test', 'report', '2022-03-02')).detail == 'Bad data'
+
+    ledger.fail('report', '2022-03-03', 'Unreadable file')
+    assert ledger.statuses('report', '2022-03-03') == {'2022-03-03': FAILED}
+
+
+def test_file_hash(tmp_path):
+    """Test file_hash"""
+    (tmp_path / 'a.txt').write_text('transitstat')
+    (tmp_path / 'b.txt').write_text('transitstat')
+    (tmp_path / 'c.txt').write_text('transitstat2')
+    assert file_hash(tmp_path / 'a.txt') == file_hash(tmp_path / 'b.txt')
+    assert file_hash(tmp_path / 'a.txt') != file_hash(tmp_path / 'c.txt')
@@ -0,0 +1,133 @@
+"""Test suite for transitstat._merge"""
+from datetime import date
+from typing import List
+from unittest.mock import MagicMock
+
+import pandas as pd  # type: ignore
+import pytest
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine  # type: ignore
+from sqlalchemy.dialects import mssql  # type: ignore
+from sqlalchemy.orm import Session  # type: ignore
+
+from transitstat._merge import _merge_mssql, _replace_records, bulk_merge, bulk_replace, MergeResult, ReplaceResult
+from transitstat.connector.schema import Base, HcRidership
+
+
+def test_bulk_merge(conn_str):
+    """Test bulk_merge with mapped objects, including updates and duplicated keys"""
+    engine = create_engine(conn_str, echo=True, future=True)
+    with engine.begin() as connection:
+        Base.metadata.create_all(connection)
+
+    ret = bulk_merge(HcRidership, [HcRidership(route_id=1, date=date(2022, 3, i), riders=i) for i in range(1, 11)],
+                     engine)
+    assert ret == MergeResult(inserted=10, updated=0)
+
+    ret = bulk_merge(HcRidership, [HcRidership(route_id=1, date=date(2022, 3, 1), riders=100),
+                                   HcRidership(route_id=1, date=date(2022, 3, 1), riders=200),
+                                   HcRidership(route_id=2, date=date(2022, 3, 1), riders=300)], engine)
+    assert ret == MergeResult(inserted=1, updated=1)
+
+    with Session(bind=engine, future=True) as session:
+        assert session.query(HcRidership).count() == 11
+        assert session.get(HcRidership, (1, date(2022, 3, 1))).riders == 200
+        assert session.get(HcRidership, (1, date(2022, 3, 2))).riders == 2
+
+
+def test_bulk_merge_dataframe(conn_str):
+    """Test bulk_merge with a DataFrame"""
+    engine = create_engine(conn_str, echo=True, future=True)
+    with engine.begin() as connection:
+        Base.metadata.create_all(connection)
+
+    df = pd.DataFrame({'route_id': [1, 1, 2], 'date': [date(2022, 3, 1), date(2022, 3, 2), date(2022, 3, 1)],
+                       'riders': [1, None, 3]})
+    assert bulk_merge(HcRidership, df, engine) == MergeResult(inserted=3, updated=0)
+    assert bulk_merge(HcRidership, df.iloc[0:0], engine) == MergeResult()
+
+    with Session(bind=engine, future=True) as session:
+        assert session.get(HcRidership, (1, date(2022, 3, 2))).riders is None
+
+
+def test_bulk_merge_chunks(conn_str):
+    """Test bulk_merge with the rows split into chunks"""
+    engine = create_engine(conn_str, echo=True, future=True)
+    with engine.begin() as connection:
+        Base.metadata.create_all(connection)
+
+    rows = [HcRidership(route_id=1, date=date(2022, 3, i), riders=i) for i in range(1, 11)]
+    assert bulk_merge(HcRidership, rows[:4], engine) == MergeResult(inserted=4, updated=0)
+    assert bulk_merge(HcRidership, rows, engine, chunk_size=3) == MergeResult(inserted=6, updated=4)
+
+
+def test_bulk_replace(conn_str):
+    """Test that bulk_replace swaps out just the slice, and leaves it alone if the transaction fails"""
+    engine = create_engine(conn_str, echo=True, future=True)
+    with engine.begin() as connection:
+        Base.metadata.create_all(connection)
+
+    bulk_merge(HcRidership, [HcRidership(route_id=route_id, date=date(2022, 3, i), riders=i)
+                             for route_id in (1, 2) for i in range(1, 4)], engine)
+    rows = [{'route_id': 1, 'date': date(2022, 3, 2), 'riders': 20}]
+    assert bulk_replace(HcRidership, rows, engine, HcRidership.date == date(2022, 3, 2)) == \
+        ReplaceResult(deleted=2, inserted=1)
+
+    with Session(bind=engine, future=True) as session:
+        assert session.query(HcRidership).count() == 5
+        assert session.get(HcRidership, (1, date(2022, 3, 2))).riders == 20
+        assert session.get(HcRidership, (2, date(2022, 3, 2))) is None
+
+    with pytest.raises(ValueError):
+        with engine.begin() as connection:
+            bulk_replace(HcRidership, [], connection, HcRidership.date == date(2022, 3, 1))
+            raise ValueError('Lost the database connection')
+    with Session(bind=engine, future=True) as session:
+        assert session.query(HcRidership).filter(HcRidership.date == date(2022, 3, 1)).count() == 2
+
+
+class MssqlConnection:  # pylint:disable=too-few-public-methods
+    """Stands in for a Sql Server connection, and records the statements it is given compiled for that dialect"""
+
+    def __init__(self):
+        self.dialect = mssql.dialect()
+        self.statements: List[str] = []
+
+    def execute(self, statement, *_):
+        """Compiles the statement instead of running it"""
+        self.statements.append(str(statement.compile(dialect=self.dialect)))
+        return MagicMock(rowcount=1)
+
+
+IDENTITY_TABLE = Table('identity_test', MetaData(), Column('id', Integer, primary_key=True), Column('name', String(10)))
+
+
+def _staging(table):
+    return Table(f'#stage_{table.name}', MetaData(), *[Column(column.name, column.type) for column in table.columns])
+
+
+def test_merge_mssql():
+    """Test the Sql Server MERGE, which turns on IDENTITY_INSERT only for tables with an identity column"""
+    connection = MssqlConnection()
+    _merge_mssql(connection, HcRidership.__table__, _staging(HcRidership.__table__))
+    assert len(connection.statements) == 1
+    assert connection.statements[0].startswith(f'MERGE INTO {HcRidership.__tablename__} WITH (HOLDLOCK)')
+
+    connection = MssqlConnection()
+    _merge_mssql(connection, IDENTITY_TABLE, _staging(IDENTITY_TABLE))
+    assert [i.split(' ')[0] for i in connection.statements] == ['SET', 'MERGE', 'SET']
+    assert connection.statements[0] == 'SET IDENTITY_INSERT identity_test ON'
+    assert connection.statements[2] == 'SET IDENTITY_INSERT identity_test OFF'
+
+
+def test_replace_records_mssql():
+    """Test that bulk_replace on Sql Server turns on IDENTITY_INSERT only for tables with an identity column"""
+    connection = MssqlConnection()
+    assert _replace_records(connection, HcRidership.__table__, HcRidership.date == date(2022, 3, 1),
+                            [{'route_id': 1, 'date': date(2022, 3, 1), 'riders': 5}], None) == \
+        ReplaceResult(deleted=1, inserted=1)
+    assert [i.split(' ')[0] for i in connection.statements] == ['DELETE', 'INSERT']
+
+    connection = MssqlConnection()
+    _replace_records(connection, IDENTITY_TABLE, IDENTITY_TABLE.c.id == 1, [{'id': 1, 'name': 'a'}], None)
+    assert [i.split(' ')[0] for i in connection.statements] == ['DELETE', 'SET', 'INSERT', 'SET']
+    assert connection.statements[1] == 'SET IDENTITY_INSERT identity_test ON'
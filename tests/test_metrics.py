@@ -0,0 +1,83 @@
+"""Test suite for transitstat.metrics"""
+import json
+import threading
+from pathlib import Path
+
+from sqlalchemy import create_engine, text  # type: ignore
+
+from transitstat.circulator.otp_reports import read_operator_report
+from transitstat.metrics import Metrics, metrics, to_prometheus
+
+
+def test_stage():
+    """Test that stages record their calls, rows and the queries made while they run"""
+    run = Metrics()
+    engine = create_engine('sqlite://', future=True)
+    run.watch(engine)
+    with run.stage('test.write') as stage, engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+        connection.execute(text('SELECT 2'))
+        stage.rows = 10
+    with run.stage('test.write'):
+        pass
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 3'))
+
+    run.count('test.retries')
+    run.count('test.retries', 2)
+    summary = run.summary('test')
+    assert summary['stages']['test.write']['calls'] == 2
+    assert summary['stages']['test.write']['rows'] == 10
+    assert summary['stages']['test.write']['queries'] == 2
+    assert summary['queries'] == 3
+    assert summary['counters'] == {'test.retries': 3}
+
+
+def test_stage_threads():
+    """Test that queries are counted against the stage running on their own thread"""
+    run = Metrics()
+    engine = create_engine('sqlite://', future=True)
+    run.watch(engine)
+
+    def _query():
+        with engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+
+    with run.stage('test.fetch'):
+        thread = threading.Thread(target=_query)
+        thread.start()
+        thread.join()
+    assert run.summary('test')['stages']['test.fetch']['queries'] == 0
+    assert run.summary('test')['queries'] == 1
+
+
+def test_emit(tmp_path_factory):
+    """Test the JSON and Prometheus output"""
+    tmp_path = tmp_path_factory.mktemp('metrics')
+    run = Metrics()
+    with run.stage('ccc_arrival_times.fetch') as stage:
+        stage.rows = 5
+    run.emit('ridesystems_otp', str(tmp_path / 'run.json'), str(tmp_path / 'run.prom'))
+
+    summary = json.loads((tmp_path / 'run.json').read_text())
+    assert summary['run'] == 'ridesystems_otp'
+    assert summary['stages']['ccc_arrival_times.fetch']['rows'] == 5
+
+    prom = (tmp_path / 'run.prom').read_text()
+    assert 'transitstat_stage_rows{run="ridesystems_otp",stage="ccc_arrival_times.fetch"} 5' in prom
+    assert prom == to_prometheus(summary)
+    assert not list(tmp_path.glob('*.tmp'))
+
+    # Emitting with reset starts the totals over
+    run.emit('ridesystems_otp', reset=True)
+    assert not run.summary('ridesystems_otp')['stages']
+
+
+def test_entry_point_stages(conn_str):
+    """Test that the stages of a loader are recorded in the shared metrics"""
+    metrics.reset()
+    read_operator_report(conn_str, Path('tests') / 'data' / 'March 2022 - Dispatch Report.xlsx')
+    stages = metrics.summary('operator_report')['stages']
+    assert list(stages) == ['ccc_operators.parse', 'ccc_operators.transform', 'ccc_operators.write']
+    assert stages['ccc_operators.write']['rows'] == 56
+    assert stages['ccc_operators.write']['queries'] > 0
@@ -0,0 +1,49 @@
+"""Test suite for transitstat.profiler"""
+from sqlalchemy import create_engine, text  # type: ignore
+
+from transitstat.args import setup_parser
+from transitstat.profiler import QueryProfiler, normalize
+
+
+def test_normalize():
+    """Test that statements that only differ in their values are grouped together"""
+    assert normalize("SELECT *\n  FROM ccc_ridership WHERE route = 'Purple' AND blockid = 12") == \
+        'SELECT * FROM ccc_ridership WHERE route = ? AND blockid = ?'
+    assert normalize('SELECT * FROM hc_ridership WHERE date IN (?, ?, ?)') == \
+        normalize('SELECT * FROM hc_ridership WHERE date IN (?, ?)') == \
+        'SELECT * FROM hc_ridership WHERE date IN (?, ...)'
+    assert normalize('INSERT INTO t1 (a, b) VALUES (?, ?), (?, ?), (?, ?)') == \
+        'INSERT INTO t1 (a, b) VALUES (?, ...), ...'
+
+
+def test_profiler():
+    """Test the statement totals and the report"""
+    engine = create_engine('sqlite://', future=True)
+    profiler = QueryProfiler(top_n=2)
+    profiler.start(engine)
+    with engine.begin() as connection:
+        connection.execute(text('CREATE TABLE t (a INTEGER)'))
+        connection.execute(text('INSERT INTO t (a) VALUES (:a)'), [{'a': i} for i in range(5)])
+        for i in range(3):
+            connection.execute(text(f'SELECT a FROM t WHERE a = {i}'))
+    profiler.stop()
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+
+    stats = {i['statement']: i for i in profiler.stats()}
+    assert stats['SELECT a FROM t WHERE a = ?']['count'] == 3
+    assert stats['INSERT INTO t (a) VALUES (?)']['count'] == 1
+    assert 'SELECT ?' not in stats
+    assert all(i['p50'] <= i['p95'] <= i['p99'] <= i['max'] for i in stats.values())
+
+    report = profiler.report()
+    assert report.startswith('Query profile: 5 statements')
+    assert len(profiler.slowest) == 2
+
+
+def test_parse_args():
+    """Test the profiler arguments"""
+    args = setup_parser().parse_args(['--profile', '--profile_top', '5'])
+    assert args.profile
+    assert args.profile_top == 5
+    assert not setup_parser().parse_args([]).profile
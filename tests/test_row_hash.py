@@ -0,0 +1,69 @@
+"""Test suite for transitstat.row_hash"""
+from datetime import date
+
+from transitstat.connector.schema import HcRidership
+from transitstat.database import get_engine
+from transitstat.row_hash import HashCounts, RowHashes, hash_records
+
+
+def test_hash_records():
+    """Test that the hashes only depend on the values"""
+    records = [{'route_id': 1, 'date': date(2022, 3, 1), 'riders': 10},
+               {'route_id': 1, 'date': date(2022, 3, 2), 'riders': None}]
+    hashes = hash_records(HcRidership, records)
+    assert hashes.equals(hash_records(HcRidership, [dict(i) for i in records]))
+    assert hashes['key_hash'].nunique() == 2
+
+    changed = hash_records(HcRidership, [{'route_id': 1, 'date': date(2022, 3, 1), 'riders': 11}])
+    assert changed['key_hash'][0] == hashes['key_hash'][0]
+    assert changed['row_hash'][0] != hashes['row_hash'][0]
+
+
+def test_diff(conn_str):
+    """Test that only new and changed rows are returned once the hashes of a unit are saved"""
+    engine = get_engine(conn_str)
+    row_hashes = RowHashes(engine, 'harbor_connector')
+    records = [{'route_id': 1, 'date': date(2022, 3, i), 'riders': i} for i in range(1, 4)]
+
+    changed, counts, hashes = row_hashes.diff(HcRidership, 'hc_ridership', '2022-03', records)
+    assert changed == records
+    assert counts == HashCounts(new=3, changed=0, unchanged=0)
+    with engine.begin() as connection:
+        row_hashes.save('hc_ridership', '2022-03', hashes, connection)
+
+    records[1] = {'route_id': 1, 'date': date(2022, 3, 2), 'riders': 20}
+    records.append({'route_id': 1, 'date': date(2022, 3, 4), 'riders': 4})
+    changed, counts, _ = row_hashes.diff(HcRidership, 'hc_ridership', '2022-03', records)
+    assert changed == records[1:2] + records[3:]
+    assert counts == HashCounts(new=1, changed=1, unchanged=2)
+
+    # Other units don't share hashes
+    assert row_hashes.diff(HcRidership, 'hc_ridership', '2022-04', records)[1].new == 4
+
+
+def test_save(conn_str):
+    """Test that save only writes the hashes of the written rows, and deletes the ones of rows that are gone"""
+    engine = get_engine(conn_str)
+    row_hashes = RowHashes(engine, 'harbor_connector')
+    records = [{'route_id': 1, 'date': date(2022, 3, i), 'riders': i} for i in range(1, 4)]
+    _, _, update = row_hashes.diff(HcRidership, 'hc_ridership', 'save', records)
+    with engine.begin() as connection:
+        row_hashes.save('hc_ridership', 'save', update, connection)
+    assert row_hashes.count('hc_ridership', 'save') == 3
+
+    records = [{'route_id': 1, 'date': date(2022, 3, 1), 'riders': 10}, records[1]]
+    changed, counts, update = row_hashes.diff(HcRidership, 'hc_ridership', 'save', records)
+    assert changed == records[:1]
+    assert counts == HashCounts(new=0, changed=1, unchanged=1)
+    assert len(update.hashes) == 1
+    assert len(update.removed) == 1
+    with engine.begin() as connection:
+        row_hashes.save('hc_ridership', 'save', update, connection)
+    assert row_hashes.count('hc_ridership', 'save') == 2
+    assert not row_hashes.diff(HcRidership, 'hc_ridership', 'save', records)[0]
+
+    # Writing every row still counts them against the stored hashes
+    changed, counts, update = row_hashes.diff(HcRidership, 'hc_ridership', 'save', records, write_all=True)
+    assert changed == records
+    assert counts == HashCounts(new=0, changed=0, unchanged=2)
+    assert len(update.hashes) == 2
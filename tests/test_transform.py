@@ -0,0 +1,71 @@
+"""Test suite for transitstat._transform"""
+from datetime import date, datetime, time
+
+import pandas as pd  # type: ignore
+
+from transitstat._transform import CategoryDictionary, frame_to_records
+from transitstat.circulator.reports import OTP_COLUMNS, REPORT_CATEGORIES
+from transitstat.circulator.schema import CirculatorArrival, CirculatorRidership
+
+
+def test_frame_to_records_otp():
+    """Test frame_to_records with nulls, renames and type coercion"""
+    df = pd.DataFrame({'date': pd.to_datetime(['2022-03-01', '2022-03-02']),
+                       'route': ['Purple', 'Orange'],
+                       'stop': ['Penn Station', None],
+                       'blockid': ['P_1', 'O_2'],
+                       'scheduledarrivaltime': [time(10, 0), time(11, 0)],
+                       'actualarrivaltime': [time(10, 1), pd.NaT],
+                       'ontimestatus': ['On Time', 'Missing'],
+                       'vehicle': [1211, float('nan')],
+                       'extra': [1, 2]})
+    ret = frame_to_records(df, CirculatorArrival, OTP_COLUMNS)
+    assert ret == [
+        {'date': date(2022, 3, 1), 'route': 'Purple', 'stop': 'Penn Station', 'block_id': 'P_1',
+         'scheduled_arrival_time': time(10, 0), 'actual_arrival_time': time(10, 1), 'on_time_status': 'On Time',
+         'vehicle': '1211'},
+        {'date': date(2022, 3, 2), 'route': 'Orange', 'stop': None, 'block_id': 'O_2',
+         'scheduled_arrival_time': time(11, 0), 'actual_arrival_time': None, 'on_time_status': 'Missing',
+         'vehicle': None},
+    ]
+
+
+def test_frame_to_records_ridership():
+    """Test frame_to_records with datetime and integer columns"""
+    df = pd.DataFrame({'datetime': ['2022-03-01 10:00:00', 'garbage'], 'boardings': [1.0, None]})
+    ret = frame_to_records(df, CirculatorRidership)
+    assert ret == [{'datetime': datetime(2022, 3, 1, 10), 'boardings': 1},
+                   {'datetime': None, 'boardings': None}]
+    assert isinstance(ret[0]['boardings'], int)
+    assert not isinstance(ret[0]['datetime'], pd.Timestamp)
+
+
+def test_category_dictionary():
+    """Test that the codes stay the same across frames, and the values come back out of frame_to_records"""
+    categories = CategoryDictionary(REPORT_CATEGORIES)
+    first = categories.compact(pd.DataFrame({'route': ['Purple', 'Orange', None], 'stop': ['Penn Station'] * 3,
+                                             'boardings': [1, 2, 3]}))
+    second = categories.compact(pd.DataFrame({'route': ['Green', 'Purple'], 'stop': ['Penn Station'] * 2,
+                                              'boardings': [1, 300]}))
+    assert isinstance(first['route'].dtype, pd.CategoricalDtype)
+    assert first['route'].cat.codes.tolist() == [0, 1, -1]
+    assert second['route'].cat.codes.tolist() == [2, 0]
+    assert first['boardings'].dtype == 'int8' and second['boardings'].dtype == 'int16'
+
+    combined = categories.concat([first, second])
+    assert isinstance(combined['route'].dtype, pd.CategoricalDtype)
+    assert combined['route'].tolist()[3:] == ['Green', 'Purple']
+    assert frame_to_records(combined, CirculatorRidership)[2] == {'route': None, 'stop': 'Penn Station',
+                                                                  'boardings': 3}
+
+    # Columns with too many values stay strings
+    capped = CategoryDictionary(['stop'], max_categories=1).compact(pd.DataFrame({'stop': ['Penn Station', 'Harbor']}))
+    assert capped['stop'].dtype == object
+
+
+def test_category_dictionary_all_null():
+    """Test that frames with a dictionary column that is entirely null can be combined"""
+    categories = CategoryDictionary(['route', 'blockid'])
+    combined = categories.concat([pd.DataFrame({'route': ['Purple'], 'blockid': [None]})] * 2)
+    assert combined['route'].tolist() == ['Purple', 'Purple']
+    assert combined['blockid'].isna().all()
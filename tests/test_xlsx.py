@@ -0,0 +1,28 @@
+"""Test suite for transitstat._xlsx"""
+from pathlib import Path
+
+import pandas as pd  # type: ignore
+import pytest
+
+from transitstat._xlsx import iter_sheets
+
+DATA_DIR = Path(__file__).parent / 'data'
+
+
+@pytest.mark.parametrize('file_name', ['testdata.xlsx', 'testdata2.xlsx', 'HC2 03.2022.xlsx',
+                                       'March 2022 - Dispatch Report.xlsx'])
+def test_iter_sheets(file_name):
+    """Test that iter_sheets reads sheets the same way as pd.read_excel"""
+    expected = pd.read_excel(DATA_DIR / file_name, skiprows=[0, 1, 2, 3, 4, 5, 6], skipfooter=2, sheet_name=None)
+    ret = dict(iter_sheets(DATA_DIR / file_name, skiprows=7, skipfooter=2))
+
+    assert list(ret.keys()) == list(expected.keys())
+    for sheet_name, df in ret.items():
+        pd.testing.assert_frame_equal(df, expected[sheet_name], check_dtype=False, check_column_type=False)
+
+
+def test_iter_sheets_include():
+    """Test that iter_sheets only reads the included sheets"""
+    ret = [sheet_name for sheet_name, _ in iter_sheets(DATA_DIR / 'testdata2.xlsx',
+                                                       include=lambda name: name.startswith('JUN'))]
+    assert ret == ['JUN 2 19 ', 'JUN 9 19', 'JUN 16 19 ', 'JUN 23 19 ']